@@ -0,0 +1,124 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Corpus statistics which can be added up a book at a time and merged.
+
+Totals holds only sums and histograms, never the books themselves, so the
+statistics of the whole corpus take the same memory as those of one book.
+The totals of separate workers, runs or machines can be merged, and saved
+as JSON to be merged later.
+"""
+
+from collections import Counter
+import json
+
+from gitlit.alto import Alto, add_histogram, new_histogram
+
+
+class Totals():
+    def __init__(self):
+        self.books = 0
+        self.pages = 0
+        self.words = 0
+        self.chars = 0
+        # Word confidence times words, so that the average is weighted by words
+        self.confidence = 0.0
+        self.cc = new_histogram(10)
+        self.wc = new_histogram(Alto.WORD_CONFIDENCE_HISTOGRAM)
+        self.styles = Counter()
+        self.languages = Counter()
+
+    def add(self, stats):
+        """ Add a book's statistics, as from BLText.getStats(). """
+        self.books += 1
+        self.pages += stats['pages']
+        self.words += stats['words']
+        self.chars += stats['chars']
+        self.confidence += stats['avg_word_confidence'] * stats['words']
+        add_histogram(self.cc, stats['cc'])
+        add_histogram(self.wc, stats['wc'])
+        self.styles.update(stats['styles'])
+        if stats.get('language'):
+            self.languages[stats['language']] += 1
+
+    def merge(self, other):
+        """ Add in another Totals. """
+        self.books += other.books
+        self.pages += other.pages
+        self.words += other.words
+        self.chars += other.chars
+        self.confidence += other.confidence
+        add_histogram(self.cc, other.cc)
+        add_histogram(self.wc, other.wc)
+        self.styles.update(other.styles)
+        self.languages.update(other.languages)
+        return self
+
+    @classmethod
+    def combine(cls, totals):
+        """ The merge of several Totals. """
+        merged = cls()
+        for t in totals:
+            merged.merge(t)
+        return merged
+
+    @property
+    def avg_word_confidence(self):
+        return self.confidence / self.words if self.words else 0
+
+    def toJSON(self):
+        return {'books': self.books, 'pages': self.pages, 'words': self.words, 'chars': self.chars,
+                'confidence': self.confidence, 'cc': [int(c) for c in self.cc], 'wc': [int(c) for c in self.wc],
+                'styles': dict(self.styles), 'languages': dict(self.languages)}
+
+    @classmethod
+    def fromJSON(cls, j):
+        totals = cls()
+        totals.books = j['books']
+        totals.pages = j['pages']
+        totals.words = j['words']
+        totals.chars = j['chars']
+        totals.confidence = j['confidence']
+        add_histogram(totals.cc, j['cc'])
+        add_histogram(totals.wc, j['wc'])
+        totals.styles.update(j['styles'])
+        totals.languages.update(j['languages'])
+        return totals
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.toJSON(), f, indent=2, sort_keys=True)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            return cls.fromJSON(json.load(f))
+
+    def __str__(self):
+        return '%d books, %d pages, %d words, %d chars, average word confidence %.3f' % (
+            self.books, self.pages, self.words, self.chars, self.avg_word_confidence)
+
+
+def test():
+    """ Totals of the sample books added one at a time match those merged from two halves. """
+    from glob import glob
+    from gitlit.reader import BLText
+    books = [BLText(f).getStats() for f in sorted(glob('data/*_dat.zip'))]
+    whole = Totals()
+    for stats in books:
+        whole.add(stats)
+    halves = [Totals(), Totals()]
+    for (i, stats) in enumerate(books):
+        halves[i % 2].add(stats)
+    merged = Totals.combine(Totals.fromJSON(json.loads(json.dumps(h.toJSON()))) for h in halves)
+    (m, w) = (merged.toJSON(), whole.toJSON())
+    # The confidence is summed in a different order, so may differ in the last place
+    assert abs(m.pop('confidence') - w.pop('confidence')) < 1e-6 * whole.words
+    assert m == w, (m, w)
+    assert whole.pages == sum(b['pages'] for b in books)
+    print(whole)
+    print('OK')
+
+
+if __name__ == '__main__':
+    test()
@@ -9,10 +9,19 @@ Created on Jan 20, 2016
 
 from array import array
 from collections import Counter
+from functools import reduce
 from lxml import etree as ET
+from io import BytesIO
+from operator import add
+import os
 import re
 import sys
 
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
 # TODO These can be tagged semantically with visual attributes decided later
 LOW_QUALITY_STYLE = '[maroon]#%s#'
 MED_QUALITY_STYLE = '[grey]#%s#'
@@ -24,6 +33,42 @@ MED_QUALITY_THRESHOLD = 0.0 # 0.65 # Should be higher but generates too much noi
 # This only matches very basic signatures (lower right page marks)
 SIGNATURE_REGEX = re.compile('^[0-9\-—].$')
 
+# TODO: Setting the threshold is key.  We should see a bimodal distribution
+# with lots of values near the left margin, a number near the nominal indent, and few in the middle
+# Perhaps pre-scan all TextBlocks/TextLines on page or in document?
+PARA_INDENT_THRESHOLD = 25 # This value is for experimentation ONLY!
+PARA_INDENT_THRESHOLD2 = 100
+BLOCK_INDENT_THRESHOLD = PARA_INDENT_THRESHOLD # This value is for experimentation ONLY!
+
+MARGINS = frozenset(['TopMargin', 'LeftMargin', 'RightMargin','BottomMargin'])
+DIGITS = '0123456789'
+
+# NumPy is optional, and off unless GITLIT_NUMPY=1, as it's no quicker on BL
+# pages.  With it the confidence histograms are counted with bincount, but
+# they're still kept as arrays of ints, like without it.
+USE_NUMPY = np is not None and os.environ.get('GITLIT_NUMPY') == '1'
+
+# Bulk attribute queries used by the fast parser.  Only words in the text
+# blocks of the print space count, just as in the element by element walk.
+BLOCK_WC = ET.XPath('TextLine/String/@WC', smart_strings=False)
+PAGE_CC = ET.XPath('PrintSpace/TextBlock/TextLine/String/@CC', smart_strings=False)
+PAGE_SUBS_TYPE = ET.XPath('PrintSpace/TextBlock/TextLine/String/@SUBS_TYPE', smart_strings=False)
+
+def new_histogram(size):
+    """ Create an empty histogram. """
+    return array(u'L',[0]*size)
+
+def add_histogram(total, counts):
+    """ Add the counts from one histogram (a list, array or NumPy array) into another, in place. """
+    for i in range(len(total)):
+        total[i] += int(counts[i])
+
+def histogram_arrays(*histograms):
+    """ The histograms as NumPy arrays, for analysis. """
+    if np is None:
+        raise ImportError('NumPy is needed for histogram arrays')
+    return tuple(np.array(h, dtype=np.int64) for h in histograms)
+
 class Alto(object):
     '''
     Class to read the ALTO XML format, as used by the British Library, for encoding OCR text.
@@ -57,38 +102,294 @@ class Alto(object):
 
     WORD_CONFIDENCE_HISTOGRAM = 20
 
-    def __init__(self, xmlfile, continuation):
+    # Whether to use NumPy for the statistics. None means USE_NUMPY.
+    numpy = None
+
+    def __init__(self, xmlfile, continuation, keepConfidences=False):
         '''
-        Constructor
+        Constructor.  With keepConfidences the confidence of each word is
+        kept in word_confidences, for QA.
         '''
+        if self.numpy is None:
+            self.numpy = USE_NUMPY
         self.xmlfile = xmlfile
+        self.keepConfidences = keepConfidences
         self.word_count = 0
         self.avg_word_confidence = None # 0 - 1.0
-        self.char_confidence = array(u'L',[0]*10) # 0=Good to 9=Bad
-        self.word_confidence = array(u'L',[0]*Alto.WORD_CONFIDENCE_HISTOGRAM)
+        self.char_confidence = new_histogram(10) # 0=Good to 9=Bad
+        self.word_confidence = new_histogram(Alto.WORD_CONFIDENCE_HISTOGRAM)
+        self.word_confidences = [] # Confidence of each word, one array per page, with keepConfidences
         self.hyphen1_count = 0
         self.hyphen2_count = 0
         self.text = ''
         self.page_accuracy=[]
         self.pages = 0
         self.styles = Counter()
+        self.wc_strings = []
         self.continuation = continuation
 
         self.parse_file()
 
+    @property
+    def histograms(self):
+        """ (char_confidence, word_confidence) as NumPy arrays. """
+        return histogram_arrays(self.char_confidence, self.word_confidence)
+
     def parseTextBlock(self, block, pageStart, pageMargin):
         """
         Parse the lines, words, spaces, hyphens in a single text block.
 
+        Only the text is assembled element by element.  Word confidences
+        are fetched for the whole block with a single XPath query and
+        added to the histograms by count_confidence() at the end of the
+        page, along with the character confidences and hyphenation counts.
+
         TODO: Do we need a parameter for paragraph indent, avg jitter, etc?
         """
-        # TODO: Setting the threshold is key.  We should see a bimodal distribution
-        # with lots of values near the left margin, a number near the nominal indent, and few in the middle
-        # Perhaps pre-scan all TextBlocks/TextLines on page or in document?
-        PARA_INDENT_THRESHOLD = 25 # This value is for experimentation ONLY!
-        PARA_INDENT_THRESHOLD2 = 100
-        BLOCK_INDENT_THRESHOLD = PARA_INDENT_THRESHOLD # This value is for experimentation ONLY!
+        lines = []
+        if not pageStart and not self.continuation:
+            lines.extend(['',''])
+        centered = False
+        stylerefs = block.get('STYLEREFS')
+        if stylerefs is not None:
+            for s in stylerefs.split():
+                self.styles[s] +=1
+                if s == 'PAR_CENTER':
+                    centered = True
+        hpos = block.get('HPOS')
+        if hpos is None:
+            raise Exception("Block with no HPOS, can't continue")
+        lmargin = int(hpos)
+        # Anything centered is automatically a new paragraph to deal with chapter heads, etc.
+        # Ditto for indented text blocks since they could be blockquote, verse, etc.
+        # FIXME: centered/indented blocks continued from the previous page don't count
+        paraStart = centered or ((lmargin - pageMargin) > BLOCK_INDENT_THRESHOLD)
+
+        wcs = BLOCK_WC(block)
+        self.wc_strings.extend(wcs)
+        # Summed in document order so the total is exactly that of a += loop
+        confidence = reduce(add, map(float, wcs), 0)
+        # Low quality words need their own confidence, so can't use the bulk path
+        styled = LOW_QUALITY_THRESHOLD > 0 or MED_QUALITY_THRESHOLD > 0
+        for tl in block:
+            if tl.tag != 'TextLine':
+                continue
+            # Start with any hyphenated piece left over
+            if self.continuation:
+                lines.append(self.continuation.rstrip('-'))
+                self.continuation = None
+            elif paraStart:
+                lines.extend(['',''])
+                # Leading (especially) and trailing whitespace is problematic
+                # append two spaces to indicate verse mode
+                lines = [line.strip() + '  ' for line in lines]
+                paraStart = False
+            else:
+                lines.append('')
+            hpos = tl.get('HPOS')
+            if hpos is None:
+                raise Exception('Something bad happened - no HPOS in TextLine - aborting')
+            indent = int(hpos) - lmargin
+            if indent > PARA_INDENT_THRESHOLD and indent < PARA_INDENT_THRESHOLD2:
+                lines.append('')
+
+            line = [lines[-1]]
+            append = line.append
+            tag = None
+            for elem in tl:
+                tag = elem.tag
+                if tag == 'String': # <String> element is just a single word
+                    s = elem.get('CONTENT')
+                    if styled:
+                        wc = float(elem.get('WC'))
+                        if wc < LOW_QUALITY_THRESHOLD:
+                            s = LOW_QUALITY_STYLE % s
+                        elif wc < MED_QUALITY_THRESHOLD:
+                            s = MED_QUALITY_STYLE % s
+                    append(s)
+                elif tag == 'SP':
+                    append(' ')
+                elif tag != 'HYP':
+                    print('Unknown tag ' + tag, file=sys.stderr)
+            line = ''.join(line)
+            # End of block hyphenation  not handled correctly by OCR
+            if line[-1] == '-' or tag == 'HYP':
+                w = line.split(' ')
+                line = ' '.join(w[0:-1])
+                self.continuation = w[-1]
+            lines[-1] = line
+
+        return (len(wcs), confidence, self.postprocess(lines, pageStart))
+
+    def postprocess(self, lines, pageStart):
+        """
+        Clean up the assembled lines of a text block and join them into
+        markdown text.
+        """
+        for (i,l) in enumerate(lines):
+            if len(l) > 1:
+                # FIXME: escape_markdown_chars() was called here but its result
+                # was discarded. Applying it changes the output, so it's left out.
+                if l[0] == '=' or l[0] == '.': # Heading & block title markers
+                    l = '{empty}'+l
+                elif l[1] == '.': # list marker
+                    # Lines starting M. Girardeu get interpreted as lists
+                    l = '{empty}' + l # Escape to prevent bad list processing
+                elif l[0:2] == '" ':
+                    # Open quote followed by extraneous space
+                    # This happens more than just at beginning of line, but it's the most common case
+                    # (and the others are more ambiguous and need more sophistication to repair
+                    l = '\\"' + l[2:]
+                # directional quotes are never ambiguous - clean them all up
+                l = l.replace(u'“ ',u'\\“').replace(u' ”',u'\\”')
+                # Extra space before punctuation is not uncommon
+                l = l.replace(' ;',';').replace(' ,',',').replace(' .','')
+                lines[i] = l
+
+            # Move signature marks out of line to a footnote (need better markup)
+            # TODO: handle catchwords too, if present/common in the corpus
+        if len(lines) > 0 and SIGNATURE_REGEX.match(lines[-1]):
+                lines[-1] = 'footnote:[Possible signature: "%s"]' % lines[-1]
+
+        # TODO: Fix this crude chapter detector - chapter head can be in multiple blocks, among other things
+        # TODO:  doesn't handle mid-page chapter heads like doc 000000206
+        if pageStart and len(lines) > 0 and lines[0].find('CHAPTER') >= 0:
+            head = lines[0]
+            # Concatenate all upper case lines
+            for i in range(1,len(lines)):
+                if not lines[i].isupper:
+                    break
+                head += ' ' + lines.pop(i)
+            lines[0] = head
+            lines.insert(1, '-'*len(head))
+            lines.insert(2, '')
+            lines.insert(0,'') # Make sure we have a blank line before
+
+        return '\n'.join(lines)
+
+    def escape_markdown_chars(self, line): 
+        markdown_special_chars = '\`*_{}[]()#+-.!'
+        for char in markdown_special_chars: 
+            line = line.replace(char, "\\"+char) 
+        return line
+
+    def parse_file(self):
+        """
+        Parse the page(s) in the file.  BL files hold a single small page,
+        so the whole document is parsed in one go rather than incrementally.
+        """
+        confidence = 0
+        words = 0
+        parts = [] # Joined once at the end rather than concatenated per block
+        self.wc_strings = []
+        if isinstance(self.xmlfile, (bytes, memoryview)):
+            root = ET.fromstring(self.xmlfile)
+        elif hasattr(self.xmlfile, 'read'):
+            root = ET.fromstring(self.xmlfile.read())
+        else:
+            root = ET.parse(self.xmlfile).getroot()
+        for page in root.iter('Page'):
+            self.pages += 1
+            get = page.get
+            accuracy = get('ACCURACY')
+            if accuracy is not None:
+                self.page_accuracy.append(float(accuracy))
+            leaf = page.attrib['PHYSICAL_IMG_NR']
+            pageno=''
+            printed = get('PRINTED_IMG_NR')
+            if printed is not None:
+                pageno = ', Page: %s' % printed
+            parts.append('\n<!-- Leaf %s' % leaf + pageno + ' -->\n')
+            pageStart = True
+            for ps in page:
+                # Note: Body text can also live in the margins TopMargin, BottomMargin, etc 
+                # if the layout analysis messes up, although normally they only contain
+                # header/footer text
+                tag = ps.tag
+                if tag == 'PrintSpace':
+                    pageMargin = int(ps.attrib['HPOS'])
+                    for tb in ps:
+                        if tb.tag == 'TextBlock':
+                            (w, c, t) = self.parseTextBlock(tb, pageStart, pageMargin)
+                            words += w
+                            confidence += c
+                            parts.append(t)
+                        elif tb.tag == 'ComposedBlock':
+                            parts.append('\n<!-- ComposedBlock (picture?) skipped here %s -->\n' % tb.attrib['ID'])
+                        else:
+                            print('Unknown tag in <PrintSpace> ' + tb.tag, file=sys.stderr)
+                        pageStart = False
+                elif tag not in MARGINS:
+                    print('Unknown tag on <Page> ', tag)
+            self.count_confidence(page)
+        self.text = ''.join(parts)
+        if words:
+            self.avg_word_confidence = confidence / words
+        self.word_count = words
+        if self.pages > 1:
+            # TODO: We kind of assumge one page per file now because that's the BL use case
+            print('WARNING: Multi-page file: %d pages' % self.pages)
+
+    def count_confidence(self, page):
+        """
+        Add the page's word confidences collected by parseTextBlock() to the
+        word histogram and tally its character confidences and hyphenated
+        words, each with one XPath query for the whole page.
+
+        With keepConfidences the per-word confidences are kept in
+        word_confidences for QA.
+        """
+        histogram = Alto.WORD_CONFIDENCE_HISTOGRAM
+        digits = ''.join(PAGE_CC(page))
+        if self.numpy:
+            values = np.array(self.wc_strings, dtype=np.float64)
+            bins = (values*100/histogram).astype(np.intp)
+            add_histogram(self.word_confidence, np.bincount(bins, minlength=histogram))
+            codes = np.frombuffer(digits.encode('ascii'), dtype=np.uint8) - ord('0')
+            if codes.size and codes.max() > 9:
+                raise ValueError('Non-digit character confidence in %s' % self.xmlfile)
+            add_histogram(self.char_confidence, np.bincount(codes, minlength=10))
+            if self.keepConfidences:
+                confidences = array('d')
+                confidences.frombytes(values.tobytes())
+                self.word_confidences.append(confidences)
+        else:
+            for (wc, n) in Counter(self.wc_strings).items():
+                self.word_confidence[int(float(wc)*100/histogram)] += n
+            counted = 0
+            for i in range(10):
+                n = digits.count(DIGITS[i])
+                self.char_confidence[i] += n
+                counted += n
+            if counted != len(digits):
+                raise ValueError('Non-digit character confidence in %s' % self.xmlfile)
+            if self.keepConfidences:
+                self.word_confidences.append(array('d', map(float, self.wc_strings)))
+        self.wc_strings = []
+
+        for hy in PAGE_SUBS_TYPE(page):
+            if hy == 'HypPart1':
+                self.hyphen1_count += 1
+            elif hy == 'HypPart2': # These are sometimes missing
+                self.hyphen2_count += 1
+            else:
+                print('Unrecognized SUBS_TYPE ' + hy, file=sys.stderr)
 
+
+
+class ReferenceAlto(Alto):
+    '''
+    The original, straightforward ALTO parser.  It's slower than Alto, but
+    is kept as the reference that Alto's output and statistics are checked
+    against.
+    '''
+
+    numpy = False
+
+    def parseTextBlock(self, block, pageStart, pageMargin):
+        """
+        Parse the lines, words, spaces, hyphens in a single text block.
+        """
         words = 0
         confidence = 0
         lines = []
@@ -189,52 +490,7 @@ class Alto(object):
                     self.continuation = w[-1]
                 firstLine = False
 
-        # Postprocess text
-        for (i,l) in enumerate(lines):
-            if len(l) > 1:
-                self.escape_markdown_chars(l)
-                if l[0] == '=' or l[0] == '.': # Heading & block title markers
-                    l = '{empty}'+l
-                elif l[1] == '.': # list marker
-                    # Lines starting M. Girardeu get interpreted as lists
-                    l = '{empty}' + l # Escape to prevent bad list processing
-                elif l[0:2] == '" ':
-                    # Open quote followed by extraneous space
-                    # This happens more than just at beginning of line, but it's the most common case
-                    # (and the others are more ambiguous and need more sophistication to repair
-                    l = '\\"' + l[2:]
-                # directional quotes are never ambiguous - clean them all up
-                l = l.replace(u'“ ',u'\\“').replace(u' ”',u'\\”')
-                # Extra space before punctuation is not uncommon
-                l = l.replace(' ;',';').replace(' ,',',').replace(' .','')
-                lines[i] = l
-
-            # Move signature marks out of line to a footnote (need better markup)
-            # TODO: handle catchwords too, if present/common in the corpus
-        if len(lines) > 0 and SIGNATURE_REGEX.match(lines[-1]):
-                lines[-1] = 'footnote:[Possible signature: "%s"]' % lines[-1]
-
-        # TODO: Fix this crude chapter detector - chapter head can be in multiple blocks, among other things
-        # TODO:  doesn't handle mid-page chapter heads like doc 000000206
-        if pageStart and len(lines) > 0 and lines[0].find('CHAPTER') >= 0:
-            head = lines[0]
-            # Concatenate all upper case lines
-            for i in range(1,len(lines)):
-                if not lines[i].isupper:
-                    break
-                head += ' ' + lines.pop(i)
-            lines[0] = head
-            lines.insert(1, '-'*len(head))
-            lines.insert(2, '')
-            lines.insert(0,'') # Make sure we have a blank line before
-
-        return (words, confidence, '\n'.join(lines))
-
-    def escape_markdown_chars(self, line): 
-        markdown_special_chars = '\`*_{}[]()#+-.!'
-        for char in markdown_special_chars: 
-            line = line.replace(char, "\\"+char) 
-        return line
+        return (words, confidence, self.postprocess(lines, pageStart))
 
     def parse_file(self):
         confidence = 0
@@ -242,7 +498,11 @@ class Alto(object):
         # TODO: Count pages, extract <Page @ACCURACY>
         # TODO: Analyze <TextBlock @STYLEREFS @ROTATION
         # TODO: Analyze <TextLine
-        context = ET.iterparse(self.xmlfile, tag='Page') 
+        parts = [] # Joined once at the end rather than concatenated per block
+        xmlfile = self.xmlfile
+        if isinstance(xmlfile, (bytes, memoryview)):
+            xmlfile = BytesIO(xmlfile)
+        context = ET.iterparse(xmlfile, tag='Page') 
         for event, page in context:  # @UnusedVariable
             self.pages += 1
             if 'ACCURACY' in page.attrib:
@@ -251,7 +511,7 @@ class Alto(object):
             pageno=''
             if 'PRINTED_IMG_NR' in page.attrib:
                 pageno = ', Page: %s' % page.attrib['PRINTED_IMG_NR']
-            self.text += '\n<!-- Leaf %s' % leaf + pageno + ' -->\n'
+            parts.append('\n<!-- Leaf %s' % leaf + pageno + ' -->\n')
             pageStart = True
             for ps in page:
                 # Note: Body text can also live in the margins TopMargin, BottomMargin, etc 
@@ -265,10 +525,10 @@ class Alto(object):
                             (w, c, t) = self.parseTextBlock(tb, pageStart, pageMargin)
                             words += w
                             confidence += c
-                            self.text += t
+                            parts.append(t)
                         elif tb.tag == 'ComposedBlock':
                             # TODO: Can this be anything other than a picture?
-                            self.text += ('\n<!-- ComposedBlock (picture?) skipped here %s -->\n' % tb.attrib['ID'])
+                            parts.append('\n<!-- ComposedBlock (picture?) skipped here %s -->\n' % tb.attrib['ID'])
                         else:
                             print('Unknown tag in <PrintSpace> ' + tb.tag, file=sys.stderr)
                         pageStart = False
@@ -277,6 +537,7 @@ class Alto(object):
                 else:
                     print('Unknown tag on <Page> ', ps.tag)
             page.clear() # Clear the page now that we're done with it
+        self.text = ''.join(parts)
         if words:
             self.avg_word_confidence = confidence / words
         self.word_count = words
@@ -298,7 +559,7 @@ def test():
             'data/000000428_0_1-206pgs__1025980_dat.zip',
             'data/000000472_0_1-178pgs__999442_dat.zip',
              ]
-    from zipfile import ZipFile
+    from gitlit.zipmap import MappedZip
     print('    File', 'Words', 'Word Confidence (0-1.0)', 'CharCount', 'Styles')
     for f in files:
         words = 0
@@ -306,25 +567,24 @@ def test():
         text = ''
         cc = array('L',[0]*10)
         styles = Counter()
-        with ZipFile(f) as zf:
+        with MappedZip(f) as zf:
             continuation = None
             for name in zf.namelist():
                 if name.startswith('ALTO/0'):
-                    with zf.open(name) as entry:
-                        a = Alto(entry, continuation)
-                        if a.word_count:
-                            text += a.text
-                            words += a.word_count
-                            for i in range(10):
-                                cc[i] += a.char_confidence[i]
-                            confidence += (a.avg_word_confidence * a.word_count)
-                            styles.update(a.styles)
-                            if a.hyphen1_count != a.hyphen2_count:
-                                print('Mismatched hyphenation count ', name, a.hyphen1_count, a.hyphen2_count, file=sys.stderr)
-                        # print name,a.word_count, a.page_accuracy, a.avg_word_confidence, a.char_confidence
-                        if a.avg_word_confidence and abs(a.avg_word_confidence * 100.0 - a.page_accuracy[0]) > 2.0:  # epsilon = 2%
-                            print('Inaccurate page accuracy %2.2f %2.2f' % (a.page_accuracy[0], a.avg_word_confidence), file=sys.stderr)
-                        continuation = a.continuation
+                    a = Alto(zf.read(name), continuation)
+                    if a.word_count:
+                        text += a.text
+                        words += a.word_count
+                        for i in range(10):
+                            cc[i] += a.char_confidence[i]
+                        confidence += (a.avg_word_confidence * a.word_count)
+                        styles.update(a.styles)
+                        if a.hyphen1_count != a.hyphen2_count:
+                            print('Mismatched hyphenation count ', name, a.hyphen1_count, a.hyphen2_count, file=sys.stderr)
+                    # print name,a.word_count, a.page_accuracy, a.avg_word_confidence, a.char_confidence
+                    if a.avg_word_confidence and abs(a.avg_word_confidence * 100.0 - a.page_accuracy[0]) > 2.0:  # epsilon = 2%
+                        print('Inaccurate page accuracy %2.2f %2.2f' % (a.page_accuracy[0], a.avg_word_confidence), file=sys.stderr)
+                    continuation = a.continuation
                 else:
                     #print '   Skipped', name
                     pass
@@ -335,6 +595,65 @@ def test():
 #         for i in range(10):
 #             print i, '*'*(cc[i]*100/tot)
 
+def compare(files=None, repeats=3):
+    """
+    Check that Alto produces exactly the same text and statistics as
+    ReferenceAlto on the sample books, and report the speedup end to end,
+    from the page XML (read into memory first) to the statistics.  Times are
+    CPU seconds, the best of repeats runs.  The time libxml2 alone takes to
+    parse the pages is shown too, with the speedup there would be if nothing
+    else took any time at all, since neither engine can get below it.
+    """
+    from glob import glob
+    from io import BytesIO
+    import time
+    from zipfile import ZipFile
+    if files is None:
+        files = sorted(glob('data/*_dat.zip'))
+    pages = []
+    for f in files:
+        with ZipFile(f) as zf:
+            pages.extend(zf.read(name) for name in zf.namelist() if name.startswith('ALTO/0'))
+
+    def run(engine, keepConfidences=False):
+        results = []
+        continuation = None
+        start = time.process_time()
+        for page in pages:
+            a = engine(BytesIO(page), continuation, keepConfidences)
+            continuation = a.continuation
+            results.append(a)
+        return time.process_time() - start, results
+
+    def parseAll():
+        start = time.process_time()
+        for page in pages:
+            ET.fromstring(page)
+        return (time.process_time() - start, None)
+
+    def best(f, *args):
+        runs = [f(*args) for i in range(repeats)]
+        return min(runs, key=lambda r: r[0])
+
+    parse = best(parseAll)[0]
+    (fast, fastResults) = best(run, Alto)
+    (ref, refResults) = best(run, ReferenceAlto)
+    attrs = ['text', 'word_count', 'avg_word_confidence', 'char_confidence', 'word_confidence',
+             'hyphen1_count', 'hyphen2_count', 'page_accuracy', 'pages', 'styles', 'continuation']
+    for (a, r) in zip(fastResults, refResults):
+        for attr in attrs:
+            (av, rv) = (getattr(a, attr), getattr(r, attr))
+            if attr in ('char_confidence', 'word_confidence'):
+                (av, rv) = (list(av), list(rv))
+            assert av == rv, 'Mismatched %s' % attr
+        assert not a.word_confidences
+    for a in run(Alto, True)[1]:
+        assert a.word_count == sum(len(p) for p in a.word_confidences)
+    print('%d pages identical. Reference %.2fs, fast %.2fs, speedup %.2fx end to end'
+          % (len(pages), ref, fast, ref / fast))
+    print('Parsing the XML alone takes %.2fs, so no parser built on it can be more than %.2fx faster'
+          % (parse, ref / parse))
 
 if __name__ == '__main__':
     test()
+    compare()
@@ -0,0 +1,198 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Runs a per-book function over a batch of files, either serially or in a
+pool of worker processes.
+
+Results are yielded in completion order and a failure in one book (a bad zip,
+missing metadata, etc) is reported in its result instead of ending the batch.
+
+In parallel, books are started largest first (longest processing time
+first), so that a big book isn't left running alone at the end of the batch
+while the other workers sit idle.
+"""
+
+from concurrent.futures import ProcessPoolExecutor, wait, FIRST_COMPLETED
+from concurrent.futures.process import BrokenProcessPool
+import itertools
+import logging
+import multiprocessing
+import os
+import time
+import traceback
+
+import gitlit.metrics as metrics
+from gitlit.prefetch import warm_ahead
+
+# Number of books queued per worker so that workers never sit idle waiting
+# for the parent, without submitting the whole corpus up front.
+QUEUE_FACTOR = 4
+
+# In a worker process, the queue on which it announces each book it starts
+started = None
+
+
+class BookResult():
+    """ The outcome of running a function over a single book file. """
+    def __init__(self, filename, value=None, error=None, trace=None, seconds=None, metrics=None):
+        self.filename = filename
+        self.value = value
+        self.error = error
+        self.trace = trace
+        self.seconds = seconds
+        # The book's stage timings and counters, from gitlit.metrics
+        self.metrics = metrics
+
+    @property
+    def ok(self):
+        return self.error is None
+
+    def __str__(self):
+        if self.ok:
+            return '%s: %s' % (self.filename, self.value)
+        return '%s: FAILED %s' % (self.filename, self.error)
+
+
+def init_worker(queue):
+    global started
+    started = queue
+
+def call(func, filename):
+    """ Run func on filename, capturing any exception and the book's metrics in the result. """
+    if started is not None:
+        started.put(filename)
+    start = time.time()
+    metrics.start(filename)
+    try:
+        result = BookResult(filename, func(filename))
+    except Exception as e:
+        result = BookResult(filename, error='%s: %s' % (type(e).__name__, e), trace=traceback.format_exc())
+    result.seconds = time.time() - start
+    result.metrics = metrics.stop()
+    return result
+
+def file_size(filename, sizes=None):
+    """ The size of a book, from sizes ({zip name: size}) if it's there, otherwise from the file. """
+    if sizes:
+        size = sizes.get(os.path.basename(filename))
+        if size is not None:
+            return size
+    try:
+        return os.path.getsize(filename)
+    except OSError:
+        return 0
+
+def largest_first(filenames, sizes=None):
+    """ The filenames in decreasing order of size, keeping the original order for equal sizes. """
+    return sorted(filenames, key=lambda f: -file_size(f, sizes))
+
+
+def run(func, filenames, jobs=1, sizes=None, prefetch=0):
+    """
+    Generate a BookResult for each filename, in completion order.
+
+    With jobs > 1 the books are processed in that many worker processes,
+    largest first by sizes or the file sizes.  func must be picklable (a
+    module level function or a functools.partial of one).  If a worker dies
+    outright, the books which had been started are reported as failed and
+    the ones still queued are run in a new pool.  The next prefetch books are
+    read in the background, ready for when they're started.
+    """
+    if jobs <= 1:
+        for filename in warm_ahead(filenames, prefetch):
+            yield call(func, filename)
+        return
+
+    pending = warm_ahead(largest_first(filenames, sizes), prefetch)
+    exhausted = False
+    while not exhausted:
+        queue = multiprocessing.SimpleQueue()
+        begun = set()
+        with ProcessPoolExecutor(max_workers=jobs, initializer=init_worker, initargs=(queue,)) as pool:
+            running = {}
+            try:
+                while True:
+                    while not exhausted and len(running) < jobs * QUEUE_FACTOR:
+                        try:
+                            filename = next(pending)
+                        except StopIteration:
+                            exhausted = True
+                            break
+                        running[pool.submit(call, func, filename)] = filename
+                    if not running:
+                        break
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    drain(queue, begun)
+                    for future in done:
+                        filename = running[future]
+                        result = result_of(future, filename)
+                        del running[future]
+                        begun.discard(filename)
+                        yield result
+            except BrokenProcessPool as e:
+                logging.error('Worker process died, restarting pool: %s', e)
+                drain(queue, begun)
+                died = set(running.values()) & begun
+                requeued = []
+                for (future, filename) in running.items():
+                    try:
+                        result = result_of(future, filename)
+                    except BrokenProcessPool:
+                        if died and filename not in died:
+                            # Never reached a worker, so it gets another go
+                            requeued.append(filename)
+                            continue
+                        result = BookResult(filename, error='Worker process died')
+                    yield result
+                if requeued:
+                    pending = itertools.chain(requeued, pending)
+                    exhausted = False
+        queue.close()
+
+def result_of(future, filename):
+    """ The BookResult of a finished future, re-raising BrokenProcessPool. """
+    try:
+        return future.result()
+    except BrokenProcessPool:
+        raise
+    except Exception as e:
+        # e.g. a result which couldn't be pickled
+        return BookResult(filename, error='%s: %s' % (type(e).__name__, e))
+
+def drain(queue, begun):
+    """ Add the books which the workers have announced on queue to begun. """
+    while not queue.empty():
+        begun.add(queue.get())
+
+
+class Timings():
+    """ How long each book of a batch took, for a report on the slowest ones. """
+    def __init__(self, jobs=1):
+        self.jobs = jobs
+        self.started = time.time()
+        self.seconds = {}
+        self.finished = []
+
+    def add(self, result):
+        if result.seconds is not None:
+            self.seconds[result.filename] = result.seconds
+        self.finished.append(time.time())
+
+    def percentile(self, p):
+        times = sorted(self.seconds.values())
+        return times[min(len(times) - 1, int(p / 100.0 * len(times)))]
+
+    def report(self, slowest=5):
+        if not self.seconds:
+            return 'No books timed.'
+        elapsed = self.finished[-1] - self.started
+        lines = ['%d books in %.1f seconds: median %.2f, p90 %.2f, p99 %.2f, max %.2f seconds per book.' % (
+            len(self.seconds), elapsed, self.percentile(50), self.percentile(90), self.percentile(99),
+            self.percentile(100))]
+        if self.jobs > 1 and len(self.finished) > self.jobs:
+            # From when the first worker ran out of books to when the last one finished
+            tail = self.finished[-1] - self.finished[-self.jobs]
+            lines.append('Tail: %.1f seconds (%.0f%%) with workers idle.' % (tail, 100 * tail / elapsed if elapsed else 0))
+        for (filename, seconds) in sorted(self.seconds.items(), key=lambda i: -i[1])[:slowest]:
+            lines.append('  %.2f  %s' % (seconds, filename))
+        return '\n'.join(lines)
@@ -0,0 +1,210 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Benchmarks of the conversion hot paths, for judging parser changes.
+
+Each benchmark runs in a fresh worker process, so that its peak RSS is its
+own and it doesn't benefit from another's caches, and the best of several
+repeats is kept.  Results can be written as JSON and compared with a
+previous run's to flag regressions.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import glob
+import json
+import os
+import platform
+import resource
+import shutil
+import tempfile
+import time
+
+from gitlit.alto import Alto
+from gitlit.local import LocalRepo, CdContext
+from gitlit.reader import BLCorpus, BLText
+from gitlit.zipmap import MappedZip
+
+# Slowdown (or growth in peak RSS) beyond which a benchmark has regressed
+TOLERANCE = 0.10
+# Differences in time smaller than this are noise, however large a fraction they are
+MIN_SECONDS = 0.05
+REPEAT = 3
+
+
+def read_pages(files):
+    """ The ALTO XML of every page of the books, in order. """
+    pages = []
+    for f in files:
+        with MappedZip(f) as zf:
+            pages.extend(bytes(zf.read(name)) for name in zf.namelist() if name.startswith('ALTO/0'))
+    return pages
+
+def parse_pages(pages):
+    words = 0
+    continuation = None
+    for page in pages:
+        a = Alto(page, continuation)
+        continuation = a.continuation
+        words += a.word_count
+    return {'pages': len(pages), 'words': words}
+
+
+class RecordingAlto(Alto):
+    """ An Alto which keeps the arguments of each postprocess() call, to replay them. """
+    calls = []
+
+    def postprocess(self, lines, pageStart):
+        self.calls.append((list(lines), pageStart))
+        return Alto.postprocess(self, lines, pageStart)
+
+
+def bench_alto(files):
+    """ Alto.parse_file over every page, already read into memory. """
+    pages = read_pages(files)
+    return lambda: parse_pages(pages)
+
+def bench_postprocess(files):
+    """ The markdown clean up of every text block, replayed from a parse of the books. """
+    RecordingAlto.calls = []
+    continuation = None
+    for page in read_pages(files):
+        continuation = RecordingAlto(page, continuation).continuation
+    calls = RecordingAlto.calls
+    counts = {'blocks': len(calls), 'words': sum(len(line.split()) for (lines, _) in calls for line in lines)}
+    alto = Alto(b'<alto/>', None)
+
+    def run():
+        # postprocess() changes the lines, so each repeat gets copies
+        for (lines, pageStart) in [(list(lines), pageStart) for (lines, pageStart) in calls]:
+            alto.postprocess(lines, pageStart)
+        return counts
+    return run
+
+def bench_text(files):
+    """ BLText construction with the text, from the zips. """
+    def run():
+        counts = {'books': 0, 'pages': 0, 'words': 0}
+        for f in files:
+            book = BLText(f)
+            counts['books'] += 1
+            counts['pages'] += book.pages
+            counts['words'] += book.words
+        return counts
+    return run
+
+def bench_metadata(files):
+    """ BLText construction with metadataOnly. """
+    def run():
+        for f in files:
+            BLText(f, metadataOnly=True).title
+        return {'books': len(files)}
+    return run
+
+def bench_repo(files):
+    """ LocalRepo creation, with its Jekyll site, in a temporary directory. """
+    def run():
+        directory = tempfile.mkdtemp(prefix='git-lit-bench')
+        try:
+            with CdContext(directory):
+                counts = {'books': 0, 'pages': 0, 'words': 0}
+                for f in files:
+                    book = BLText(f, streaming=True)
+                    with LocalRepo(book) as repo:
+                        repo.jekyllify()
+                    counts['books'] += 1
+                    counts['pages'] += book.pages
+                    counts['words'] += book.words
+                return counts
+        finally:
+            shutil.rmtree(directory)
+    return run
+
+def bench_corpus(files):
+    """ A lightweight BLCorpus scan of the directory of the books, reading each title. """
+    directories = sorted(set(os.path.dirname(f) for f in files))
+
+    def run():
+        books = 0
+        for d in directories:
+            for text in BLCorpus(d, lightweight=True):
+                text.title
+                books += 1
+        return {'books': books}
+    return run
+
+# name: function of the files returning the function to time, which returns its counts
+BENCHMARKS = {
+    'alto': bench_alto,
+    'postprocess': bench_postprocess,
+    'text': bench_text,
+    'metadata': bench_metadata,
+    'repo': bench_repo,
+    'corpus': bench_corpus,
+}
+
+
+def run_benchmark(name, files, repeat=REPEAT):
+    """ Run a benchmark in this process, returning its best time, counts, rates and peak RSS. """
+    timed = BENCHMARKS[name](files)
+    best = None
+    for i in range(repeat):  # @UnusedVariable
+        start = time.perf_counter()
+        counts = timed()
+        seconds = time.perf_counter() - start
+        best = seconds if best is None else min(best, seconds)
+    result = {'seconds': round(best, 4)}
+    for (unit, count) in counts.items():
+        result[unit] = count
+        result[unit + '_per_sec'] = round(count / best, 1) if best else None
+    # ru_maxrss is in kilobytes on Linux (bytes on macOS)
+    result['peak_rss_kb'] = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return result
+
+def run(files, names=None, repeat=REPEAT):
+    """ Run the benchmarks, each in a new process, returning the results to report. """
+    files = [os.path.abspath(f) for f in files]
+    results = {'python': platform.python_version(), 'machine': platform.machine(), 'files': len(files),
+               'time': time.strftime('%Y-%m-%dT%H:%M:%S'), 'benchmarks': {}}
+    for name in names or BENCHMARKS:
+        with ProcessPoolExecutor(max_workers=1) as pool:
+            results['benchmarks'][name] = pool.submit(run_benchmark, name, files, repeat).result()
+    return results
+
+def default_files():
+    return sorted(glob.glob(os.path.join('data', '*_dat.zip')))
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    """ Descriptions of the benchmarks which are slower, or use more memory, than in the baseline. """
+    regressions = []
+    for (name, result) in sorted(results['benchmarks'].items()):
+        old = baseline['benchmarks'].get(name)
+        if old is None:
+            continue
+        for (measure, what) in (('seconds', 'time'), ('peak_rss_kb', 'peak RSS')):
+            if measure == 'seconds' and result[measure] - old[measure] < MIN_SECONDS:
+                continue
+            if old[measure] and result[measure] > old[measure] * (1 + tolerance):
+                regressions.append('%s: %s up %.0f%% (%s -> %s)' % (
+                    name, what, 100.0 * (result[measure] / old[measure] - 1), old[measure], result[measure]))
+    return regressions
+
+def report(results, baseline=None):
+    """ A table of the results, with the change from the baseline if there is one. """
+    lines = ['%-12s %9s %10s %10s %12s %9s %9s' % ('benchmark', 'seconds', 'books/sec', 'pages/sec', 'words/sec',
+                                                  'RSS MB', 'vs base')]
+    for (name, r) in results['benchmarks'].items():
+        change = ''
+        if baseline and name in baseline['benchmarks'] and baseline['benchmarks'][name]['seconds']:
+            change = '%+.1f%%' % (100.0 * (r['seconds'] / baseline['benchmarks'][name]['seconds'] - 1))
+        lines.append('%-12s %9.3f %10s %10s %12s %9.1f %9s' % (
+            name, r['seconds'], r.get('books_per_sec', '-'), r.get('pages_per_sec', '-'), r.get('words_per_sec', '-'),
+            r['peak_rss_kb'] / 1024.0, change))
+    return '\n'.join(lines)
+
+def load(path):
+    with open(path) as f:
+        return json.load(f)
+
+def save(results, path):
+    with open(path, 'w') as f:
+        json.dump(results, f, indent=2, sort_keys=True)
@@ -0,0 +1,254 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Builds the repositories for a whole batch of books as branches of one
+staging repository, with a single long-lived `git fast-import` per worker
+process instead of a temporary directory and repository per book.
+
+Each book gets the branches <vol_id>/master and <vol_id>/gh-pages, with the
+same trees LocalRepo would make.  Files shared by every book (CONTRIBUTING.md
+and the Jekyll skeleton) are read and sent once per worker.  split() copies
+a book's branches out into a repository of its own, to publish.
+
+Restaging a book only commits the branches whose trees have changed: the new
+tree ids are computed in Python and compared with the staged ones, so an
+unchanged book costs no git objects at all.
+"""
+
+from functools import lru_cache
+import logging
+import lxml.etree
+from multiprocessing.util import Finalize
+import os
+import subprocess
+import tempfile
+
+from pkg_resources import resource_filename
+
+import gitlit.metrics as metrics
+from gitlit.fastimport import FastImport, init_repo, set_head, file_mode, blob_id, file_blob_id, tree_id
+from gitlit.local import render_files, skeleton, HEADER, JEKYLL_TEMPLATES
+
+# Books staged between checkpoints, so that a crash loses at most this many.
+# Books which are journaled are checkpointed one by one instead.
+CHECKPOINT_EVERY = 100
+
+# The fast-import of this process for each staging repository
+importers = {}
+# The branches already staged, as this process first saw them
+heads = {}
+
+
+def staging_repo(path):
+    """ Create the (bare) staging repository if it doesn't exist. Returns its path. """
+    if not os.path.exists(os.path.join(path, 'HEAD')):
+        init_repo(path, bare=True)
+    return os.path.abspath(path)
+
+def branch(vol_id, name):
+    return '%s/%s' % (vol_id, name)
+
+def get_importer(staging):
+    """ This process's importer for the staging repo, closed when the process exits. """
+    importer = importers.get(staging)
+    if importer is None:
+        importer = importers[staging] = StagingImporter(staging)
+        Finalize(importer, importer.close, exitpriority=10)
+    return importer
+
+def get_heads(staging):
+    """ The staged branches, read once per process. """
+    if staging not in heads:
+        heads[staging] = staged_heads(staging)
+    return heads[staging]
+
+def close_importers():
+    """ Finish the importers of this process, e.g. after a serial batch. """
+    while importers:
+        importers.popitem()[1].close()
+
+@lru_cache()
+def shared_files():
+    """ The files every book has, as {path: (mode, contents)}: CONTRIBUTING.md and the Jekyll skeleton. """
+    contributing = resource_filename('gitlit.local', 'templates/CONTRIBUTING.md')
+    with open(contributing, 'rb') as f:
+        files = {'CONTRIBUTING.md': (file_mode(contributing), f.read())}
+    for (path, mode, contents) in skeleton():
+        files[path] = ('100755' if mode & 0o111 else '100644', contents)
+    return files
+
+def book_files(book, spool, jekyll=True):
+    """
+    The trees LocalRepo would make for a book, as {path: (mode, contents)}
+    for the master branch and (with jekyll) the gh-pages branch.  The text
+    is written to the file spool and, like the zip, left on disk as a
+    FileBlob instead of being read into memory.
+    """
+    rendered = render_files(book, jekyll)
+    with open(spool, 'w', encoding='utf-8', newline='') as f:
+        book.writeText(f)
+        f.write('\n')
+    doc = book.vol_id + '.md'
+    shared = shared_files()
+
+    master = {'CONTRIBUTING.md': shared['CONTRIBUTING.md']}
+    master[os.path.basename(book.zipfile)] = (file_mode(book.zipfile), FileBlob(book.zipfile))
+    master[doc] = ('100644', FileBlob(spool))
+    master[book.vol_id + '_metadata.xml'] = ('100644', (
+        lxml.etree.tostring(book.metadata, encoding='unicode') + '\n').encode('utf-8'))
+    master['README.md'] = ('100644', rendered['README.md'].encode('utf-8'))
+    if not jekyll:
+        return (master, None)
+
+    pages = dict(master)
+    pages.update(shared)
+    del pages[doc]
+    pages['index.md'] = ('100644', FileBlob(spool, (rendered[HEADER] + '\n').encode('utf-8')))
+    for f in JEKYLL_TEMPLATES:
+        # Like writing over the skeleton's copy, which keeps its mode
+        mode = pages[f][0] if f in pages else '100644'
+        pages[f] = (mode, rendered[f].encode('utf-8'))
+    return (master, pages)
+
+def blob_ids(files):
+    return {path: (mode, contents.id if isinstance(contents, FileBlob) else blob_id(contents))
+            for (path, (mode, contents)) in files.items()}
+
+def staged_heads(staging, prefix=''):
+    """ The branches in the staging repo, as {name: (commit, tree)}, from a single git command. """
+    metrics.count('subprocesses')
+    out = subprocess.check_output(['git', '--git-dir', staging, 'for-each-ref',
+                                   '--format=%(refname:lstrip=2) %(objectname) %(tree)',
+                                   'refs/heads/' + prefix]).decode('utf-8')
+    return {name: (commit, tree) for (name, commit, tree) in (line.split() for line in out.splitlines())}
+
+def fetch(staging, vol_id, url):
+    """
+    Fetch a book's published branches into the staging repo. Returns whether
+    it had any.  Books are published with only their gh-pages branch, which
+    is made on top of master, so if there's no master its parent is staged
+    as master: otherwise the book would look new, and be committed and
+    pushed again, even though it hasn't changed.
+    """
+    metrics.count('subprocesses')
+    try:
+        subprocess.check_call(['git', '--git-dir', staging, 'fetch', '--quiet', url,
+                               'refs/heads/*:refs/heads/%s*' % branch(vol_id, '')])
+    except subprocess.CalledProcessError:
+        logging.info('Nothing to fetch for %s from %s', vol_id, url)
+        return False
+    fetched = staged_heads(staging, branch(vol_id, ''))
+    if branch(vol_id, 'master') not in fetched and branch(vol_id, 'gh-pages') in fetched:
+        metrics.count('subprocesses')
+        # Fails if gh-pages has no parent, in which case the master is committed afresh
+        subprocess.call(['git', '--git-dir', staging, 'update-ref', 'refs/heads/' + branch(vol_id, 'master'),
+                         'refs/heads/%s^' % branch(vol_id, 'gh-pages')], stderr=subprocess.DEVNULL)
+    return True
+
+def staged_books(staging):
+    """ The vol_ids of the books in the staging repo. """
+    return sorted(set(name.split('/', 1)[0] for name in staged_heads(staging)))
+
+def split(staging, vol_id, directory):
+    """
+    Make a repository of one book's branches from the staging repository,
+    with gh-pages (or master if there's no site) checked out, like the
+    repositories process makes.  Returns the directory.
+    """
+    gitdir = init_repo(os.path.abspath(directory))
+    metrics.count('subprocesses')
+    subprocess.check_call(['git', '--git-dir', gitdir, 'fetch', '--quiet', '--update-head-ok', staging,
+                           'refs/heads/%s*:refs/heads/*' % branch(vol_id, '')])
+    heads = os.listdir(os.path.join(gitdir, 'refs', 'heads'))
+    if not heads:
+        raise KeyError('%s is not in %s' % (vol_id, staging))
+    if 'gh-pages' in heads:
+        set_head(gitdir, 'gh-pages')
+    metrics.count('subprocesses')
+    subprocess.check_call(['git', '--git-dir', gitdir, '--work-tree', directory, 'reset', '--quiet', '--hard'])
+    return directory
+
+
+class FileBlob():
+    """ The contents of a file, after prefix, hashed a chunk at a time. """
+    def __init__(self, path, prefix=b''):
+        self.path = path
+        self.prefix = prefix
+        self.id = file_blob_id(path, prefix)
+
+
+class StagingImporter(FastImport):
+    """ A fast-import which writes book branches to a staging repository. """
+    def __init__(self, staging, checkpointEvery=CHECKPOINT_EVERY):
+        FastImport.__init__(self, staging)
+        self.checkpointEvery = checkpointEvery
+        self.books = 0
+        self.sharedBlobs = None
+        self.closed = False
+
+    def commitFiles(self, branch, message, files, parent=None):
+        """ Commit files, a dict of {path: (mode, contents)}. """
+        if self.sharedBlobs is None:
+            for (mode, contents) in shared_files().values():
+                self.blob(contents)
+            self.sharedBlobs = dict(self.blobs)
+        return self.commit(branch, message, [(path, mode, self.send(contents))
+                                             for (path, (mode, contents)) in sorted(files.items())], parent)
+
+    def send(self, contents):
+        """ Send contents, bytes or a FileBlob, as a blob. Returns its mark. """
+        if isinstance(contents, FileBlob):
+            return self.blobFile(contents.path, contents.prefix, contents.id)
+        return self.blob(contents)
+
+    @metrics.staged('git')
+    def addBook(self, book, jekyll=True, heads=None, durable=False):
+        """
+        Stage a book's branches.  heads are the branches already staged, as
+        from staged_heads(): a branch whose tree hasn't changed isn't
+        committed again, and one which has gets a new commit on top.  With
+        durable the branches are written out before this returns, so the
+        book can be journaled as committed; otherwise they're written every
+        checkpointEvery books.  Returns the names of the branches committed.
+        """
+        heads = heads or {}
+        (fd, spool) = tempfile.mkstemp(prefix='tmptext', suffix='.md')
+        os.close(fd)
+        try:
+            (master, pages) = book_files(book, spool, jekyll)
+            committed = []
+            name = branch(book.vol_id, 'master')
+            (parent, tree) = heads.get(name, (None, None))
+            if tree_id(blob_ids(master)) == tree:
+                masterCommit = parent
+            else:
+                message = 'Update from British Library originals.' if parent else "Initial import from British Library originals."
+                masterCommit = self.commitFiles(name, message, master, parent)
+                committed.append(name)
+
+            if jekyll:
+                name = branch(book.vol_id, 'gh-pages')
+                (parent, tree) = heads.get(name, (masterCommit, None))
+                if tree_id(blob_ids(pages)) != tree:
+                    message = 'Update Jekyll site.' if name in heads else 'Create Jekyll site.'
+                    self.commitFiles(name, message, pages, parent)
+                    committed.append(name)
+        finally:
+            os.remove(spool)
+
+        # Only the shared files are worth deduplicating across books
+        if self.sharedBlobs is not None:
+            self.blobs = dict(self.sharedBlobs)
+        self.books += 1
+        if durable:
+            if committed:
+                self.checkpoint(wait=True)
+        elif self.books % self.checkpointEvery == 0:
+            self.checkpoint()
+        return committed
+
+    def close(self):
+        if not self.closed:
+            self.closed = True
+            FastImport.close(self)
+            logging.info('Staged %d books in %s', self.books, self.gitdir)
@@ -0,0 +1,177 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+A persistent cache of converted books, so that re-running a batch doesn't
+reparse the ALTO of books which haven't changed.
+
+Entries are keyed by a hash of the zip file's contents plus a fingerprint of
+the converter source and the conversion's settings, so changing the book,
+the parser or the settings invalidates them.  Each entry holds the compressed markdown and the BLText statistics.
+The cache is a single SQLite database which is shared by worker processes and
+trimmed back to its size limit by evicting the least recently used books.
+"""
+
+import codecs
+from functools import lru_cache
+import hashlib
+import json
+import logging
+import os
+import sqlite3
+import time
+import zlib
+
+DEFAULT_PATH = os.environ.get('GITLIT_CACHE',
+                              os.path.join(os.path.expanduser('~'), '.cache', 'git-lit', 'conversions.db'))
+DEFAULT_MAX_BYTES = 4 * 1024 ** 3
+
+# Modules whose source determines the converted text and statistics
+CONVERTER_MODULES = ['alto.py', 'reader.py', 'language.py']
+
+# Size of the pieces cached text is decompressed in
+CHUNK_SIZE = 256 * 1024
+
+
+@lru_cache()
+def fingerprint():
+    """ A hash of the converter source, which changes whenever the parser does. """
+    h = hashlib.sha1()
+    here = os.path.dirname(os.path.abspath(__file__))
+    for module in CONVERTER_MODULES:
+        with open(os.path.join(here, module), 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()[:16]
+
+def file_hash(filename):
+    """ SHA-1 of a file's contents. """
+    h = hashlib.sha1()
+    with open(filename, 'rb') as f:
+        for block in iter(lambda: f.read(1024 * 1024), b''):
+            h.update(block)
+    return h.hexdigest()
+
+@lru_cache()
+def open_cache(path=DEFAULT_PATH, max_bytes=DEFAULT_MAX_BYTES):
+    """ Get the cache at path, opening it only once per process. """
+    return ConversionCache(path, max_bytes)
+
+
+class CachedBook():
+    """ A cache hit: the statistics and compressed text of a converted book. """
+    def __init__(self, stats, blob):
+        self.stats = stats
+        self.blob = blob
+
+    def chunks(self):
+        """ Generate the text in pieces, without decompressing it all at once. """
+        decompressor = zlib.decompressobj()
+        decoder = codecs.getincrementaldecoder('utf-8')()
+        for i in range(0, len(self.blob), CHUNK_SIZE):
+            text = decoder.decode(decompressor.decompress(self.blob[i:i + CHUNK_SIZE]))
+            if text:
+                yield text
+        text = decoder.decode(decompressor.flush(), final=True)
+        if text:
+            yield text
+
+
+class CacheWriter():
+    """ Compresses a book's text as it's generated, then stores it. """
+    def __init__(self, cache, key):
+        self.cache = cache
+        self.key = key
+        self.compressor = zlib.compressobj()
+        self.pieces = []
+
+    def write(self, text):
+        self.pieces.append(self.compressor.compress(text.encode('utf-8')))
+
+    def commit(self, stats):
+        self.pieces.append(self.compressor.flush())
+        self.cache.put(self.key, b''.join(self.pieces), stats)
+
+
+class ConversionCache():
+    def __init__(self, path=DEFAULT_PATH, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.max_bytes = max_bytes
+        directory = os.path.dirname(path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+        self.db = sqlite3.connect(path, timeout=60)
+        # WAL lets worker processes read while another one writes
+        self.db.execute('PRAGMA journal_mode=WAL')
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS books ('
+                            'key TEXT PRIMARY KEY, stats TEXT, text BLOB, size INTEGER, used REAL)')
+            self.db.execute('CREATE INDEX IF NOT EXISTS books_used ON books (used)')
+            # The total size of the books, kept up to date as they're added and removed
+            self.db.execute('CREATE TABLE IF NOT EXISTS total (id INTEGER PRIMARY KEY CHECK (id = 0), size INTEGER)')
+            if self.db.execute('SELECT 1 FROM total').fetchone() is None:
+                self.db.execute('INSERT INTO total SELECT 0, COALESCE(SUM(size), 0) FROM books')
+
+    def __reduce__(self):
+        # Open the same cache in the process it's sent to
+        return (open_cache, (self.path, self.max_bytes))
+
+    def key(self, zipfile, sha=None, settings=''):
+        """
+        The key of a book, from the SHA-1 of its zip if it's already known.
+        settings tells apart conversions of the same book which differ,
+        e.g. in how its language is detected.
+        """
+        key = (sha or file_hash(zipfile)) + '-' + fingerprint()
+        if settings:
+            key += '-' + settings
+        return key
+
+    def get(self, key):
+        """ Returns a CachedBook, or None if the book isn't cached. """
+        row = self.db.execute('SELECT stats, text FROM books WHERE key = ?', (key,)).fetchone()
+        if row is None:
+            return None
+        with self.db:
+            self.db.execute('UPDATE books SET used = ? WHERE key = ?', (time.time(), key))
+        logging.debug('Conversion cache hit %s', key)
+        return CachedBook(json.loads(row[0]), row[1])
+
+    def writer(self, key):
+        return CacheWriter(self, key)
+
+    def put(self, key, blob, stats):
+        stats = json.dumps(stats)
+        size = len(blob) + len(stats)
+        with self.db:
+            # Replaces any entry for the key, so less its size
+            self.db.execute('UPDATE total SET size = size + ? - COALESCE((SELECT size FROM books WHERE key = ?), 0)',
+                            (size, key))
+            self.db.execute('INSERT OR REPLACE INTO books (key, stats, text, size, used) VALUES (?, ?, ?, ?, ?)',
+                            (key, stats, blob, size, time.time()))
+        self.evict()
+
+    def size(self):
+        return self.db.execute('SELECT size FROM total').fetchone()[0]
+
+    def evict(self):
+        """ Drop the least recently used books until the cache fits in max_bytes. """
+        excess = self.size() - self.max_bytes
+        if excess <= 0:
+            return
+        victims = []
+        for (key, size) in self.db.execute('SELECT key, size FROM books ORDER BY used'):
+            victims.append((key,))
+            excess -= size
+            if excess <= 0:
+                break
+        with self.db:
+            for victim in victims:
+                # Another process may have evicted it already
+                self.db.execute('UPDATE total SET size = size - COALESCE((SELECT size FROM books WHERE key = ?), 0)',
+                                victim)
+                self.db.execute('DELETE FROM books WHERE key = ?', victim)
+        logging.info('Evicted %d books from the conversion cache', len(victims))
+
+    def clear(self):
+        with self.db:
+            self.db.execute('DELETE FROM books')
+            self.db.execute('UPDATE total SET size = 0')
@@ -0,0 +1,239 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Builds git repositories by streaming blobs and commits to a single
+`git fast-import` process, instead of running git init/add/commit/checkout
+for every step.
+
+The repository skeleton is created in Python, so writing a whole repository
+takes exactly one subprocess.  Only objects and refs are written: there's no
+index, so one has to be written afterwards (with `git read-tree HEAD`, as
+LocalRepo does) before the working tree can be used with git.
+"""
+
+from functools import lru_cache
+import hashlib
+import logging
+import os
+import shutil
+import subprocess
+import time
+
+import gitlit.metrics as metrics
+
+DEFAULT_NAME = 'Git-Lit'
+DEFAULT_EMAIL = 'git-lit@users.noreply.github.com'
+# Bytes read at a time when hashing a file
+CHUNK = 1 << 16
+
+
+@lru_cache()
+def identity():
+    """
+    The (name, email) to commit as, as git itself would commit: from
+    `git var GIT_COMMITTER_IDENT`, run once per process.
+    """
+    metrics.count('subprocesses')
+    try:
+        ident = subprocess.check_output(['git', 'var', 'GIT_COMMITTER_IDENT'],
+                                        stderr=subprocess.DEVNULL).decode('utf-8')
+    except (OSError, subprocess.CalledProcessError):
+        # e.g. git can't work out an email address
+        return (DEFAULT_NAME, DEFAULT_EMAIL)
+    # Name <email> timestamp timezone
+    (name, rest) = ident.split('<', 1)
+    return (name.strip() or DEFAULT_NAME, rest.split('>', 1)[0].strip() or DEFAULT_EMAIL)
+
+def init_repo(directory, branch='master', bare=False):
+    """ Create an empty repository, like git init but without a subprocess. Returns the git dir. """
+    gitdir = directory if bare else os.path.join(directory, '.git')
+    for d in ['objects/info', 'objects/pack', 'refs/heads', 'refs/tags']:
+        os.makedirs(os.path.join(gitdir, d), exist_ok=True)
+    set_head(gitdir, branch)
+    with open(os.path.join(gitdir, 'config'), 'w') as f:
+        f.write('[core]\n\trepositoryformatversion = 0\n\tfilemode = true\n'
+                '\tbare = %s\n\tlogallrefupdates = true\n' % ('true' if bare else 'false'))
+    return gitdir
+
+def set_head(gitdir, branch):
+    """ Point HEAD at a branch, like git checkout without touching the working tree. """
+    with open(os.path.join(gitdir, 'HEAD'), 'w') as f:
+        f.write('ref: refs/heads/%s\n' % branch)
+
+def file_mode(path):
+    """ The git mode for a file, executable or not. """
+    if os.stat(path).st_mode & 0o111:
+        return '100755'
+    return '100644'
+
+def blob_id(data):
+    """ The git object id of a blob, without writing it anywhere. """
+    return hashlib.sha1(b'blob %d\0' % len(data) + data).hexdigest()
+
+def file_blob_id(path, prefix=b''):
+    """ The git object id of a blob of prefix and then a file, read a chunk at a time. """
+    sha = hashlib.sha1(b'blob %d\0' % (len(prefix) + os.path.getsize(path)) + prefix)
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK), b''):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def tree_id(files):
+    """
+    The git object id of the tree of files, a dict of {path: (mode, blob id)},
+    so a tree can be compared with a commit's without building it.
+    """
+    root = {}
+    for (path, entry) in files.items():
+        node = root
+        parts = path.split('/')
+        for d in parts[:-1]:
+            node = node.setdefault(d, {})
+        node[parts[-1]] = entry
+    return _tree_id(root)
+
+def _tree_id(node):
+    entries = []
+    for (name, entry) in node.items():
+        if isinstance(entry, dict):
+            # git sorts subtrees as if their names ended with /
+            entries.append((name + '/', b'40000 %s\0%s' % (name.encode('utf-8'), bytes.fromhex(_tree_id(entry)))))
+        else:
+            (mode, sha) = entry
+            entries.append((name, b'%s %s\0%s' % (mode.encode('ascii'), name.encode('utf-8'), bytes.fromhex(sha))))
+    body = b''.join(e for (name, e) in sorted(entries, key=lambda e: e[0].encode('utf-8')))
+    return hashlib.sha1(b'tree %d\0' % len(body) + body).hexdigest()
+
+def tree_files(directory):
+    """ The files in a working tree (without .git) as sorted relative paths. """
+    files = []
+    for (dirpath, dirs, filenames) in os.walk(directory):
+        if dirpath == directory and '.git' in dirs:
+            dirs.remove('.git')
+        for f in filenames:
+            files.append(os.path.relpath(os.path.join(dirpath, f), directory))
+    return sorted(files)
+
+
+class FastImport():
+    """
+    A `git fast-import` process.  Blobs are identified by marks, and blobs
+    given as data are only sent once however many commits use them.
+    """
+    def __init__(self, gitdir):
+        self.gitdir = gitdir
+        # stdout only carries the progress lines which tell checkpoint() it's done
+        self.process = subprocess.Popen(['git', '--git-dir', gitdir, 'fast-import', '--quiet', '--done'],
+                                        stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+        metrics.count('subprocesses')
+        self.stream = self.process.stdin
+        self.mark = 0
+        self.blobs = {}
+        (self.name, self.email) = identity()
+
+    def nextMark(self):
+        self.mark += 1
+        return ':%d' % self.mark
+
+    def write(self, text):
+        self.stream.write(text.encode('utf-8'))
+
+    def data(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        self.write('data %d\n' % len(data))
+        metrics.count('git_bytes', len(data))
+        self.stream.write(data)
+        self.stream.write(b'\n')
+
+    def blob(self, data):
+        """ Send a blob (bytes or str) unless it's already been sent. Returns its mark. """
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        key = hashlib.sha1(data).digest()
+        mark = self.blobs.get(key)
+        if mark is None:
+            mark = self.nextMark()
+            self.write('blob\nmark %s\n' % mark)
+            self.data(data)
+            self.blobs[key] = mark
+        return mark
+
+    def blobFile(self, path, prefix=b'', key=None):
+        """
+        Stream a file as a blob, after prefix, without reading it all into
+        memory.  With a key (such as its blob id) it's only sent once.
+        Returns its mark.
+        """
+        mark = self.blobs.get(key) if key else None
+        if mark is None:
+            mark = self.nextMark()
+            size = len(prefix) + os.path.getsize(path)
+            self.write('blob\nmark %s\ndata %d\n' % (mark, size))
+            metrics.count('git_bytes', size)
+            self.stream.write(prefix)
+            with open(path, 'rb') as f:
+                shutil.copyfileobj(f, self.stream)
+            self.stream.write(b'\n')
+            if key:
+                self.blobs[key] = mark
+        return mark
+
+    def commit(self, branch, message, files, parent=None):
+        """
+        Commit a complete tree to a branch.  files is a list of (path, mode,
+        mark) and replaces whatever the parent commit had.  parent is a
+        commit mark, sha or ref.  Returns the new commit's mark.
+        """
+        mark = self.nextMark()
+        when = '%d %s' % (time.time(), time.strftime('%z'))
+        self.write('commit refs/heads/%s\nmark %s\n' % (branch, mark))
+        self.write('author %s <%s> %s\ncommitter %s <%s> %s\n' % (self.name, self.email, when, self.name, self.email, when))
+        self.data(message)
+        if parent:
+            self.write('from %s\n' % parent)
+        self.write('deleteall\n')
+        for (path, mode, blob) in files:
+            self.write('M %s %s %s\n' % (mode, blob, path))
+        self.write('\n')
+        return mark
+
+    @metrics.staged('git')
+    def commitDirectory(self, branch, message, directory, parent=None):
+        """ Commit the files in a working directory, like git add --all && git commit. """
+        files = [(f, file_mode(os.path.join(directory, f)), self.blobFile(os.path.join(directory, f)))
+                 for f in tree_files(directory)]
+        return self.commit(branch, message, files, parent)
+
+    def checkpoint(self, wait=False):
+        """
+        Write out what's been imported so far, updating the refs.  With wait,
+        only return once fast-import has done so, when they're safely on disk.
+        """
+        self.write('checkpoint\n\n')
+        if wait:
+            # fast-import reports progress in order, so this comes after the checkpoint
+            self.write('progress checkpoint\n\n')
+        self.stream.flush()
+        if wait and not self.process.stdout.readline():
+            raise IOError('git fast-import for %s stopped before its checkpoint' % self.gitdir)
+
+    def close(self):
+        self.write('done\n')
+        self.stream.close()
+        code = self.process.wait()
+        self.process.stdout.close()
+        if code:
+            raise IOError('git fast-import failed for %s with code %d' % (self.gitdir, code))
+        logging.debug('Wrote %d objects to %s', self.mark, self.gitdir)
+
+    def abort(self):
+        """ Stop the import without finishing it, e.g. after an error, so no refs are updated. """
+        self.process.kill()
+        try:
+            self.stream.close()
+        except OSError:
+            # Whatever was still buffered can't be written to the killed process
+            pass
+        self.process.wait()
+        self.process.stdout.close()
@@ -6,11 +6,15 @@ Syncs a local git book repo to a remote git repo (by default, github)
 Based on code from the GITenberg project
 """
 
+import json
 import logging
-import time
+import os
+import tempfile
 import github3
 import sh
+import gitlit.cache
 from gitlit.local import CdContext
+from gitlit.publish import push_with_retry
 
 try:
     from secrets import GH_USER, GH_PASSWORD
@@ -20,6 +24,107 @@ except:
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+ORG = 'Git-Lit'
+# A book's repo, by vol_id
+REMOTE = 'git@github.com:' + ORG + '/%s.git'
+REPO_INDEX = os.path.join(os.path.dirname(gitlit.cache.DEFAULT_PATH), 'repos-%s.json')
+# Repos added or removed before the index is saved, short of a flush().  One
+# lost on a crash is only missed until the next refresh finds it.
+SAVE_EVERY = 50
+
+def is_book(name):
+    # assumes that books start with 0. 
+    return name.startswith('0')
+
+
+class RepoIndex():
+    """
+    The names of the book repos in an org, kept on disk between runs.  The
+    listing is refreshed at most once per process, with a conditional
+    request on its ETag: GitHub lists the newest repos first, so the first
+    page changes whenever a repo is created.  Repos we create or delete
+    ourselves are added or removed as we go, and saved every SAVE_EVERY
+    changes or on flush().
+    """
+    def __init__(self, org, path=None):
+        self.org = org
+        self.path = path or REPO_INDEX % ORG
+        self.names = set()
+        self.etag = None
+        self.fresh = False
+        self.unsaved = 0
+        if os.path.exists(self.path):
+            with open(self.path) as f:
+                saved = json.load(f)
+            self.names = set(saved['names'])
+            self.etag = saved['etag']
+
+    def refresh(self):
+        """ Update the names from GitHub unless they haven't changed. Returns whether they had. """
+        self.fresh = True
+        repos = self.org.iter_repos(etag=self.etag)
+        names = set()
+        etag = None
+        for repo in repos:
+            if etag is None:
+                # The iterator keeps the ETag we gave it, so take the new one from the first page
+                etag = repos.last_response.headers.get('ETag')
+            if is_book(repo.name):
+                names.add(repo.name)
+        if getattr(repos, 'last_status', None) == 304:
+            logger.debug('Repo list for %s unchanged.', self.path)
+            return False
+        self.names = names
+        self.etag = etag
+        self.save()
+        return True
+
+    def save(self):
+        directory = os.path.dirname(self.path)
+        if directory and not os.path.isdir(directory):
+            os.makedirs(directory, exist_ok=True)
+        # A temporary file of our own, since other processes may be saving the same index
+        (fd, temp) = tempfile.mkstemp(prefix=os.path.basename(self.path) + '.', suffix='.tmp', dir=directory or '.')
+        try:
+            with os.fdopen(fd, 'w') as f:
+                json.dump({'etag': self.etag, 'names': sorted(self.names)}, f)
+            os.replace(temp, self.path)
+        except BaseException:
+            os.remove(temp)
+            raise
+        self.unsaved = 0
+
+    def flush(self):
+        """ Save any repos added or removed since the last save. """
+        if self.unsaved:
+            self.save()
+
+    def ensureFresh(self):
+        if not self.fresh:
+            self.refresh()
+
+    def __contains__(self, name):
+        self.ensureFresh()
+        return name in self.names
+
+    def __iter__(self):
+        self.ensureFresh()
+        return iter(sorted(self.names))
+
+    def add(self, name):
+        self.names.add(name)
+        self.changed()
+
+    def discard(self, name):
+        self.names.discard(name)
+        self.changed()
+
+    def changed(self):
+        self.unsaved += 1
+        if self.unsaved >= SAVE_EVERY:
+            self.save()
+
+
 class GithubRepo():
 
     def __init__(self, book, directory):
@@ -37,15 +142,13 @@ class GithubRepo():
         self.github = github3.login(username=GH_USER, password=GH_PASSWORD)
         if hasattr(self.github, 'set_user_agent'):
             self.github.set_user_agent('Jonathan Reeve: http://jonreeve.com')
-        self.org = self.github.organization('Git-Lit')
+        self.org = self.github.organization(ORG)
         logger.debug("ratelimit: " + str(self.org.ratelimit_remaining))
+        self.repos = RepoIndex(self.org)
 
     def repo_exists(self, repo): 
         """ Checks if a repo exists in the Git-Lit org. """
-        repos = [repo.name for repo in self.org.iter_repos()
-                # assumes that books start with 0. 
-                if repo.name.startswith('0')]
-        return repo in repos
+        return repo in self.repos
 
     def format_desc(self):
         return '{0} by {1} is a British Library book, now on GitHub.'.format(
@@ -65,6 +168,8 @@ class GithubRepo():
             has_issues=True,
             has_wiki=False,
         )
+        self.repos.add(self.repo.name)
+        self.repos.flush()
 
     def add_remote_origin_to_local_repo(self):
         with CdContext(self.directory):
@@ -74,13 +179,8 @@ class GithubRepo():
                 print("We may have already added a remote origin to this repo")
 
     def push_to_github(self):
-        with CdContext(self.directory):
-            try:
-                sh.git('push', 'origin', 'gh-pages')
-            except sh.ErrorReturnCode_128:
-                logging.error(u"github repo not ready yet")
-                time.sleep(10)
-                sh.git('push', 'origin', 'gh-pages')
+        # Retried with backoff while GitHub finishes creating the repo
+        push_with_retry(['-C', self.directory, 'push', 'origin', 'gh-pages'])
 
 class GitHub(): 
     """ 
@@ -97,20 +197,19 @@ class GitHub():
         self.github = github3.login(username=GH_USER, password=GH_PASSWORD)
         if hasattr(self.github, 'set_user_agent'):
             self.github.set_user_agent('Jonathan Reeve: http://jonreeve.com')
-        self.org = self.github.organization('Git-Lit')
+        self.org = self.github.organization(ORG)
         logger.debug("ratelimit: " + str(self.org.ratelimit_remaining))
+        self.repos = RepoIndex(self.org)
 
     def delete(self, repo): 
         repository = self.github.repository('git-lit', repo)
         success = repository.delete()
         if success: 
+            self.repos.discard(repo)
             logging.info('Repo %s successfully deleted.' % repo)
         else: 
             logging.warn("Repo %s wasn't deleted!" % repo)
 
     def list(self): 
         """ Gets list of all book-looking items in the Git-Lit org. """
-        repos = [repo.name for repo in self.org.iter_repos()
-                # assumes that books start with 0. 
-                if repo.name.startswith('0')]
-        return sorted(repos)
+        return [repo for repo in self.repos]
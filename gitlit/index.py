@@ -0,0 +1,233 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+A persistent SQLite index of the volumes in a corpus, so that selecting
+books by author, language, number of volumes, etc is a query rather than a
+parse of every zip file.
+
+Volumes are refreshed incrementally: a zip is only re-read when its size or
+modification time has changed.  The index also holds the print/scan ID
+crosswalk, the zip sizes from the corpus file list and the languages from
+the extended booklists, each reloaded only when its file changes.
+"""
+
+import glob
+import json
+import logging
+import os
+import re
+import sqlite3
+
+from gitlit.reader import BLMetadata, scanMetadata
+
+DEFAULT_PATH = 'corpus-index.db'
+METADATA_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'metadata')
+CROSSWALK = os.path.join(METADATA_DIR, 'crosswalk.tsv')
+FILE_LIST = os.path.join(METADATA_DIR, 'file-list.txt')
+# Output of tools/extend_booklist.py: Print sysnum, Flag, Detected Lang, Best Lang, Scan sysnum, ...
+BOOKLISTS = os.path.join(METADATA_DIR, 'booklist-*.tsv')
+
+PAGES_RE = re.compile(r'_(\d+)-(\d+)pgs_')
+
+SCHEMA = [
+    '''CREATE TABLE IF NOT EXISTS volumes (
+        path TEXT PRIMARY KEY, vol_id TEXT, book_id TEXT, volume INTEGER,
+        title TEXT, author TEXT, pages INTEGER, size INTEGER, print_id TEXT,
+        scan_id TEXT, language TEXT, mtime REAL, stat_size INTEGER)''',
+    'CREATE INDEX IF NOT EXISTS volumes_book_id ON volumes (book_id)',
+    'CREATE INDEX IF NOT EXISTS volumes_vol_id ON volumes (vol_id)',
+    'CREATE INDEX IF NOT EXISTS volumes_language ON volumes (language)',
+    # Each of a volume's authors, for exact or prefix lookups by name
+    'CREATE TABLE IF NOT EXISTS authors (path TEXT, name TEXT COLLATE NOCASE)',
+    'CREATE INDEX IF NOT EXISTS authors_name ON authors (name)',
+    'CREATE INDEX IF NOT EXISTS authors_path ON authors (path)',
+    'CREATE TABLE IF NOT EXISTS crosswalk (print_id TEXT, scan_id TEXT)',
+    'CREATE INDEX IF NOT EXISTS crosswalk_print_id ON crosswalk (print_id)',
+    'CREATE INDEX IF NOT EXISTS crosswalk_scan_id ON crosswalk (scan_id)',
+    'CREATE TABLE IF NOT EXISTS file_sizes (name TEXT PRIMARY KEY, size INTEGER)',
+    'CREATE TABLE IF NOT EXISTS languages (id TEXT PRIMARY KEY, language TEXT)',
+    'CREATE TABLE IF NOT EXISTS sources (path TEXT PRIMARY KEY, mtime REAL, size INTEGER)',
+]
+
+def pageCount(zipfile):
+    """ Number of pages from a zip name like 000000037_0_1-42pgs__944211_dat.zip """
+    m = PAGES_RE.search(os.path.basename(zipfile))
+    if not m:
+        return None
+    return int(m.group(2)) - int(m.group(1)) + 1
+
+def jsonAuthor(author):
+    """ The author (a string or list) as JSON, with its characters as they are so that LIKE can match them. """
+    return json.dumps(author, ensure_ascii=False)
+
+def authorNames(author):
+    """ The author (a string or list) as a list of names. """
+    if isinstance(author, list):
+        return author
+    return [author] if author else []
+
+def likePrefix(prefix):
+    """ A LIKE pattern (with ESCAPE '\\') matching strings which start with prefix. """
+    return prefix.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') + '%'
+
+def findZips(path):
+    """ All the book zips in a directory tree. """
+    for (dirpath, dirs, files) in os.walk(path):  # @UnusedVariable
+        for f in files:
+            if f.endswith('_dat.zip'):
+                yield os.path.join(dirpath, f)
+
+
+class CorpusIndex():
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = path
+        self.db = sqlite3.connect(path, timeout=60)
+        with self.db:
+            for statement in SCHEMA:
+                self.db.execute(statement)
+
+    def sourceChanged(self, path):
+        """ Has a side file changed since we last loaded it? Records the new state if so. """
+        if not os.path.exists(path):
+            return False
+        st = os.stat(path)
+        row = self.db.execute('SELECT mtime, size FROM sources WHERE path = ?', (path,)).fetchone()
+        if row == (st.st_mtime, st.st_size):
+            return False
+        self.db.execute('INSERT OR REPLACE INTO sources VALUES (?, ?, ?)', (path, st.st_mtime, st.st_size))
+        return True
+
+    def loadSources(self, crosswalk=CROSSWALK, fileList=FILE_LIST, booklists=BOOKLISTS):
+        """ Reload any of the crosswalk, file list and booklists which have changed. """
+        with self.db:
+            if self.sourceChanged(crosswalk):
+                logging.info('Loading crosswalk %s', crosswalk)
+                self.db.execute('DELETE FROM crosswalk')
+                with open(crosswalk) as f:
+                    rows = (line.rstrip('\n').split('\t')[:2] for line in f if not line.startswith('Print ID'))
+                    self.db.executemany('INSERT INTO crosswalk VALUES (?, ?)',
+                                        ([None if i in ('', 'None') else i for i in row] for row in rows if len(row) == 2))
+            if self.sourceChanged(fileList):
+                logging.info('Loading file sizes %s', fileList)
+                self.db.execute('DELETE FROM file_sizes')
+                with open(fileList) as f:
+                    rows = (line.split() for line in f)
+                    self.db.executemany('INSERT OR REPLACE INTO file_sizes VALUES (?, ?)',
+                                        ((row[1], int(row[0])) for row in rows if len(row) == 2))
+            for booklist in sorted(glob.glob(booklists)):
+                if self.sourceChanged(booklist):
+                    logging.info('Loading languages %s', booklist)
+                    with open(booklist, encoding='utf-8') as f:
+                        for line in f:
+                            fields = line.rstrip('\n').split('\t')
+                            if len(fields) < 5 or not fields[3] or fields[0].startswith('Print'):
+                                continue
+                            for i in (fields[0], fields[4]):
+                                if i and i != 'None':
+                                    self.db.execute('INSERT OR REPLACE INTO languages VALUES (?, ?)', (i, fields[3]))
+
+    def refresh(self, paths, jobs=1):
+        """
+        Bring the index up to date with the zips in the given directories
+        (or lists of zips), reading metadata only for new or changed files.
+        Volumes whose files have gone from a scanned directory are dropped.
+        """
+        self.loadSources()
+        files = []
+        for path in paths:
+            if os.path.isdir(path):
+                files.extend(findZips(path))
+                prefix = os.path.join(path, '')
+                for (indexed,) in self.db.execute('SELECT path FROM volumes WHERE path LIKE ?', (prefix + '%',)).fetchall():
+                    if not os.path.exists(indexed):
+                        with self.db:
+                            self.db.execute('DELETE FROM volumes WHERE path = ?', (indexed,))
+                            self.db.execute('DELETE FROM authors WHERE path = ?', (indexed,))
+            else:
+                files.append(path)
+
+        stale = {}
+        for f in files:
+            st = os.stat(f)
+            row = self.db.execute('SELECT mtime, stat_size FROM volumes WHERE path = ?', (f,)).fetchone()
+            if row != (st.st_mtime, st.st_size):
+                stale[f] = st
+        logging.info('Indexing %d new or changed of %d files', len(stale), len(files))
+        with self.db:
+            for record in scanMetadata(list(stale), jobs):
+                self.add(record, stale[record.zipfile])
+        return len(stale)
+
+    def add(self, record, st):
+        name = os.path.basename(record.zipfile)
+        row = self.db.execute('SELECT print_id, scan_id FROM crosswalk WHERE print_id = ? OR scan_id = ?',
+                              (record.book_id, record.book_id)).fetchone()
+        (print_id, scan_id) = row if row else (None, None)
+        # Keep any language detected from the text if the booklists don't have one
+        row = self.db.execute('SELECT language FROM volumes WHERE path = ?', (record.zipfile,)).fetchone()
+        language = row[0] if row else None
+        for i in (record.book_id, print_id, scan_id):
+            lang = i and self.db.execute('SELECT language FROM languages WHERE id = ?', (i,)).fetchone()
+            if lang:
+                language = lang[0]
+                break
+        # Prefer the corpus file list size (the published zip) if we know it
+        size = self.db.execute('SELECT size FROM file_sizes WHERE name = ?', (name,)).fetchone()
+        self.db.execute('INSERT OR REPLACE INTO volumes VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                        (record.zipfile, record.vol_id, record.book_id, record.volume, record.title,
+                         jsonAuthor(record.author), pageCount(name), size[0] if size else st.st_size,
+                         print_id, scan_id, language, st.st_mtime, st.st_size))
+        self.db.execute('DELETE FROM authors WHERE path = ?', (record.zipfile,))
+        self.db.executemany('INSERT INTO authors VALUES (?, ?)',
+                            ((record.zipfile, name) for name in authorNames(record.author)))
+
+    def setLanguage(self, vol_id, language):
+        """ Record the language detected from a volume's text, e.g. by tools/stats.py --index. """
+        with self.db:
+            self.db.execute('UPDATE volumes SET language = ? WHERE vol_id = ?', (language, vol_id))
+
+    def select(self, book_id=None, vol_id=None, author=None, language=None, volumes=None, title=None,
+               authorPrefix=None, order='path'):
+        """
+        Select volume rows.  author and title match substrings (SQL LIKE),
+        authorPrefix matches the start of any of the authors' names using
+        the author index, ignoring case.  volumes is the number of volumes
+        of the book.  Returns sqlite3.Row objects.
+        """
+        where = []
+        args = []
+        for (column, value) in (('book_id', book_id), ('vol_id', vol_id), ('language', language)):
+            if value is not None:
+                where.append('%s = ?' % column)
+                args.append(value)
+        for (column, value) in (('author', author), ('title', title)):
+            if value is not None:
+                where.append('%s LIKE ?' % column)
+                args.append('%' + value + '%')
+        if authorPrefix is not None:
+            where.append("path IN (SELECT path FROM authors WHERE name LIKE ? ESCAPE '\\')")
+            args.append(likePrefix(authorPrefix))
+        if volumes is not None:
+            where.append('book_id IN (SELECT book_id FROM volumes GROUP BY book_id HAVING COUNT(*) = ?)')
+            args.append(volumes)
+        sql = 'SELECT * FROM volumes'
+        if where:
+            sql += ' WHERE ' + ' AND '.join(where)
+        sql += ' ORDER BY ' + order
+        self.db.row_factory = sqlite3.Row
+        try:
+            return self.db.execute(sql, args).fetchall()
+        finally:
+            self.db.row_factory = None
+
+    def query(self, **criteria):
+        """ The zip paths matching the criteria of select(). """
+        return [row['path'] for row in self.select(**criteria)]
+
+    def records(self, **criteria):
+        """ BLMetadata records for the matching volumes, with title and author from the index. """
+        for row in self.select(**criteria):
+            yield BLMetadata(row['path'], title=row['title'], author=json.loads(row['author']))
+
+    def __len__(self):
+        return self.db.execute('SELECT COUNT(*) FROM volumes').fetchone()[0]
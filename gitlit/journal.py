@@ -0,0 +1,86 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+A journal of how far each book in a batch has got, so that an interrupted
+run can be resumed without redoing finished books.
+
+Each command keeps its own record of every book (by the absolute path of its
+zip): converted, committed (to a local or staging repo), pushed, or failed
+with an error.  A book whose push failed keeps its committed repo, so a
+resumed run only has to push it again.  The journal is a SQLite database, so several runs over
+disjoint sets of books can share one.
+"""
+
+import json
+import logging
+import os
+import sqlite3
+import time
+
+DEFAULT_PATH = 'git-lit-journal.db'
+
+CONVERTED = 'converted'
+COMMITTED = 'committed'
+PUSHED = 'pushed'
+FAILED = 'failed'
+PUSH_FAILED = 'push failed'
+
+
+class Journal():
+    def __init__(self, path=DEFAULT_PATH, command='process'):
+        self.path = path
+        self.command = command
+        self.db = sqlite3.connect(path, timeout=60)
+        self.db.execute('PRAGMA journal_mode=WAL')
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS books ('
+                            'command TEXT, filename TEXT, state TEXT, value TEXT, error TEXT, updated REAL, '
+                            'PRIMARY KEY (command, filename))')
+
+    def record(self, filename, state, value=None, error=None):
+        with self.db:
+            self.db.execute('INSERT OR REPLACE INTO books VALUES (?, ?, ?, ?, ?, ?)',
+                            (self.command, os.path.abspath(filename), state, json.dumps(value), error, time.time()))
+
+    def recordResult(self, result, state, failedState=FAILED):
+        """
+        Record a batch.BookResult, which reached state if it didn't fail.  If
+        it did fail, it's recorded as failedState, and for any state but
+        FAILED it keeps the value it had, e.g. the directory of its repo.
+        """
+        if result.ok:
+            self.record(result.filename, state, result.value)
+        elif failedState == FAILED:
+            self.record(result.filename, FAILED, error=result.error)
+        else:
+            previous = self.state(result.filename)
+            self.record(result.filename, failedState, previous[1] if previous else None, result.error)
+
+    def state(self, filename):
+        """ The (state, value, error) of a book, or None if it hasn't been run. """
+        row = self.db.execute('SELECT state, value, error FROM books WHERE command = ? AND filename = ?',
+                              (self.command, os.path.abspath(filename))).fetchone()
+        if row is None:
+            return None
+        return (row[0], json.loads(row[1]), row[2])
+
+    def values(self, filenames, states):
+        """ {filename: value} for the books which have reached one of the states. """
+        found = {}
+        for filename in filenames:
+            s = self.state(filename)
+            if s and s[0] in states:
+                found[filename] = s[1]
+        return found
+
+    def pending(self, filenames, states):
+        """ The books which haven't reached one of the states, in order. Failed books are retried. """
+        done = self.values(filenames, states)
+        if done:
+            logging.info('Skipping %d of %d books already %s.', len(done), len(filenames), ' or '.join(states))
+        return [f for f in filenames if f not in done]
+
+    def summary(self):
+        """ {state: number of books} for this command. """
+        return dict(self.db.execute('SELECT state, COUNT(*) FROM books WHERE command = ? GROUP BY state',
+                                    (self.command,)).fetchall())
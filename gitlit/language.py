@@ -0,0 +1,94 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Identifies the language of a book from a sample of its pages, taken while
+the pages are converted so that the text isn't read a second time.
+
+The pages sampled are spread evenly through the volume, so front matter in
+another language doesn't decide it, and the sample is capped in size.  CLD2
+(pycld2) is used if it's installed, otherwise a count of common words of the
+languages most frequent in the corpus.  Languages are ISO 639-1 codes, with
+'un' for unknown as in CLD2.
+"""
+
+from collections import Counter
+import re
+
+try:
+    import pycld2
+except ImportError:
+    pycld2 = None
+
+# Which detector is used, since the languages found depend on it
+DETECTOR = 'cld2' if pycld2 is not None else 'stopwords'
+
+SAMPLE_PAGES = 10
+SAMPLE_BYTES = 20000
+UNKNOWN = 'un'
+
+MARKUP = re.compile(r'<!--.*?-->|\{empty\}', re.DOTALL)
+WORD = re.compile(r'[^\W\d_]+')
+
+# The commonest words of each language, for when CLD2 isn't available
+STOPWORDS = {
+    'en': 'the and of to in that is was he for it with as his on be at by had which this not but from',
+    'de': 'der die und in den von zu das mit sich des auf für ist im dem nicht ein eine als auch',
+    'fr': 'le la de et les des en un une du que qui dans est pour pas par sur il au',
+    'it': 'di e il la che per un in del non della una si da le con al gli dei',
+    'es': 'de la que el en y los del se las por un para con no una su al es lo',
+    'nl': 'de en van het een in is dat op te zijn met voor niet aan er die hij',
+    'sv': 'och att det som en på är av för med till den har de inte om ett han',
+    'la': 'et in est non ad cum quod ut sed qui quae per ex esse sunt de enim',
+}
+STOPWORD_SETS = {lang: frozenset(words.split()) for (lang, words) in STOPWORDS.items()}
+# Stopwords found before a guess counts, and how far ahead of the next it must be
+MIN_HITS = 20
+MARGIN = 1.5
+
+
+def sample_pages(count, pages=SAMPLE_PAGES):
+    """ The indexes of pages (of count) to sample, spread evenly through the volume. """
+    if count <= pages:
+        return set(range(count))
+    return set(int((i + 0.5) * count / pages) for i in range(pages))
+
+def detect_stopwords(text):
+    counts = Counter()
+    for word in WORD.findall(text.lower()):
+        for (lang, words) in STOPWORD_SETS.items():
+            if word in words:
+                counts[lang] += 1
+    ranked = counts.most_common(2) + [(UNKNOWN, 0)]
+    ((best, hits), (second, secondHits)) = ranked[:2]  # @UnusedVariable
+    if hits < MIN_HITS or hits < secondHits * MARGIN:
+        return UNKNOWN
+    return best
+
+def detect(text):
+    """ The language of a text, as an ISO 639-1 code, or UNKNOWN if it's not clear. """
+    text = MARKUP.sub(' ', text)
+    if pycld2 is not None:
+        try:
+            (isReliable, textBytesFound, details) = pycld2.detect(text.encode('utf-8'), isPlainText=True)  # @UnusedVariable
+        except pycld2.error:
+            return UNKNOWN
+        return details[0][1] if isReliable else UNKNOWN
+    return detect_stopwords(text)
+
+
+class LanguageSampler():
+    """ Collects the sample of a book's text as its pages are converted, then detects its language. """
+    def __init__(self, count, pages=SAMPLE_PAGES, size=SAMPLE_BYTES):
+        self.wanted = sample_pages(count, pages) if pages else set()
+        # Each sampled page gets an equal share of the sample
+        self.perPage = size // max(len(self.wanted), 1)
+        self.parts = []
+
+    def add(self, index, text):
+        if index in self.wanted:
+            self.parts.append(text[:self.perPage])
+
+    def detect(self):
+        if not self.wanted:
+            return None
+        return detect(' '.join(self.parts))
@@ -7,49 +7,133 @@ Based on code from GITenburg project.
 """
 
 import codecs
+from functools import lru_cache
+import gitlit.cache
+import gitlit.metrics as metrics
 import jinja2
 import sh
 import logging
 import lxml
+import os
 import shutil
 import tempfile
 import glob
 from pkg_resources import resource_filename
+from gitlit.fastimport import FastImport, init_repo, set_head, tree_files
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
 BASE_URL = 'https://Git-Lit.github.io/'
 
+# Jekyll site files which are generated from templates
+JEKYLL_TEMPLATES = ['_config.yml', 'about.md']
+
+# Where compiled templates are kept between runs
+TEMPLATE_CACHE = os.path.join(os.path.dirname(gitlit.cache.DEFAULT_PATH), 'templates')
+
+# Key of the Jekyll page header in render_files()
+HEADER = 'book-header.md'
+
+@lru_cache()
+def environment():
+    """ The Jinja2 environment for the templates, created once per process. """
+    os.makedirs(TEMPLATE_CACHE, exist_ok=True)
+    return jinja2.Environment(loader=jinja2.FileSystemLoader(resource_filename(__name__, 'templates')),
+                              bytecode_cache=jinja2.FileSystemBytecodeCache(TEMPLATE_CACHE))
+
+@lru_cache()
+def skeleton():
+    """ The Jekyll skeleton files, read once per process, as a list of (path, mode, contents). """
+    try:
+        skel_dir = resource_filename(__name__, 'jekyll-skel/') 
+    except: 
+        logging.warn("Couldn't find Jekyll skel directory.")
+        raise IOError("Couldn't find Jekyll skel directory!")
+    files = []
+    for f in tree_files(skel_dir):
+        path = os.path.join(skel_dir, f)
+        with open(path, 'rb') as skelFile:
+            files.append((f, os.stat(path).st_mode & 0o777, skelFile.read()))
+    return files
+
+@metrics.staged('render')
+def render_files(book, jekyll=True):
+    """
+    Renders all the templated files for a book in one go: the README and,
+    for a Jekyll site, its files plus the page header under HEADER.
+    """
+    context = dict(
+        title = book.title,
+        author = book.author,
+        book_id = book.vol_id, # Use this, since it will have volume info. 
+        url = BASE_URL + book.vol_id, 
+    )
+    names = ['README.md']
+    if jekyll:
+        names += JEKYLL_TEMPLATES + [HEADER]
+    return {name: environment().get_template(name + '.j2').render(context) for name in names}
+
+def directory_size(directory):
+    """ The total size of the files under a directory, .git and all. """
+    size = 0
+    for (dirpath, dirs, filenames) in os.walk(directory):  # @UnusedVariable
+        for f in filenames:
+            size += os.path.getsize(os.path.join(dirpath, f))
+    return size
+
 class CdContext():
-    """ A context manager using `sh` to cd to a directory and back
+    """ A context manager to cd to a directory and back
         `with CdContext(new path to go to)`
     """
     def __init__(self, path):
-        self._og_directory = str(sh.pwd()).strip('\n')
+        self._og_directory = os.getcwd()
         self._dest_directory = path
 
     def __enter__(self):
-        sh.cd(self._dest_directory)
+        os.chdir(self._dest_directory)
 
     def __exit__(self, exception_type, exception_value, traceback):
-        sh.cd(self._og_directory)
+        os.chdir(self._og_directory)
 
 
 class LocalRepo():
-    def __init__(self, book):
-        """ Requires a BLText book object as input. """ 
+    def __init__(self, book, backend='fastimport', jekyll=True):
+        """
+        Requires a BLText book object as input.  Without jekyll only the
+        README is rendered, since jekyllify() won't be called.
+
+        With the fastimport backend all the commits are written by one
+        `git fast-import` process, which is finished by close(), or by
+        leaving the repo's with block.  The original sh backend runs git
+        for each step instead.
+        """ 
         self.book = book
+        self.backend = backend
+        self.fastimport = None
         self.basename = self.book.vol_id
         self.title = self.book.title
         logging.info("Now attempting to initialize a local git repository for text: " 
                       + self.basename + " a.k.a. " + self.title )
+        self.rendered = render_files(self.book, jekyll)
         self.directory = tempfile.mkdtemp(prefix='tmprepo%s' % self.basename, dir='.')
         # TODO: Temp dirs being created locally to ease debugging.  Remove for production
         self.add_new_files()
-        self.add_all_files()
-        self.commit("Initial import from British Library originals.")
+        if self.backend == 'fastimport':
+            self.gitdir = init_repo(os.path.abspath(self.directory))
+            with metrics.stage('git'):
+                self.fastimport = FastImport(self.gitdir)
+            try:
+                self.master = self.fastimport.commitDirectory('master', "Initial import from British Library originals.",
+                                                              self.directory)
+            except:
+                self.abort()
+                raise
+        else:
+            self.add_all_files()
+            self.commit("Initial import from British Library originals.")
 
+    @metrics.staged('write')
     def add_new_files(self):
         shutil.copy(self.book.zipfile, self.directory)
         self.write_text()
@@ -59,30 +143,16 @@ class LocalRepo():
 
     def write_text(self):
         with open(self.directory+'/'+ self.basename + '.md','w') as f:
-            f.write(self.book.text + '\n')
+            self.book.writeText(f)
+            f.write('\n')
 
     def write_metadata(self):
         with open(self.directory+'/'+self.basename + '_metadata.xml','w') as f:
             f.write(lxml.etree.tostring(self.book.metadata, encoding='unicode') + '\n')
 
     def template_readme(self):
-        templateFilename = resource_filename(__name__, 'templates/README.md.j2')
-        with open(templateFilename) as f:
-            templateSrc = f.read()
-        template = jinja2.Template(templateSrc)
-        readme_text = template.render(
-            title = self.title,
-            author = self.book.author,
-            book_id = self.basename, # Use this, since it will have volume info. 
-            url = BASE_URL + self.basename, 
-        )
-
-        readme_path = "{0}/{1}".format(
-            self.directory,
-            'README.md'
-        )
-        with open(readme_path, 'w') as readme_file:
-            readme_file.write(readme_text)
+        with open(self.directory + '/README.md', 'w') as readme_file:
+            readme_file.write(self.rendered['README.md'])
 
     def copy_files(self):
         """ Copy the LICENSE and CONTRIBUTING files to each folder repo """
@@ -90,22 +160,22 @@ class LocalRepo():
         # license = resource_filename(__name__, 'templates/LICENSE')
         contributing = resource_filename(__name__, 'templates/CONTRIBUTING.md')
         FILES = [contributing] 
-        this_dir = sh.pwd().strip()
         for _file in FILES:
-            sh.cp(
-                _file,
-                '{0}/'.format(self.directory)
-            )
+            shutil.copy(_file, self.directory)
 
+    @metrics.staged('git')
     def add_all_files(self):
         with CdContext(self.directory):
             sh.git.init('.')
             files = glob.glob('./*')
+            metrics.count('subprocesses', len(files) + 1)
             logging.debug("Files to add: %s")
             for file in files: 
                 sh.git('add', file)
 
+    @metrics.staged('git')
     def commit(self, message):
+        metrics.count('subprocesses')
         with CdContext(self.directory):
             try:
                 # note the double quotes around the message
@@ -121,60 +191,82 @@ class LocalRepo():
     def template_header(self): 
         """ Generates a Jekyll page header (YAML) from the template. """
         logging.info('Creating book headers from template.')
-        headerTemplate = resource_filename(__name__, 'templates/book-header.md.j2')
-        with open(headerTemplate, 'r') as templateFile: 
-            templateContents = templateFile.read() 
-            template = jinja2.Template(templateContents)
-            header = template.render(title=self.title)
-        return header
+        return self.rendered[HEADER]
 
     def template_file(self, filename): 
         """ Generates a file from its template. """
-        templateFilename = filename + '.j2'
-        logging.info('Generating %s from %s.' % (filename, templateFilename))
-        templateFilename = resource_filename(__name__, 'templates/'+templateFilename)
-        with open(templateFilename, 'r') as templateFile: 
-            templateContents = templateFile.read()
-            template = jinja2.Template(templateContents)
-        out = template.render(
-                title = self.title, 
-                author = self.book.author,
-                book_id = self.basename,
-                )
-        return out
+        logging.info('Generating %s from %s.j2.' % (filename, filename))
+        return self.rendered[filename]
 
+    @metrics.staged('write')
     def jekyllify(self): 
         logging.info('Now creating a Jekyll site out of this repo.')
 
         with CdContext(self.directory):
             # Copy Jekyll skeleton files to our new directory. 
-            try:
-                skel_dir = resource_filename(__name__, 'jekyll-skel/') 
-            except: 
-                logging.warn("Couldn't find Jekyll skel directory.")
-                raise IOError("Couldn't find Jekyll skel directory!")
-            sh.cp('-a', skel_dir+'.', '.')
+            for (path, mode, contents) in skeleton():
+                if os.path.dirname(path):
+                    os.makedirs(os.path.dirname(path), exist_ok=True)
+                with open(path, 'wb') as f:
+                    f.write(contents)
+                os.chmod(path, mode)
 
             # Create header from template. 
             header = self.template_header()
 
             # Prepend header to book markdown file. 
+            # Copied in chunks so the whole book is never held in memory.
             doc = self.basename+'.md'
-            with open(doc, 'r') as origFile: 
-                origContent = origFile.read()
-            with open(doc, 'w') as modifiedFile:
-                modifiedFile.write(header + '\n' + origContent)
-            sh.mv(doc, 'index.md')
-            # Remove it from git, since we've renamed it to index.md
-            sh.git('rm', doc) 
-
-            for f in ['_config.yml', 'about.md']: 
+            with open(doc, 'r') as origFile, open('index.md', 'w') as modifiedFile:
+                modifiedFile.write(header + '\n')
+                shutil.copyfileobj(origFile, modifiedFile)
+            if self.fastimport:
+                os.remove(doc)
+            else:
+                # Remove it from git, since we've renamed it to index.md
+                metrics.count('subprocesses')
+                sh.git('rm', doc) 
+
+            for f in JEKYLL_TEMPLATES: 
                 out = self.template_file(f)
                 with open(f, 'w') as outFile: 
                     outFile.write(out) 
 
+            if self.fastimport:
+                self.fastimport.commitDirectory('gh-pages', 'Create Jekyll site.', '.', parent=self.master)
+                set_head(self.gitdir, 'gh-pages')
+                return
+
             # Use gh-pages branch. 
+            metrics.count('subprocesses')
             sh.git('checkout', '-b', 'gh-pages')
 
         self.add_all_files()
         self.commit('Create Jekyll site.')
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        if exception_type is None:
+            self.close()
+        else:
+            self.abort()
+
+    @metrics.staged('git')
+    def close(self):
+        """
+        Finish writing the repository.  fast-import doesn't write an index,
+        so one is read from HEAD, or git would see every file as deleted.
+        """
+        if self.fastimport:
+            self.fastimport.close()
+            self.fastimport = None
+            metrics.count('subprocesses')
+            sh.git('--git-dir', self.gitdir, 'read-tree', 'HEAD')
+
+    def abort(self):
+        """ Stop writing the repository after an error, leaving its branches unwritten. """
+        if self.fastimport:
+            self.fastimport.abort()
+            self.fastimport = None
@@ -1,10 +1,24 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 
+import gitlit.batch as batch
+import gitlit.bench as bench
+import gitlit.bulk as bulk
+import gitlit.cache
+import gitlit.index
+import gitlit.journal as journal
 import gitlit.local as local
+import gitlit.metrics as metrics
+import gitlit.prefetch as prefetching
 import gitlit.github as github
+import gitlit.publish
+import gitlit.shard as sharding
 from gitlit.reader import BLText
+from functools import partial
 import logging
+import os
+import shutil
+import tempfile
 import click
 
 logger = logging.getLogger()
@@ -21,23 +35,243 @@ def cli(debug):
     if debug: 
         logger.setLevel(logging.DEBUG)
 
+def open_cache(useCache):
+    if useCache:
+        return gitlit.cache.open_cache()
+    return None
+
+def convert_book(filename, useCache=True, prefetch=prefetching.PAGE_DEPTH):
+    """ Converts a single book to markdown in the current directory. """
+    logging.info('Converting book: %s', filename) 
+    book = BLText(filename, streaming=True, cache=open_cache(useCache), prefetch=prefetch)  
+    outname = book.book_id + '.md'
+    with metrics.stage('write'), open(outname,'w') as f:
+        book.writeText(f)
+        f.write('\n')
+    metrics.count('bytes_written', os.path.getsize(outname))
+    return outname
+
+def process_book(filename, jekyll=True, useCache=True, backend='fastimport', prefetch=prefetching.PAGE_DEPTH):
+    """ Creates a local git repository for a single book. """
+    logging.info('Processing book: %s', filename) 
+    book = BLText(filename, streaming=True, cache=open_cache(useCache), prefetch=prefetch)  
+    logging.info('Making local repo: %s %s' % (book.book_id, book.title))
+    with local.LocalRepo(book, backend=backend, jekyll=jekyll) as repo:
+        if jekyll: 
+            repo.jekyllify()
+    metrics.count('bytes_written', local.directory_size(repo.directory))
+    return os.path.abspath(repo.directory)
+
+def log_published(results):
+    """ Logs each publishing result, returning the number which failed. """
+    failed = 0
+    for result in results:
+        if result.ok:
+            logging.info('Published %s', result)
+        else:
+            failed += 1
+            logging.error('Failed to publish %s', result)
+            logging.debug(result.trace)
+    return failed
+
+def publish_repos(directories, jobs, log=None, report=None):
+    """
+    Creates GitHub repos for the local book repos and pushes them, several at
+    a time.  directories is {book filename: repo directory}, for the journal
+    and metrics report.
+    """
+    publishJobs = [gitlit.publish.PublishJob.fromDirectory(d) for d in directories.values()]
+    filenames = {d: f for (f, d) in directories.items()}
+    results = gitlit.publish.Publisher(jobs=jobs).publish(publishJobs)
+    if log: 
+        results = journaled(results, log, journal.PUSHED, filenames, journal.PUSH_FAILED)
+    if report: 
+        results = reported(results, report, filenames)
+    check_failures(log_published(results), len(publishJobs), ' to publish')
+
+def journaled(results, log, state, filenames=None, failedState=journal.FAILED):
+    """ Records each result in the journal as it passes. filenames maps the results' names to the books'. """
+    for result in results:
+        original = result.filename
+        if filenames: 
+            result.filename = filenames[original]
+        log.recordResult(result, state, failedState)
+        result.filename = original
+        yield result
+
+def reported(results, report, filenames=None):
+    """ Adds each result's metrics to the report as it passes. filenames maps the results' names to the books'. """
+    for result in results:
+        report.add(result, filenames.get(result.filename) if filenames else None)
+        yield result
+
+def stage_book(filename, staging, jekyll=True, useCache=True, prefetch=prefetching.PAGE_DEPTH, durable=False):
+    """
+    Adds the branches for a single book to a bulk staging repository, written
+    out before it returns with durable, e.g. to journal it as committed.
+    """
+    logging.info('Staging book: %s', filename) 
+    book = BLText(filename, streaming=True, cache=open_cache(useCache), prefetch=prefetch)  
+    return bulk.get_importer(staging).addBook(book, jekyll, bulk.get_heads(staging), durable)
+
+def split_book(vol_id, staging):
+    """ Copies a book out of a bulk staging repo into a repo of its own. Returns its directory. """
+    directory = tempfile.mkdtemp(prefix='tmprepo%s' % vol_id, dir='.')
+    try: 
+        return os.path.abspath(bulk.split(staging, vol_id, directory))
+    except: 
+        shutil.rmtree(directory)
+        raise
+
+def update_book(filename, staging, jekyll=True, useCache=True, remote=None, prefetch=prefetching.PAGE_DEPTH): 
+    """
+    Re-renders a book into a bulk staging repo, committing only the branches
+    which have changed.  With a remote URL, a book which isn't staged yet is
+    first fetched from its published repo.  Returns (vol_id, branches committed).
+    """
+    logging.info('Updating book: %s', filename) 
+    book = BLText(filename, streaming=True, cache=open_cache(useCache), prefetch=prefetch)  
+    heads = bulk.get_heads(staging)
+    if remote and bulk.branch(book.vol_id, 'master') not in heads: 
+        if bulk.fetch(staging, book.vol_id, remote % book.vol_id): 
+            heads.update(bulk.staged_heads(staging, bulk.branch(book.vol_id, '')))
+    return (book.vol_id, bulk.get_importer(staging).addBook(book, jekyll, heads))
+
+def run_batch(func, filenames, jobs, log=None, state=None, summary=None, prefetch=0, report=None, manifest=None):
+    """
+    Runs func over all the books, logging each result as it completes, and
+    recording it in the journal log, shard summary and metrics report if
+    there are any.  With prefetch, the next books are read ahead in the
+    background.  In parallel, the largest books are started first, by their
+    sizes in the manifest (by default the corpus file list).
+    Returns ({filename: value} for the books which succeeded, number of books
+    which failed).
+    """
+    failed = 0
+    values = {}
+    timings = batch.Timings(jobs)
+    sizes = sharding.manifest_sizes(manifest) if jobs > 1 else None
+    results = batch.run(func, filenames, jobs, sizes, prefetch=prefetching.BOOK_DEPTH if prefetch else 0)
+    if log: 
+        results = journaled(results, log, state)
+    if report: 
+        results = reported(results, report)
+    for result in results:
+        timings.add(result)
+        if summary: 
+            summary.add(result)
+        if result.ok:
+            logging.info('Finished %s', result)
+            values[result.filename] = result.value
+        else:
+            failed += 1
+            logging.error('Failed %s', result)
+            logging.debug(result.trace)
+    if summary: 
+        summary.finish()
+    if filenames: 
+        logging.info(timings.report())
+    return (values, failed)
+
+def sharded(command):
+    """ Adds the options for running a command over one shard of the books. """
+    command = click.option('--shard', default=None, metavar='K/N',
+                           help='Only do shard K of N (from 0), by a hash of the book ID.')(command)
+    command = click.option('--manifest', default=None, type=click.Path(exists=True),
+                           help='With --shard, split the books by the zip sizes in this file list '
+                                '(e.g. metadata/file-list.txt) so each shard has about as much work. '
+                                'Parallel runs start the largest books first, by this list or by default '
+                                'metadata/file-list.txt.')(command)
+    command = click.option('--summary', 'summaryPath', default=None,
+                           help='Write a JSON summary of the run, for merge-summaries.')(command)
+    return command
+
+def prefetched(command):
+    """ Adds the option for reading ahead of the conversion. """
+    return click.option('--prefetch', default=prefetching.PAGE_DEPTH, metavar='PAGES',
+                        help='Read and decompress this many pages (and the next books) ahead of the '
+                             'conversion, in the background. 0 turns it off.')(command)
+
+def measured(command):
+    """ Adds the options for exporting the metrics of each book. """
+    command = click.option('--metrics', 'metricsPath', default=None,
+                           help='Append the stage timings and counters of each book to this JSON lines file.')(command)
+    command = click.option('--prometheus', 'prometheusPath', default=None,
+                           help='Write the totals to this file in the Prometheus text format.')(command)
+    return command
+
+def finish_report(report):
+    """ Logs the table of where the time went, and writes out the metrics. """
+    logging.info('Time by stage:\n%s', report.table())
+    report.close()
+
+def select_shard(filenames, shard, manifest):
+    """ The filenames in the shard, if there is one, and a Summary to record them in. """
+    if not shard: 
+        return (filenames, sharding.Summary())
+    (k, n) = sharding.parse_shard(shard)
+    selected = sharding.select(filenames, k, n, manifest)
+    logging.info('Shard %s has %d of %d books.', shard, len(selected), len(filenames))
+    return (selected, sharding.Summary(['%d/%d' % (k, n)]))
+
+def save_summary(summary, path):
+    if path: 
+        summary.save(path)
+        logging.info('Wrote summary to %s', path)
+
+def check_failures(failed, total, doing=''):
+    if failed:
+        raise click.ClickException('%d of %d books failed%s.' % (failed, total, doing))
+
+def open_journal(path, resume, command):
+    """ The journal to keep, if one was asked for. """
+    if path or resume: 
+        return journal.Journal(path or journal.DEFAULT_PATH, command)
+    return None
+
 @cli.command()
 @click.argument('filenames', nargs=-1) 
-def convert(filenames): 
+@click.option('--jobs', '-j', default=1, help='Number of books to convert in parallel.')
+@click.option('--no-cache', 'nocache', is_flag=True, help="Don't use or update the conversion cache.")
+@click.option('--journal', 'journalPath', default=None, help='Record the progress of each book in this journal.')
+@click.option('--resume', is_flag=True, help='Skip the books the journal has as done, retrying failed ones.')
+@sharded
+@prefetched
+@measured
+def convert(filenames, jobs=1, nocache=False, journalPath=None, resume=False, shard=None, manifest=None,
+            summaryPath=None, prefetch=prefetching.PAGE_DEPTH, metricsPath=None, prometheusPath=None): 
     """Just converts the books to markdown, without creating a git repository for it."""
 
     logging.info('About to convert files: %s', filenames) 
-    for filename in filenames: 
-        logging.info('Converting book: %s', filename) 
-        book = BLText(filename)  
-        with open(book.book_id + '.md','w') as f:
-            f.write(book.text + '\n')
+    (filenames, summary) = select_shard(filenames, shard, manifest)
+    log = open_journal(journalPath, resume, 'convert')
+    if resume: 
+        filenames = log.pending(filenames, [journal.CONVERTED])
+    report = metrics.Report(metricsPath, prometheusPath)
+    (values, failed) = run_batch(partial(convert_book, useCache=not nocache, prefetch=prefetch), filenames, jobs,
+                                 log, journal.CONVERTED, summary, prefetch, report, manifest)
+    save_summary(summary, summaryPath)
+    finish_report(report)
+    check_failures(failed, len(filenames))
 
 @cli.command() 
 @click.argument('filenames', nargs=-1) 
 @click.option('--nojekyll', is_flag=True, help="Don't make a Jekyll site out of the repo." ) 
 @click.option('--push', is_flag=True, help="Push the resulting repo to GitHub." ) 
-def process(filenames, nojekyll=False, push=False): 
+@click.option('--jobs', '-j', default=1, help='Number of books to process in parallel.')
+@click.option('--no-cache', 'nocache', is_flag=True, help="Don't use or update the conversion cache.")
+@click.option('--git-backend', 'backend', type=click.Choice(['fastimport', 'sh']), default='fastimport',
+              help='Write repos with one git fast-import per book, or with a git command per step.')
+@click.option('--bulk', 'staging', default=None, metavar='STAGING',
+              help='Add the books as branches of the staging repo STAGING, instead of a repo each.')
+@click.option('--journal', 'journalPath', default=None, help='Record the progress of each book in this journal.')
+@click.option('--resume', is_flag=True, help='Skip the books the journal has as done, retrying failed ones.')
+@sharded
+@prefetched
+@measured
+def process(filenames, nojekyll=False, push=False, jobs=1, nocache=False, backend='fastimport', staging=None,
+            journalPath=None, resume=False, shard=None, manifest=None, summaryPath=None,
+            prefetch=prefetching.PAGE_DEPTH, metricsPath=None, prometheusPath=None): 
     """Creates a local git repository for the book. Doesn't push."""
     
     logging.info('Processing files: %s', filenames) 
@@ -47,30 +281,169 @@ def process(filenames, nojekyll=False, push=False):
     else: 
         logging.info('Creating jekyll sites for them, too.')
         jekyll = True
+    (filenames, summary) = select_shard(filenames, shard, manifest)
+    report = metrics.Report(metricsPath, prometheusPath)
 
-    for filename in filenames: 
-        logging.info('Processing book: %s', filename) 
-        book = BLText(filename)  
-        logging.info('Making local repo: %s %s' % (book.book_id, book.title))
-        repo = local.LocalRepo(book)
-        if jekyll: 
-            repo.jekyllify()
+    if staging: 
+        if push: 
+            raise click.UsageError("Can't push from a --bulk staging repo.")
+        staging = bulk.staging_repo(staging)
+        log = open_journal(journalPath, resume, 'process --bulk ' + staging)
+        if resume: 
+            filenames = log.pending(filenames, [journal.COMMITTED])
+        try: 
+            # A journaled book has to be on disk before it's recorded as committed
+            (values, failed) = run_batch(partial(stage_book, staging=staging, jekyll=jekyll, useCache=not nocache,
+                                                 prefetch=prefetch, durable=log is not None),
+                                         filenames, jobs, log, journal.COMMITTED, summary, prefetch, report, manifest)
+        finally: 
+            bulk.close_importers()
+        save_summary(summary, summaryPath)
+        finish_report(report)
+        check_failures(failed, len(filenames))
+        return
 
+    log = open_journal(journalPath, resume, 'process')
+    directories = {}
+    todo = filenames
+    if resume: 
         if push: 
-            gh = github.GithubRepo(book, repo.directory) 
-            logging.info('Checking whether %s exists.' % repo.basename)
-            if gh.repo_exists(repo.basename): 
-                raise Exception('The repository %s already exists!' % repo.basename)
-            gh.create_and_push()
+            # Repos which were made but not pushed, or whose push failed, only need pushing
+            directories = {f: d for (f, d) in log.values(filenames, [journal.COMMITTED, journal.PUSH_FAILED]).items()
+                           if d and os.path.isdir(d)}
+            todo = [f for f in log.pending(filenames, [journal.PUSHED]) if f not in directories]
+        else: 
+            todo = log.pending(filenames, [journal.COMMITTED, journal.PUSHED, journal.PUSH_FAILED])
+    (values, failed) = run_batch(partial(process_book, jekyll=jekyll, useCache=not nocache, backend=backend,
+                                         prefetch=prefetch),
+                                 todo, jobs, log, journal.COMMITTED, summary, prefetch, report, manifest)
+    save_summary(summary, summaryPath)
+    directories.update(values)
+    try: 
+        if push and directories: 
+            publish_repos(directories, jobs, log, report)
+    finally: 
+        finish_report(report)
+    check_failures(failed, len(todo))
+
+@cli.command() 
+@click.argument('filenames', nargs=-1) 
+@click.option('--staging', required=True, help='The bulk staging repo holding the books.')
+@click.option('--nojekyll', is_flag=True, help="Don't make a Jekyll site out of the repo." ) 
+@click.option('--push', is_flag=True, help="Push the changed books to their GitHub repos." ) 
+@click.option('--jobs', '-j', default=1, help='Number of books to process in parallel.')
+@click.option('--no-cache', 'nocache', is_flag=True, help="Don't use or update the conversion cache.")
+@sharded
+@prefetched
+@measured
+def update(filenames, staging, nojekyll=False, push=False, jobs=1, nocache=False, shard=None, manifest=None,
+           summaryPath=None, prefetch=prefetching.PAGE_DEPTH, metricsPath=None, prometheusPath=None): 
+    """Re-renders books, committing and pushing only the ones which have changed."""
+    (filenames, summary) = select_shard(filenames, shard, manifest)
+    staging = bulk.staging_repo(staging)
+    remote = github.REMOTE if push else None
+    report = metrics.Report(metricsPath, prometheusPath)
+    try: 
+        (results, failed) = run_batch(partial(update_book, staging=staging, jekyll=not nojekyll,
+                                              useCache=not nocache, remote=remote, prefetch=prefetch),
+                                      filenames, jobs, summary=summary, prefetch=prefetch, report=report,
+                                      manifest=manifest)
+    finally: 
+        bulk.close_importers()
+    save_summary(summary, summaryPath)
+    try: 
+        # The books which failed don't stop the others being pushed
+        changed = {vol_id: branches for (vol_id, branches) in results.values() if branches}
+        logging.info('%d of %d books changed.', len(changed), len(results))
+        pushFailed = 0
+        if push and changed: 
+            books = {vol_id: f for (f, (vol_id, branches)) in results.items()}  # @UnusedVariable
+            pushed = reported(gitlit.publish.push_staged(staging, changed, remote, jobs), report, books)
+            pushFailed = log_published(pushed)
+        check_failures(failed, len(filenames))
+        check_failures(pushFailed, len(changed), ' to push')
+    finally: 
+        finish_report(report)
+
+@cli.command() 
+@click.argument('vol_ids', nargs=-1) 
+@click.option('--staging', required=True, help='The bulk staging repo holding the books.')
+@click.option('--push', is_flag=True, help="Publish the books' repos to GitHub." ) 
+@click.option('--jobs', '-j', default=4, help='Number of repos to push at once.')
+def split(vol_ids, staging, push=False, jobs=4): 
+    """Copies books (by default all of them) out of a bulk staging repo into a repo each."""
+    staging = bulk.staging_repo(staging)
+    vol_ids = vol_ids or bulk.staged_books(staging)
+    (directories, failed) = run_batch(partial(split_book, staging=staging), vol_ids, 1)
+    for (vol_id, directory) in sorted(directories.items()): 
+        print('%s\t%s' % (vol_id, directory))
+    if push and directories: 
+        publish_repos({d: d for d in directories.values()}, jobs)
+    check_failures(failed, len(vol_ids))
+
+@cli.command() 
+@click.argument('directories', nargs=-1) 
+@click.option('--jobs', '-j', default=4, help='Number of repos to push at once.')
+def publish(directories, jobs=4): 
+    """Creates GitHub repos for local book repos made by process, and pushes them."""
+    publish_repos({d: d for d in directories}, jobs)
             
+@cli.command('bench') 
+@click.argument('filenames', nargs=-1) 
+@click.option('--only', multiple=True, type=click.Choice(sorted(bench.BENCHMARKS)),
+              help='Run just this benchmark (can be repeated).')
+@click.option('--repeat', default=bench.REPEAT, help='Times to run each benchmark, keeping the best.')
+@click.option('--json', 'jsonPath', default=None, help='Write the results to this JSON file.')
+@click.option('--baseline', default=None, type=click.Path(exists=True),
+              help='Compare with the results in this JSON file, failing if any have regressed.')
+@click.option('--tolerance', default=bench.TOLERANCE, help='Fraction slower than the baseline that counts as a regression.')
+def benchmark(filenames, only=(), repeat=bench.REPEAT, jsonPath=None, baseline=None, tolerance=bench.TOLERANCE): 
+    """Times the conversion hot paths on the books (by default data/*_dat.zip)."""
+    filenames = filenames or bench.default_files()
+    if not filenames: 
+        raise click.UsageError('No books to benchmark.')
+    results = bench.run(filenames, only, repeat)
+    baseline = bench.load(baseline) if baseline else None
+    print(bench.report(results, baseline))
+    if jsonPath: 
+        bench.save(results, jsonPath)
+    if baseline: 
+        regressions = bench.compare(results, baseline, tolerance)
+        for r in regressions: 
+            print('REGRESSION ' + r)
+        if regressions: 
+            raise click.ClickException('%d benchmarks regressed.' % len(regressions))
+
+@cli.command('merge-summaries') 
+@click.argument('summaries', nargs=-1, type=click.Path(exists=True)) 
+@click.option('--out', default=None, help='Write the merged summary to this file.')
+def merge_summaries(summaries, out=None): 
+    """Merges the --summary files of the shards of a run."""
+    merged = sharding.Summary.merge(sharding.Summary.load(s) for s in summaries)
+    print(merged)
+    save_summary(merged, out)
+
+@cli.command() 
+@click.argument('paths', nargs=-1) 
+@click.option('--db', default=gitlit.index.DEFAULT_PATH, help='Index database file.')
+@click.option('--jobs', '-j', default=1, help='Number of zips to read in parallel.')
+def index(paths, db, jobs=1): 
+    """Adds new or changed book zips in the directories to the corpus index."""
+    corpus = gitlit.index.CorpusIndex(db)
+    changed = corpus.refresh(paths, jobs)
+    print('Indexed %d new or changed volumes, %d in total.' % (changed, len(corpus)))
+
 @cli.command() 
 @click.argument('repos', nargs=-1) 
 def delete(repos): 
     """ Deletes repos from GitHub. """
     click.confirm('Are you really sure you want to delete this/these repo(s)?', abort=True)
     gh = github.GitHub()
-    for repo in repos: 
-        gh.delete(repo)
+    try:
+        for repo in repos: 
+            gh.delete(repo)
+    finally:
+        gh.repos.flush()
 
 @cli.command() 
 def list(): 
@@ -0,0 +1,226 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Per-book timings and counters, to find where a batch spends its time.
+
+batch.call() starts a record for each book in the thread that runs it, and
+the code it calls marks its stages with `with stage('parse'):` and counts
+things with count('pages', n).  Time in a stage nested in another (parsing
+while the text is written, say) only counts towards the inner one, so the
+stages of a book add up to its total, less what wasn't in any stage.  With
+no record started, as when the library is used on its own, both do nothing.
+
+A Report collects the records of a run, writes them as JSON lines and as a
+Prometheus text file, and sums them up in a table.
+"""
+
+from collections import Counter
+import functools
+import json
+import os
+import threading
+import time
+
+# In the order they happen, for the report
+STAGES = ['read', 'parse', 'language', 'render', 'write', 'git', 'api', 'push']
+
+local = threading.local()
+
+
+class BookMetrics():
+    """ The stage timings and counters of one book. """
+    def __init__(self, filename):
+        self.filename = filename
+        self.stages = Counter()
+        self.counters = Counter()
+        # [stage, when it was entered or last resumed]
+        self.stack = []
+        self.started = time.perf_counter()
+        self.seconds = None
+
+    def begin(self, name):
+        now = time.perf_counter()
+        if self.stack:
+            # Pause the enclosing stage
+            (outer, since) = self.stack[-1]
+            self.stages[outer] += now - since
+        self.stack.append([name, now])
+
+    def end(self):
+        now = time.perf_counter()
+        (name, since) = self.stack.pop()
+        self.stages[name] += now - since
+        if self.stack:
+            self.stack[-1][1] = now
+
+    def count(self, name, n=1):
+        self.counters[name] += n
+
+    def finish(self):
+        self.seconds = time.perf_counter() - self.started
+        return self
+
+    def toJSON(self):
+        return {'book': self.filename,
+                'seconds': round(self.seconds, 6),
+                'stages': {name: round(seconds, 6) for (name, seconds) in self.stages.items()},
+                'counters': dict(self.counters)}
+
+
+class Stage():
+    """ Times its with block as a stage of the current book. """
+    __slots__ = ['name', 'book']
+
+    def __init__(self, name):
+        self.name = name
+        self.book = None
+
+    def __enter__(self):
+        self.book = getattr(local, 'book', None)
+        if self.book is not None:
+            self.book.begin(self.name)
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        if self.book is not None:
+            self.book.end()
+
+
+def start(filename):
+    """ Start recording a book in this thread. """
+    local.book = BookMetrics(filename)
+    return local.book
+
+def stop():
+    """ Finish recording this thread's book. Returns its record as JSON, or None if there wasn't one. """
+    book = getattr(local, 'book', None)
+    local.book = None
+    if book is None:
+        return None
+    return book.finish().toJSON()
+
+def stage(name):
+    return Stage(name)
+
+def count(name, n=1):
+    book = getattr(local, 'book', None)
+    if book is not None:
+        book.count(name, n)
+
+def staged(name):
+    """ A decorator which times each call of a function as the stage name. """
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with Stage(name):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+def timed(items, name):
+    """ Generate the items, timing the wait for each as the stage name. """
+    items = iter(items)
+    while True:
+        with Stage(name):
+            try:
+                item = next(items)
+            except StopIteration:
+                return
+        yield item
+
+
+class Report():
+    """
+    The metrics of a run: each book's record is appended to a JSON lines
+    file as it's added, and the totals can be written as a Prometheus text
+    file (e.g. for node_exporter's textfile collector) and summed up in a
+    table.
+    """
+    def __init__(self, jsonPath=None, prometheusPath=None):
+        self.jsonPath = jsonPath
+        self.prometheusPath = prometheusPath
+        self.names = set()
+        self.seconds = 0.0
+        self.stages = Counter()
+        self.counters = Counter()
+        self.slowest = {}
+        self.out = open(jsonPath, 'a') if jsonPath else None
+
+    def add(self, result, book=None):
+        """
+        Add the metrics of a batch.BookResult, if it has any.  book is the
+        book's filename if the result is named after something else, like
+        its repo, so that later stages of a book count towards the same book.
+        """
+        record = getattr(result, 'metrics', None)
+        if not record:
+            return
+        if book:
+            record = dict(record, book=book)
+        self.names.add(record['book'])
+        self.seconds += record['seconds']
+        self.stages.update(record['stages'])
+        self.counters.update(record['counters'])
+        for (name, seconds) in record['stages'].items():
+            if seconds > self.slowest.get(name, (0, None))[0]:
+                self.slowest[name] = (seconds, record['book'])
+        if self.out:
+            record = dict(record, ok=result.ok)
+            self.out.write(json.dumps(record, sort_keys=True) + '\n')
+            self.out.flush()
+
+    @property
+    def books(self):
+        return len(self.names)
+
+    def stageNames(self):
+        return [s for s in STAGES if s in self.stages] + sorted(s for s in self.stages if s not in STAGES)
+
+    def table(self):
+        """ The time in each stage and the counters, as lines of text. """
+        if not self.books:
+            return 'No metrics recorded.'
+        lines = ['%-12s %10s %7s %10s %10s  %s' % ('stage', 'seconds', 'share', 'per book', 'max', 'slowest book')]
+        other = self.seconds - sum(self.stages.values())
+        for name in self.stageNames():
+            seconds = self.stages[name]
+            (most, book) = self.slowest.get(name, (0, ''))
+            lines.append('%-12s %10.2f %6.1f%% %10.3f %10.3f  %s' % (
+                name, seconds, 100.0 * seconds / self.seconds if self.seconds else 0, seconds / self.books, most,
+                os.path.basename(book or '')))
+        lines.append('%-12s %10.2f %6.1f%% %10.3f' % ('other', other, 100.0 * other / self.seconds if self.seconds else 0,
+                                                      other / self.books))
+        lines.append('%-12s %10.2f %7s %10.3f' % ('total', self.seconds, '', self.seconds / self.books))
+        lines.append('%d books: %s' % (self.books, ', '.join('%s %d' % (name, n) for (name, n) in sorted(self.counters.items()))))
+        return '\n'.join(lines)
+
+    def prometheus(self):
+        """ The totals in the Prometheus text format. """
+        lines = ['# HELP gitlit_books_total Books processed.',
+                 '# TYPE gitlit_books_total counter',
+                 'gitlit_books_total %d' % self.books,
+                 '# HELP gitlit_book_seconds_total Seconds spent on books.',
+                 '# TYPE gitlit_book_seconds_total counter',
+                 'gitlit_book_seconds_total %f' % self.seconds,
+                 '# HELP gitlit_stage_seconds_total Seconds spent in each stage of processing books.',
+                 '# TYPE gitlit_stage_seconds_total counter']
+        for name in self.stageNames():
+            lines.append('gitlit_stage_seconds_total{stage="%s"} %f' % (name, self.stages[name]))
+        for (name, n) in sorted(self.counters.items()):
+            lines.append('# TYPE gitlit_%s_total counter' % name)
+            lines.append('gitlit_%s_total %d' % (name, n))
+        return '\n'.join(lines) + '\n'
+
+    def save(self):
+        """ Write the Prometheus file, if there is one, replacing it in one go for scrapers. """
+        if self.prometheusPath:
+            temp = self.prometheusPath + '.tmp'
+            with open(temp, 'w') as f:
+                f.write(self.prometheus())
+            os.replace(temp, self.prometheusPath)
+
+    def close(self):
+        self.save()
+        if self.out:
+            self.out.close()
+            self.out = None
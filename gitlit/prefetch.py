@@ -0,0 +1,99 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Overlaps reading books with converting them.
+
+prefetch() reads and decompresses the next few pages of a book in a
+background thread while the current page is parsed, and warm_ahead() reads
+the next few books of a batch into the page cache while the current one is
+converted.  zlib and file reads release the GIL, so the reading goes on
+while the parser runs, and on network storage most of the read latency is
+hidden.
+"""
+
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+import logging
+import threading
+
+# Pages read ahead of the parser, which bounds the decompressed pages held in memory
+PAGE_DEPTH = 8
+# Books of a batch read ahead of the one being converted
+BOOK_DEPTH = 2
+BLOCK_SIZE = 1024 * 1024
+
+
+def prefetch(items, load, depth=PAGE_DEPTH):
+    """
+    Generate (item, load(item)) for each of items, with up to depth items
+    loaded ahead in a background thread.  An exception from load is raised
+    when its item is reached.  With depth 0 each item is loaded when it's
+    reached, without a thread.
+    """
+    if depth <= 0:
+        for item in items:
+            yield (item, load(item))
+        return
+    items = iter(items)
+    pool = ThreadPoolExecutor(max_workers=1)
+    queued = deque()
+    try:
+        for item in items:
+            queued.append((item, pool.submit(load, item)))
+            if len(queued) > depth:
+                (item, future) = queued.popleft()
+                yield (item, future.result())
+        while queued:
+            (item, future) = queued.popleft()
+            yield (item, future.result())
+    finally:
+        # Also when the consumer stops early: nothing may still be reading once we return
+        pool.shutdown(wait=True, cancel_futures=True)
+
+def warm(filename, stop=None):
+    """
+    Read a file through, so that it's in the page cache when it's needed.
+    Gives up part way once the event stop is set.
+    """
+    buf = bytearray(BLOCK_SIZE)
+    try:
+        with open(filename, 'rb', buffering=0) as f:
+            while not (stop and stop.is_set()) and f.readinto(buf):
+                pass
+    except OSError as e:
+        # The book will fail properly when it's converted
+        logging.debug('Could not prefetch %s: %s', filename, e)
+
+def warm_ahead(filenames, depth=BOOK_DEPTH):
+    """
+    Generate the filenames, reading the next depth of them in a background
+    thread.  Unlike prefetch() this never waits for the reading: once a
+    filename has been generated the consumer reads the file itself, so a
+    warm of it which hasn't started is cancelled and one which has is
+    stopped.
+    """
+    if depth <= 0:
+        yield from filenames
+        return
+    filenames = iter(filenames)
+    pool = ThreadPoolExecutor(max_workers=1)
+    ahead = deque()
+    try:
+        while True:
+            while len(ahead) <= depth:
+                try:
+                    filename = next(filenames)
+                except StopIteration:
+                    break
+                stop = threading.Event()
+                ahead.append((filename, pool.submit(warm, filename, stop), stop))
+            if not ahead:
+                break
+            (filename, future, stop) = ahead.popleft()
+            future.cancel()
+            stop.set()
+            yield filename
+    finally:
+        for (filename, future, stop) in ahead:
+            stop.set()
+        pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,243 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Publishes many local book repos to GitHub at once.
+
+One authenticated session is shared by all the books.  Repos are created
+through the API one at a time, paced by the remaining rate limit, while the
+pushes run concurrently in a bounded pool of threads.  A push which fails
+because GitHub hasn't finished creating the repo is retried with
+exponential backoff.
+
+A book whose repo already exists is checked rather than failed, so that a
+run which stopped between creating or pushing a repo and recording it can
+be resumed: if the repo already has the book's branch it counts as
+published, and if it's empty it's pushed.
+"""
+
+from concurrent.futures import ThreadPoolExecutor, as_completed
+import glob
+import logging
+import os
+import threading
+import time
+import traceback
+
+import sh
+
+from gitlit.batch import BookResult
+import gitlit.metrics as metrics
+from gitlit.reader import BLMetadata
+
+BASE_URL = 'https://Git-Lit.github.io/'
+
+# Keep this many API requests in hand before waiting for the rate limit reset
+MIN_REMAINING = 50
+# Seconds between repo creations, which GitHub asks of content-creating requests
+MIN_INTERVAL = 1.0
+PUSH_RETRIES = 5
+# Seconds before the first retry of a push, doubled for each retry after that
+BACKOFF = 2.0
+
+
+def push_with_retry(args, retries=PUSH_RETRIES, backoff=BACKOFF):
+    """ Run a git push, retrying with exponential backoff while it fails with code 128. """
+    for attempt in range(retries + 1):
+        metrics.count('subprocesses')
+        try:
+            sh.git(*args)
+            return
+        except sh.ErrorReturnCode_128:
+            if attempt == retries:
+                raise
+            delay = backoff * 2 ** attempt
+            logging.info('git %s failed (repo not ready yet?), retrying in %.1f seconds.', ' '.join(args), delay)
+            time.sleep(delay)
+
+def push_staged(staging, changed, remote, jobs=4, retries=PUSH_RETRIES, backoff=BACKOFF):
+    """
+    Push books' branches from a bulk staging repo to their existing repos,
+    several at once.  changed is {vol_id: [staged branch names]} and remote
+    the URL with %s for the vol_id.  Generates a BookResult for each book,
+    in completion order.
+    """
+    def pushOne(vol_id, branches):
+        refspecs = ['refs/heads/%s:refs/heads/%s' % (b, b.split('/', 1)[1]) for b in branches]
+        metrics.start(vol_id)
+        try:
+            with metrics.stage('push'):
+                push_with_retry(['--git-dir', staging, 'push', remote % vol_id] + refspecs, retries, backoff)
+            result = BookResult(vol_id, remote % vol_id)
+        except Exception as e:
+            result = BookResult(vol_id, error='%s: %s' % (type(e).__name__, e), trace=traceback.format_exc())
+        result.metrics = metrics.stop()
+        return result
+
+    with ThreadPoolExecutor(max_workers=jobs) as pool:
+        futures = [pool.submit(pushOne, vol_id, branches) for (vol_id, branches) in sorted(changed.items())]
+        for future in as_completed(futures):
+            yield future.result()
+
+
+class PublishJob():
+    """ A local repo to publish as a GitHub repo called name. """
+    def __init__(self, name, description, homepage, directory, branch='gh-pages'):
+        self.name = name
+        self.description = description
+        self.homepage = homepage
+        self.directory = directory
+        self.branch = branch
+
+    @classmethod
+    def fromBook(cls, book, directory):
+        return cls(book.vol_id,
+                   '{0} by {1} is a British Library book, now on GitHub.'.format(book.title, book.author),
+                   BASE_URL + book.vol_id, directory)
+
+    @classmethod
+    def fromDirectory(cls, directory):
+        """ A job for a repo made by LocalRepo, described from the book zip in it. """
+        zips = glob.glob(os.path.join(directory, '*_dat.zip'))
+        if not zips:
+            raise IOError('No book zip file in %s' % directory)
+        return cls.fromBook(BLMetadata(zips[0]), directory)
+
+
+class Publisher():
+    def __init__(self, org=None, github=None, jobs=4, minRemaining=MIN_REMAINING, minInterval=MIN_INTERVAL,
+                 retries=PUSH_RETRIES, backoff=BACKOFF, repos=None, remote=None):
+        """
+        Publishes to org, a github3 organization.  By default this logs in
+        once (with the credentials from secrets.py) and uses the Git-Lit org.
+        remote is the URL of a repo in the org, with %s for its name.
+        """
+        from gitlit.github import GitHub, RepoIndex, REMOTE
+        if org is None:
+            session = GitHub()
+            (org, github, repos) = (session.org, session.github, session.repos)
+        self.org = org
+        self.github = github
+        self.repos = repos if repos is not None else RepoIndex(org)
+        self.remote = remote or REMOTE
+        self.jobs = jobs
+        self.minRemaining = minRemaining
+        self.minInterval = minInterval
+        self.retries = retries
+        self.backoff = backoff
+        self.apiLock = threading.Lock()
+        self.lastRequest = 0
+
+    def waitForApi(self):
+        """ Wait until we can make another API request without running into the rate limit. """
+        delay = self.lastRequest + self.minInterval - time.time()
+        if delay > 0:
+            time.sleep(delay)
+        (remaining, reset) = self.rateLimit()
+        if remaining < self.minRemaining:
+            logging.warning('Only %d GitHub API requests left, waiting %d seconds for the reset.',
+                            remaining, reset - time.time())
+            time.sleep(max(reset - time.time(), 0) + 1)
+        self.lastRequest = time.time()
+
+    def rateLimit(self):
+        """ (requests remaining, when the rate limit resets as a Unix time). """
+        if self.github is not None:
+            # One request for both, from the session's own API URL
+            core = self.github.rate_limit()['resources']['core']
+            return (core['remaining'], core['reset'])
+        return (self.org.ratelimit_remaining, time.time() + 60)
+
+    def existing(self):
+        """ The names of the book repos already in the org. """
+        with self.apiLock:
+            if not self.repos.fresh:
+                self.waitForApi()
+                self.repos.refresh()
+            return set(self.repos.names)
+
+    @metrics.staged('api')
+    def createRepo(self, job):
+        with self.apiLock:
+            self.waitForApi()
+            metrics.count('api_calls')
+            repo = self.org.create_repo(
+                job.name,
+                description=job.description,
+                homepage=job.homepage,
+                private=False,
+                has_issues=True,
+                has_wiki=False,
+            )
+            self.repos.add(repo.name)
+            return repo
+
+    @metrics.staged('push')
+    def push(self, directory, url, branch):
+        metrics.count('subprocesses')
+        try:
+            sh.git('-C', directory, 'remote', 'add', 'origin', url)
+        except sh.ErrorReturnCode_3:
+            # Already has an origin, e.g. from a previous attempt
+            metrics.count('subprocesses')
+            sh.git('-C', directory, 'remote', 'set-url', 'origin', url)
+        push_with_retry(['-C', directory, 'push', 'origin', branch], self.retries, self.backoff)
+
+    @metrics.staged('push')
+    def remoteHeads(self, url):
+        """ The branches of a remote repo, as {ref name: commit}. """
+        metrics.count('subprocesses')
+        out = sh.git('ls-remote', '--heads', url)
+        return dict(reversed(line.split('\t')) for line in str(out).splitlines())
+
+    def publishExisting(self, job):
+        """ Check a job whose repo exists, pushing to it if it's empty. """
+        metrics.start(job.directory)
+        url = self.remote % job.name
+        try:
+            metrics.count('subprocesses')
+            local = str(sh.git('-C', job.directory, 'rev-parse', job.branch)).strip()
+            heads = self.remoteHeads(url)
+            if heads.get('refs/heads/' + job.branch) == local:
+                logging.info('%s was already published.', job.name)
+                result = BookResult(job.directory, url)
+            elif not heads:
+                # Created by a run which stopped before it was pushed
+                self.push(job.directory, url, job.branch)
+                result = BookResult(job.directory, url)
+            else:
+                result = BookResult(job.directory, error='The repository %s already exists!' % job.name)
+        except Exception as e:
+            result = BookResult(job.directory, error='%s: %s' % (type(e).__name__, e), trace=traceback.format_exc())
+        result.metrics = metrics.stop()
+        return result
+
+    def publishOne(self, job):
+        metrics.start(job.directory)
+        try:
+            repo = self.createRepo(job)
+            self.push(job.directory, repo.ssh_url, job.branch)
+            result = BookResult(job.directory, repo.ssh_url)
+        except Exception as e:
+            result = BookResult(job.directory, error='%s: %s' % (type(e).__name__, e), trace=traceback.format_exc())
+        result.metrics = metrics.stop()
+        return result
+
+    def publish(self, jobs):
+        """
+        Create and push each job's repo, or check it if it exists, generating a
+        BookResult for each in completion order.
+        """
+        existing = self.existing()
+        try:
+            with ThreadPoolExecutor(max_workers=self.jobs) as pool:
+                futures = []
+                for job in jobs:
+                    if job.name in existing:
+                        futures.append(pool.submit(self.publishExisting, job))
+                    else:
+                        futures.append(pool.submit(self.publishOne, job))
+                for future in as_completed(futures):
+                    yield future.result()
+        finally:
+            with self.apiLock:
+                self.repos.flush()
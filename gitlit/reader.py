@@ -5,32 +5,78 @@ Reader of metadata, and optionally text, for British Library
 public domain corpus.
 """
 
-from gitlit.alto import Alto
-from array import array
-from collections import Counter
+from gitlit.alto import Alto, add_histogram, new_histogram, histogram_arrays
+from collections import Counter, OrderedDict
 import glob
 import lxml.etree
 import os
+import pickle
 import re
 import sys
 import logging
 #from IPython.display import display
 # import pandas as pd
 from unidecode import unidecode
-from zipfile import ZipFile
+from zipfile import ZipFile, ZIP_STORED, ZIP_DEFLATED
+from gitlit.zipmap import MappedZip, LOCAL_HEADER
+from gitlit.prefetch import prefetch, PAGE_DEPTH
+import gitlit.metrics as metrics
+from gitlit.language import LanguageSampler, DETECTOR
 import tempfile
+import zlib
 
 # TODO: Move this to a template file for easy editing
 INTRO = '<!-- This file was created from text provided by the British Library. --> \n\n\n'
 
-class BLText:
-    NAMESPACES = {'MODS': 'http://www.loc.gov/mods/v3',
-                  'METS': 'http://www.loc.gov/METS/',
-                  'xsi': 'http://www.w3.org/2001/XMLSchema-instance',
-                  'xlink': 'http://www.w3.org/1999/xlink'
-                  }
+NAMESPACES = {'MODS': 'http://www.loc.gov/mods/v3',
+              'METS': 'http://www.loc.gov/METS/',
+              'xsi': 'http://www.w3.org/2001/XMLSchema-instance',
+              'xlink': 'http://www.w3.org/1999/xlink'
+              }
 
-    def __init__(self, zipfile, metadataOnly=False): 
+def readFirstMember(zipfile, name):
+    """
+    Read the named member of a zip file if it's the first one stored,
+    straight from its local header without reading the central directory.
+    BL zips always start with the metadata.  Returns None if the member
+    isn't first or can't be read this way.
+    """
+    with open(zipfile, 'rb') as f:
+        header = f.read(LOCAL_HEADER.size)
+        if len(header) < LOCAL_HEADER.size:
+            return None
+        (signature, version, flags, method, modTime, modDate, crc,
+         compressedSize, size, nameLength, extraLength) = LOCAL_HEADER.unpack(header)  # @UnusedVariable
+        # Bit 3 means the sizes follow the data rather than being in the header
+        if signature != b'PK\x03\x04' or flags & 0x08 or method not in (ZIP_STORED, ZIP_DEFLATED):
+            return None
+        if f.read(nameLength) != name.encode('utf-8'):
+            return None
+        f.seek(extraLength, os.SEEK_CUR)
+        data = f.read(compressedSize)
+    if method == ZIP_DEFLATED:
+        data = zlib.decompress(data, -zlib.MAX_WBITS)
+    if len(data) != size or zlib.crc32(data) != crc:
+        return None
+    return data
+
+
+class BLMetadata(object):
+    """
+    The identifiers and catalog metadata for one book zip, without its text.
+
+    This is kept small for indexing the whole corpus.  The metadata XML
+    isn't read until it's first needed and the title, author, etc are
+    only worked out once.
+    """
+    __slots__ = ['zipfile', 'book_id', 'volume', 'vol_id', '_metadata', '_title', '_author', '_githubTitle']
+
+    NAMESPACES = NAMESPACES
+    TITLE = lxml.etree.XPath('//MODS:mods/MODS:titleInfo/MODS:title/text()', namespaces=NAMESPACES)
+    AUTHOR = lxml.etree.XPath('//MODS:name[@type="personal"]/MODS:namePart/text()', namespaces=NAMESPACES)
+
+    def __init__(self, zipfile, title=None, author=None):
+        """ title and author can be given if they're already known, e.g. from an index. """
         # Zipfiles look like:
         # 000000037_0_1-42pgs__944211_dat.zip
         # 000000216_1_1-318pgs__632698_dat.zip
@@ -42,54 +88,39 @@ class BLText:
             self.vol_id = self.book_id + '_%02d' % self.volume
         else: 
             self.vol_id = self.book_id
+        self._metadata = None
+        self._title = title
+        self._author = author
+        self._githubTitle = None
 
-        with ZipFile(zipfile) as zf:
-            # TODO: Check for an warn if there are multiple books in the same zip file
-            # 00000037 is a file that can be used for testing
-            fn = self.book_id + '_metadata.xml'
-            with zf.open(fn) as f:
-                self.metadata = lxml.etree.parse(f)
-
-            self.pages = 0
-            self.words = 0
-            self.avg_word_confidence = 0
-            self.text = INTRO
-            self.cc = array('L',[0]*10)
-            self.wc = array('L',[0]*Alto.WORD_CONFIDENCE_HISTOGRAM)
-            self.styles = Counter()
-    
-            if not metadataOnly:
-                self.loadText(zf)
-
+    @property
+    def metadataName(self):
+        return self.book_id + '_metadata.xml'
 
-    def loadText(self, zf):
-        """  Parse page OCR files and merge individual page stats
-        """
-        confidence = 0
-        continuation = None
-        for name in zf.namelist():
-            if name.startswith('ALTO/0'):
-                with zf.open(name) as f:
-                    a = Alto(f, continuation)
-                    self.pages += 1
-                    if a.word_count:
-                        self.text += a.text
-                        self.words += a.word_count
-                        for i in range(10):
-                            self.cc[i] += a.char_confidence[i]
-                        for i in range(Alto.WORD_CONFIDENCE_HISTOGRAM):
-                            self.wc[i] += a.word_confidence[i]
-                        confidence += a.avg_word_confidence * a.word_count
-                        self.styles.update(a.styles)
-                    continuation = a.continuation
-        if self.words: 
-            self.avg_word_confidence = confidence / self.words
-        else: 
-            self.avg_word_confidence = 0
+    def readMetadata(self, zf=None):
+        """ Parse the metadata XML, from the open ZipFile or MappedZip zf if given. """
+        # TODO: Check for an warn if there are multiple books in the same zip file
+        # 00000037 is a file that can be used for testing
+        if zf is not None:
+            data = zf.read(self.metadataName)
+        else:
+            data = readFirstMember(self.zipfile, self.metadataName)
+        if data is None:
+            with ZipFile(self.zipfile) as zf:
+                data = zf.read(self.metadataName)
+        self._metadata = lxml.etree.ElementTree(lxml.etree.fromstring(data))
 
+    @property
+    def metadata(self):
+        if self._metadata is None:
+            self.readMetadata()
+        return self._metadata
 
     def getText(self, xpath):
-        out = self.metadata.xpath(xpath + '/text()', namespaces=self.NAMESPACES)
+        if isinstance(xpath, lxml.etree.XPath):
+            out = xpath(self.metadata)
+        else:
+            out = self.metadata.xpath(xpath + '/text()', namespaces=self.NAMESPACES)
         if isinstance(out, list): 
             if len(out) == 1: 
                 # No sense having a list of length one. Get just the string. 
@@ -98,9 +129,10 @@ class BLText:
     
     @property
     def title(self):
-        # TODO enable caching of this result
+        if self._title is not None:
+            return self._title
         # Be careful not to pick up related titles, etc.
-        title = self.getText('//MODS:mods/MODS:titleInfo/MODS:title')
+        title = self.getText(self.TITLE)
         logging.info('Title: %s' % title)
         if type(title) == list: 
             # FIXME. We're only taking the first of multiple titles,
@@ -110,6 +142,7 @@ class BLText:
         out = self.removeBracketed(title)
         if self.volume: 
             out += " (Volume %s)" % self.volume
+        self._title = out
         return out
 
     def removeBracketed(self, s):
@@ -117,13 +150,16 @@ class BLText:
 
     @property
     def author(self): 
-        rawAuthor = self.getText('//MODS:name[@type="personal"]/MODS:namePart')
-        # TODO: do some transformations to the text here. Get it in the appropriate case.
-        # Also handle multiple authors better
-        return rawAuthor
+        if self._author is None:
+            # TODO: do some transformations to the text here. Get it in the appropriate case.
+            # Also handle multiple authors better
+            self._author = self.getText(self.AUTHOR)
+        return self._author
 
     @property
     def githubTitle(self):
+        if self._githubTitle is not None:
+            return self._githubTitle
         oldTitle = self.title
         textID = self.book_id
         idLength = len(textID)
@@ -132,15 +168,259 @@ class BLText:
         # Replace non-ASCII characters with their closest
         # ASCII equivalents. See https://pypi.python.org/pypi/Unidecode
         cleanTitle = unidecode(titleNoSpace)
-        newTitle = cleanTitle[:100-idLength]+'-'+textID
-        return newTitle
+        self._githubTitle = cleanTitle[:100-idLength]+'-'+textID
+        return self._githubTitle
 
     def __str__(self): 
         return "title: {}\nauthor: {}\ngithubTitle: {}\n".format(self.title, self.author, self.githubTitle)
 
+    def __getstate__(self):
+        # Parsed XML can't be pickled, so send it as text
+        state = dict((slot, getattr(self, slot)) for slot in BLMetadata.__slots__)
+        if self._metadata is not None:
+            state['_metadata'] = lxml.etree.tostring(self._metadata)
+        return state
+
+    def __setstate__(self, state):
+        for (slot, value) in state.items():
+            setattr(self, slot, value)
+        if self._metadata is not None:
+            self._metadata = lxml.etree.ElementTree(lxml.etree.fromstring(self._metadata))
+
+
+def scanMetadata(files, jobs=1):
+    """
+    Generate a BLMetadata record, with its metadata already parsed, for
+    each of the zip files, in parallel if jobs > 1.  Failures are logged
+    and skipped.
+    """
+    from gitlit import batch
+    for result in batch.run(loadMetadata, files, jobs):
+        if result.ok:
+            yield result.value
+        else:
+            logging.error('Failed to read metadata %s', result)
+
+def loadMetadata(zipfile):
+    record = BLMetadata(zipfile)
+    record.readMetadata()
+    # Work these out in the worker
+    record.title
+    record.author
+    record.githubTitle
+    return record
+
+
+class BLText(BLMetadata):
+    def __init__(self, zipfile, metadataOnly=False, streaming=False, cache=None, prefetch=PAGE_DEPTH,
+                 languagePages=0, keepConfidences=False): 
+        """
+        With metadataOnly the page OCR is never read.  With streaming the
+        text is not loaded up front; use iterText() or writeText() to
+        generate it a page at a time, which also fills in the statistics.
+        If a ConversionCache is given, the text and statistics are taken
+        from it when the book has been converted before.  prefetch is the
+        number of pages to read ahead of the parser, in a background thread
+        (0 for none).  With languagePages, the language of the text is
+        identified from that many pages spread through the book (e.g.
+        gitlit.language.SAMPLE_PAGES), as they're converted, and kept with
+        the statistics.  With keepConfidences the
+        confidence of every word is kept in page_confidences, for QA, which
+        takes memory in proportion to the length of the book.
+        """
+        BLMetadata.__init__(self, zipfile)
+        self.cache = cache
+        self.prefetch = prefetch
+        self.languagePages = languagePages
+        self.keepConfidences = keepConfidences
+
+        # One mapped zip for the metadata and the pages.  When streaming
+        # it's kept until the pages have been read.
+        self.zip = MappedZip(zipfile)
+        self.readMetadata(self.zip)
+        self.resetStats()
+        self.text = INTRO
+
+        if streaming:
+            self.text = None
+        else:
+            if not metadataOnly:
+                self.loadText()
+            self.close()
+
+    def close(self):
+        """ Release the zip file. """
+        if self.zip is not None:
+            self.zip.close()
+            self.zip = None
+
+    def __getstate__(self):
+        # The metadata, with the text and statistics.  The zip is reopened if it's needed.
+        state = BLMetadata.__getstate__(self)
+        state.update(self.__dict__)
+        state['zip'] = None
+        return state
+
+    def resetStats(self):
+        self.pages = 0
+        self.words = 0
+        self.chars = 0
+        self.avg_word_confidence = 0
+        self.cc = new_histogram(10)
+        self.wc = new_histogram(Alto.WORD_CONFIDENCE_HISTOGRAM)
+        self.styles = Counter()
+        self.language = None
+        # Per word confidence arrays for each page, for QA, with keepConfidences
+        self.page_confidences = []
+
+    def loadText(self, zf=None):
+        """  Parse page OCR files and merge individual page stats
+        """
+        self.text = ''.join(self.iterText(zf))
+
+    @property
+    def histograms(self):
+        """ (cc, wc) as NumPy arrays. """
+        return histogram_arrays(self.cc, self.wc)
+
+    def getStats(self):
+        """ The book statistics as a JSON serializable dict. """
+        return {'pages': self.pages,
+                'words': self.words,
+                'chars': self.chars,
+                'avg_word_confidence': self.avg_word_confidence,
+                'cc': [int(c) for c in self.cc],
+                'wc': [int(c) for c in self.wc],
+                'styles': dict(self.styles),
+                'language': self.language,
+                }
+
+    def setStats(self, stats):
+        self.resetStats()
+        self.pages = stats['pages']
+        self.words = stats['words']
+        self.chars = stats['chars']
+        self.avg_word_confidence = stats['avg_word_confidence']
+        add_histogram(self.cc, stats['cc'])
+        add_histogram(self.wc, stats['wc'])
+        self.styles.update(stats['styles'])
+        self.language = stats.get('language')
+
+    def iterText(self, zf=None):
+        """
+        Generate the text of the book one page at a time, merging the
+        individual page stats as we go.  The stats are complete once the
+        generator is exhausted.
+
+        With a cache, a previously converted book is read back from it
+        instead (without per-page confidences) and a new conversion is
+        added to it once it completes.
+        """
+        if self.cache is None:
+            yield from self.iterPages(zf)
+            self.countStats()
+            return
+        # The language is cached with the statistics, so depends on how it's detected
+        settings = 'lang%d-%s' % (self.languagePages, DETECTOR) if self.languagePages else 'lang0'
+        if self.zip is not None:
+            # Hash the zip we've already mapped rather than reading it again
+            key = self.cache.key(self.zipfile, self.zip.sha1().hexdigest(), settings)
+        else:
+            key = self.cache.key(self.zipfile, settings=settings)
+        cached = self.cache.get(key)
+        if cached:
+            self.close()
+            self.setStats(cached.stats)
+            metrics.count('cache_hits')
+            yield from cached.chunks()
+            self.countStats()
+            return
+        writer = self.cache.writer(key)
+        for chunk in self.iterPages(zf):
+            writer.write(chunk)
+            yield chunk
+        writer.commit(self.getStats())
+        self.countStats()
+
+    def countStats(self):
+        metrics.count('pages', self.pages)
+        metrics.count('words', self.words)
+
+    def iterPages(self, zf=None):
+        """
+        Parse and generate the text of each page, without the cache, from zf
+        (a ZipFile or MappedZip) if given.
+        """
+        if zf is None:
+            if self.zip is None:
+                self.zip = MappedZip(self.zipfile)
+            try:
+                yield from self.iterPages(self.zip)
+            finally:
+                self.close()
+            return
+        self.resetStats()
+        self.chars = len(INTRO)
+        yield INTRO
+        confidence = 0
+        continuation = None
+        names = [name for name in zf.namelist() if name.startswith('ALTO/0')]
+        sampler = LanguageSampler(len(names), self.languagePages)
+        # The next pages are decompressed while this one is parsed
+        for (name, data) in metrics.timed(prefetch(names, zf.read, self.prefetch), 'read'):  # @UnusedVariable
+            with metrics.stage('parse'):
+                a = Alto(data, continuation, self.keepConfidences)
+            self.pages += 1
+            if self.keepConfidences:
+                self.page_confidences.extend(a.word_confidences)
+            if a.word_count:
+                sampler.add(self.pages - 1, a.text)
+                self.words += a.word_count
+                add_histogram(self.cc, a.char_confidence)
+                add_histogram(self.wc, a.word_confidence)
+                confidence += a.avg_word_confidence * a.word_count
+                self.styles.update(a.styles)
+                self.chars += len(a.text)
+                yield a.text
+            continuation = a.continuation
+        if self.words: 
+            self.avg_word_confidence = confidence / self.words
+        else: 
+            self.avg_word_confidence = 0
+        if self.languagePages:
+            with metrics.stage('language'):
+                self.language = sampler.detect()
+
+    def writeText(self, f):
+        """
+        Write the text of the book to the open file f.  If the text hasn't
+        been loaded, it's streamed page by page so that only one page is
+        held in memory at a time.
+        """
+        if self.text is None:
+            for chunk in self.iterText():
+                f.write(chunk)
+        else:
+            f.write(self.text)
+
 # A collection of BLText objects. 
 class BLCorpus(): 
-    def __init__(self, corpus, metadataOnly=True):
+    """
+    The books of a directory (searched recursively), a file listing their
+    paths, or a list of paths.
+
+    Books are only read when they're used: iterating over the corpus, or
+    indexing it by position or volume ID, makes each BLText (without its
+    pages with metadataOnly) as it's reached, and it's dropped again
+    afterwards unless cacheSize keeps that many of the most recently used.
+    So a corpus-wide pass only holds one book in memory at a time.
+
+    With lightweight the books are BLMetadata records instead, which only
+    parse the metadata when it's first asked for, but have no statistics
+    or text.
+    """
+    def __init__(self, corpus, metadataOnly=True, cacheSize=0, records=None, lightweight=False):
+        """ records can give the BLMetadata of some of the books, by path, e.g. from an index. """
         self.files = []
         if type(corpus) is str or type(corpus) is str:
             if os.path.isdir(corpus):
@@ -149,6 +429,8 @@ class BLCorpus():
                     for f in files:
                         if f.endswith('_dat.zip'): # *pgs__*_dat.zip
                             self.files.append(os.path.join(path,f))
+                # os.walk's order depends on the filesystem
+                self.files.sort()
             elif os.path.isfile(corpus):
                 self.baseDir = None
                 with open(corpus) as f:
@@ -159,14 +441,101 @@ class BLCorpus():
         else:
             raise Exception('Unknown corpus type')
 
-        self.texts = []
-        self.readDataDir(metadataOnly)
-        #self.makeDataFrame()
+        self.metadataOnly = metadataOnly
+        self.cacheSize = cacheSize
+        self.records = records or {}
+        self.lightweight = lightweight
+        self._texts = None
+        # The most recently used books, last used last
+        self.cache = OrderedDict()
+        # Paths by vol_id, worked out when first needed
+        self._volumes = None
 
-    def readDataDir(self, metadataOnly): 
-        #print 'Loading %d files' % len(files)
-        self.texts = [ BLText(mdf, metadataOnly=metadataOnly) for mdf in self.files ]
-        #print 'Loaded ',self.texts
+    @classmethod
+    def fromIndex(cls, index, metadataOnly=True, **criteria):
+        """
+        A corpus of the volumes in a CorpusIndex which match the criteria,
+        e.g. BLCorpus.fromIndex(index, language='en', volumes=3).  With
+        metadataOnly the books are the index's BLMetadata records.
+        """
+        records = {r.zipfile: r for r in index.records(**criteria)} if metadataOnly else None
+        return cls(index.query(**criteria), metadataOnly=metadataOnly, records=records, lightweight=metadataOnly)
+
+    def load(self, path):
+        """ The book at path, from the cache if it's there. """
+        book = self.cache.get(path)
+        if book is not None:
+            self.cache.move_to_end(path)
+            return book
+        book = self.records.get(path)
+        if book is None:
+            if self.lightweight:
+                # Records which only read their metadata when asked
+                book = BLMetadata(path)
+            else:
+                book = BLText(path, metadataOnly=self.metadataOnly)
+        if self.cacheSize:
+            self.cache[path] = book
+            while len(self.cache) > self.cacheSize:
+                self.cache.popitem(last=False)
+        return book
+
+    def __len__(self):
+        return len(self.files)
+
+    def __iter__(self):
+        for path in self.files:
+            yield self.load(path)
+
+    @property
+    def volumes(self):
+        """ {vol_id: path}, which only needs the file names. """
+        if self._volumes is None:
+            self._volumes = {BLMetadata(path).vol_id: path for path in self.files}
+        return self._volumes
+
+    def __getitem__(self, key):
+        """ A book by its position or vol_id (the book_id of single volume books). """
+        if isinstance(key, str):
+            return self.load(self.volumes[key])
+        return self.load(self.files[key])
+
+    def __contains__(self, vol_id):
+        return vol_id in self.volumes
+
+    def book(self, book_id):
+        """ All the volumes of a book. """
+        return [self.load(path) for (vol_id, path) in sorted(self.volumes.items())
+                if vol_id.split('_')[0] == book_id]
+
+    def filter(self, predicate=None, **criteria):
+        """
+        A corpus of the books for which predicate(book) is true and whose
+        attributes have the values of the criteria, e.g.
+        corpus.filter(book_id='000000216') or
+        corpus.filter(lambda b: 'Manchester' in b.title).  Criteria which
+        are in the file name don't read the book.
+        """
+        files = []
+        for path in self.files:
+            names = BLMetadata(path)
+            if any(getattr(names, k) != v for (k, v) in criteria.items() if k in ('book_id', 'volume', 'vol_id')):
+                continue
+            if predicate or any(k not in ('book_id', 'volume', 'vol_id') for k in criteria):
+                book = self.load(path)
+                if any(getattr(book, k) != v for (k, v) in criteria.items()):
+                    continue
+                if predicate and not predicate(book):
+                    continue
+            files.append(path)
+        return BLCorpus(files, self.metadataOnly, self.cacheSize, self.records, self.lightweight)
+
+    @property
+    def texts(self):
+        """ All the books as a list, made on first use and kept, so they're all held in memory at once. """
+        if self._texts is None:
+            self._texts = list(self)
+        return self._texts
 
 #     def makeDataFrame(self): 
 #        metadata = [ [ text.book_id, text.pages, text.title, text.author, text.githubTitle] for text in self.texts ] 
@@ -181,7 +550,7 @@ def test():
     c = BLCorpus('data')
     #c.df
     assert len(c.texts) == 10
-    # assert len(c) == 10 # do we want to implement this?
+    assert len(c) == 10
     assert c.texts[0].book_id == '000000037'
     #print('Loaded %d texts. First is %s' % (len(c.texts), str(c.texts[0])))
 
@@ -192,11 +561,15 @@ def test():
                   ))
     assert len(c2.texts) == 3
     assert c2.texts[-1].book_id == '000000206'
+    assert c2.texts is c2.texts and isinstance(c2.texts[0], BLText)
+    assert c2.texts[0].pages == 0 and c2.texts[0].title == BLMetadata(c2.files[0]).title
+    light = BLCorpus(c2.files, lightweight=True)
+    assert type(light[0]) is BLMetadata and light[0].title == c2.texts[0].title
     #print('Loaded %d texts. Last is %s' % (len(c2.texts), str(c2.texts[-1])))
 
     print('Testing file with list of filenames constructor')
-    files = glob.glob('data/*pgs__*_dat.zip')
-    with tempfile.NamedTemporaryFile() as tf:
+    files = sorted(glob.glob('data/*pgs__*_dat.zip'))
+    with tempfile.NamedTemporaryFile('w') as tf:
         tf.write('\n'.join(files))
         tf.flush()
         c3 = BLCorpus(tf.name)
@@ -204,6 +577,23 @@ def test():
         assert c3.texts[1].book_id == '000000196'
         #print('Loaded %d texts with the middle one being %s' % (len(c3.texts), c3.texts[1]))
 
+    print('Testing lookup, filtering and the cache')
+    assert c['000000216_02'].volume == 2 and c['000000428'].book_id == '000000428'
+    assert '000000216_01' in c and '000000999' not in c
+    assert [b.vol_id for b in c.book('000000218')] == ['000000218_01', '000000218_02', '000000218_03']
+    assert len(c.filter(book_id='000000218')) == 3
+    assert [b.vol_id for b in c.filter(lambda b: b.title.startswith('All for Greed'))] == ['000000216_01', '000000216_02']
+    assert c[0] is not c[0]
+    cached = BLCorpus('data', cacheSize=2)
+    assert cached[0] is cached[0]
+    (cached[1], cached[2])
+    assert len(cached.cache) == 2 and cached.files[0] not in cached.cache
+
+    print('Testing pickling, as for worker processes')
+    text = BLText(c.files[0])
+    copy = pickle.loads(pickle.dumps(text))
+    assert (copy.text, copy.getStats(), copy.title) == (text.text, text.getStats(), text.title)
+
     return c
 
 if __name__ == '__main__':
@@ -0,0 +1,157 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Splits a corpus between machines.  Shard K of N (counting from 0) is either
+the books whose book_id hashes to K, which keeps all the volumes of a book
+together, or, given a manifest of zip sizes like metadata/file-list.txt, the
+Kth of N bins packed to hold about the same number of bytes each.  Both only
+depend on the file names and the manifest, so every machine agrees on the
+split without talking to the others.
+
+Each machine can write a summary of its shard, and the summaries can then be
+merged into one for the whole run.
+"""
+
+import hashlib
+import json
+import os
+import time
+
+import click
+
+def parse_shard(shard):
+    """ (K, N) from 'K/N'. """
+    try:
+        (k, n) = (int(i) for i in shard.split('/'))
+    except ValueError:
+        raise click.BadParameter('Shards are given as K/N, e.g. 0/4')
+    if not 0 <= k < n:
+        raise click.BadParameter('Shard %d/%d should be between 0/%d and %d/%d' % (k, n, n, n - 1, n))
+    return (k, n)
+
+def book_id(filename):
+    """ The book_id from a zip name like 000000037_0_1-42pgs__944211_dat.zip """
+    return os.path.basename(filename).split('_')[0]
+
+def hash_shard(filename, n):
+    """ The shard of a book by a stable hash of its book_id (Python's hash() varies between runs). """
+    return int(hashlib.md5(book_id(filename).encode('utf-8')).hexdigest(), 16) % n
+
+def read_sizes(manifest):
+    """ {zip name: size} from a file list of "size name" lines. """
+    sizes = {}
+    with open(manifest) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) == 2:
+                sizes[fields[1]] = int(fields[0])
+    return sizes
+
+def manifest_sizes(manifest=None):
+    """
+    The zip sizes to schedule a parallel batch by, largest first: from the
+    manifest, or the corpus file list if there isn't one.  None if neither
+    exists.
+    """
+    from gitlit.index import FILE_LIST
+    path = manifest or FILE_LIST
+    if not os.path.exists(path):
+        return None
+    return read_sizes(path)
+
+def pack(filenames, n, sizes):
+    """
+    Assign the books to n shards with about the same total size each,
+    largest first onto the lightest shard.  Books missing from sizes are
+    shared out by hash.  Returns {filename: shard}.
+    """
+    shards = {}
+    totals = [0] * n
+    known = []
+    for f in filenames:
+        size = sizes.get(os.path.basename(f))
+        if size is None:
+            shards[f] = hash_shard(f, n)
+        else:
+            known.append((size, os.path.basename(f), f))
+    # Sorted by name too, so that ties are broken the same way everywhere
+    for (size, name, f) in sorted(known, key=lambda k: (-k[0], k[1])):
+        lightest = totals.index(min(totals))
+        shards[f] = lightest
+        totals[lightest] += size
+    return shards
+
+def select(filenames, k, n, manifest=None):
+    """ The filenames in shard k of n, in their original order. """
+    if manifest:
+        shards = pack(filenames, n, read_sizes(manifest))
+        return [f for f in filenames if shards[f] == k]
+    return [f for f in filenames if hash_shard(f, n) == k]
+
+
+class Summary():
+    """ What happened to the books of one shard, or of several merged. """
+    def __init__(self, shards=(), books=0, failed=0, size=0, seconds=0.0, failures=None):
+        self.shards = list(shards)
+        self.books = books
+        self.failed = failed
+        self.size = size
+        self.seconds = seconds
+        self.failures = failures or {}
+        self.started = time.time()
+
+    def add(self, result):
+        """ Count a batch.BookResult. """
+        self.books += 1
+        if os.path.exists(result.filename):
+            self.size += os.path.getsize(result.filename)
+        if not result.ok:
+            self.failed += 1
+            self.failures[result.filename] = result.error
+
+    def finish(self):
+        self.seconds = time.time() - self.started
+
+    def toJSON(self):
+        return {'shards': self.shards, 'books': self.books, 'failed': self.failed, 'bytes': self.size,
+                'seconds': round(self.seconds, 3), 'failures': self.failures}
+
+    def save(self, path):
+        with open(path, 'w') as f:
+            json.dump(self.toJSON(), f, indent=2, sort_keys=True)
+
+    @classmethod
+    def load(cls, path):
+        with open(path) as f:
+            j = json.load(f)
+        return cls(j['shards'], j['books'], j['failed'], j['bytes'], j['seconds'], j['failures'])
+
+    @classmethod
+    def merge(cls, summaries):
+        """ One summary for several shards.  Its seconds are the slowest shard's. """
+        merged = cls()
+        for s in summaries:
+            merged.shards.extend(s.shards)
+            merged.books += s.books
+            merged.failed += s.failed
+            merged.size += s.size
+            merged.seconds = max(merged.seconds, s.seconds)
+            merged.failures.update(s.failures)
+        return merged
+
+    def missing(self):
+        """ Shards of the run which aren't in this summary. """
+        seen = set(self.shards)
+        counts = set(int(s.split('/')[1]) for s in seen)
+        return ['%d/%d' % (k, n) for n in sorted(counts) for k in range(n) if '%d/%d' % (k, n) not in seen]
+
+    def __str__(self):
+        lines = ['Shards: %s' % (', '.join(sorted(self.shards, key=lambda s: tuple(map(int, s.split('/')))))
+                                 or 'all'),
+                 'Books: %d (%d failed), %.1f MB in %.1f seconds' % (self.books, self.failed, self.size / 1e6,
+                                                                     self.seconds)]
+        if self.missing():
+            lines.append('Missing shards: %s' % ', '.join(self.missing()))
+        for (filename, error) in sorted(self.failures.items()):
+            lines.append('Failed %s: %s' % (filename, error))
+        return '\n'.join(lines)
@@ -0,0 +1,105 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+Reads zip members through a memory map of the whole zip.
+
+The central directory is read once, when the zip is opened, and each member
+is then decompressed from the map in a single call into one buffer (stored
+members are returned as a view of the map without copying), instead of the
+many small reads and copies of ZipFile.open().  On network storage this
+means the zip is read in a few large requests.
+"""
+
+import hashlib
+import mmap
+import struct
+import zipfile
+import zlib
+
+LOCAL_HEADER = struct.Struct('<4sHHHHHIIIHH')
+
+
+class MappedZip():
+    def __init__(self, filename):
+        self.filename = filename
+        # For the members compressed with other methods, opened when first needed
+        self.zip = None
+        self.file = open(filename, 'rb')
+        try:
+            try:
+                self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+            except ValueError:
+                # An empty file can't be mapped
+                self.map = b''
+            self.view = memoryview(self.map)
+            # ZipFile only needs read, seek and tell, which the map has
+            with zipfile.ZipFile(self.map if self.map else self.file) as zf:
+                self.members = {info.filename: info for info in zf.infolist()}
+                self.names = [info.filename for info in zf.infolist()]
+        except zipfile.BadZipFile:
+            self.close()
+            raise
+        except Exception as e:
+            # e.g. ValueError from seeking in a file which isn't a zip
+            self.close()
+            raise zipfile.BadZipFile('%s is not a zip file: %s' % (filename, e)) from e
+
+    def namelist(self):
+        return list(self.names)
+
+    def raw(self, info):
+        """ The compressed data of a member, as a view of the map. """
+        start = info.header_offset
+        (signature, version, flags, method, modTime, modDate, crc, compressedSize, size,  # @UnusedVariable
+         nameLength, extraLength) = LOCAL_HEADER.unpack_from(self.map, start)
+        if signature != b'PK\x03\x04':
+            raise zipfile.BadZipFile('Bad local header for %s in %s' % (info.filename, self.filename))
+        start += LOCAL_HEADER.size + nameLength + extraLength
+        return self.view[start:start + info.compress_size]
+
+    def read(self, name):
+        """
+        The contents of a member: bytes, or for a stored member a memoryview
+        of the map, valid until the zip is closed.
+        """
+        info = self.members[name]
+        if info.compress_type not in (zipfile.ZIP_STORED, zipfile.ZIP_DEFLATED):
+            # Other methods (bzip2, lzma) are rare enough to leave to ZipFile
+            if self.zip is None:
+                # From the file, since reading members needs seekable(), which maps don't have
+                self.zip = zipfile.ZipFile(self.file)
+            return self.zip.read(name)
+        data = self.raw(info)
+        if info.compress_type == zipfile.ZIP_DEFLATED:
+            # Decompress into a single buffer of the right size
+            data = zlib.decompress(data, -zlib.MAX_WBITS, max(info.file_size, 1))
+        if len(data) != info.file_size or zlib.crc32(data) != info.CRC:
+            raise zipfile.BadZipFile('Bad CRC for %s in %s' % (name, self.filename))
+        return data
+
+    def sha1(self):
+        """ A hashlib sha1 of the whole zip, from the map rather than another read. """
+        return hashlib.sha1(self.view)
+
+    def close(self):
+        if self.file is None:
+            return
+        if self.zip is not None:
+            self.zip.close()
+            self.zip = None
+        try:
+            if hasattr(self, 'view'):
+                self.view.release()
+            if getattr(self, 'map', None):
+                self.map.close()
+        except BufferError:
+            # A stored member is still in use, so leave the map to be freed with it
+            pass
+        self.file.close()
+        self.file = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exception_type, exception_value, traceback):
+        self.close()
@@ -6,21 +6,41 @@ The computed language is used both to catch errors in the existing metadata,
 but, more frequently, to fill in the language for the 19k works which are 
 missing it.
 
+Each distinct cleaned title is only classified once, in batches spread over
+a pool of processes, and the results are kept in a SQLite cache keyed by a
+hash of the title, so rerunning on an updated booklist only classifies the
+new titles.  langdetect is seeded so that it gives the same answer every
+time.
+
 Created on Jan 27, 2016
 
 @author: Tom Morris <tfmorris@gmail.com>
 @license: Apache License 2.0
 '''
+from argparse import ArgumentParser
 import codecs
 from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
+from functools import lru_cache
+import hashlib
+import os
 import iso639
 import langdetect
 from langdetect.lang_detect_exception import LangDetectException
 import pycld2 as cld2
 import re
+import sqlite3
+import sys
 
 BRACKET_RE = re.compile(r'\[[^\]]*\]')
 
+CACHE = 'title-languages.db'
+BATCH_SIZE = 500
+
+# langdetect is random unless it's seeded
+langdetect.DetectorFactory.seed = 0
+
+@lru_cache(maxsize=None)
 def bib2std(code):
     """
     Translate a bibliographic variant ISO 639-2 three letter code to its 
@@ -50,7 +70,80 @@ def cleanTitle(title):
     title = re.sub(BRACKET_RE, '', title).strip()
     return title
 
+def detect(title):
+    """ The languages of a cleaned title according to langdetect and CLD2, 'unk' if they can't tell. """
+    lang1 = 'unk'
+    try:
+        lang1 = langdetect.detect(title)
+    except LangDetectException:
+        # print(('Language detection failed for %s' % line).encode('utf-8'))
+        pass
+    title = title.encode('utf-8') # CLD2 needs UTF-8 bytes
+    isReliable, textBytesFound, langDetails = cld2.detect(title)  # @UnusedVariable
+    lang2 = 'unk'
+    if isReliable:
+        lang2 = langDetails[0][1]
+    return (lang1, lang2)
+
+def detectBatch(titles):
+    return [detect(title) for title in titles]
+
+def titleHash(title):
+    return hashlib.sha1(title.encode('utf-8')).hexdigest()
+
+
+class LanguageCache():
+    """ The detected languages of titles, by a hash of the cleaned title. """
+    def __init__(self, path=CACHE):
+        self.db = sqlite3.connect(path)
+        with self.db:
+            self.db.execute('CREATE TABLE IF NOT EXISTS languages (hash TEXT PRIMARY KEY, langdetect TEXT, cld2 TEXT)')
+
+    def get(self, titles):
+        """ {title: (langdetect, cld2)} for those of the titles which have been classified. """
+        found = {}
+        for title in titles:
+            row = self.db.execute('SELECT langdetect, cld2 FROM languages WHERE hash = ?',
+                                  (titleHash(title),)).fetchone()
+            if row:
+                found[title] = tuple(row)
+        return found
+
+    def put(self, languages):
+        with self.db:
+            self.db.executemany('INSERT OR REPLACE INTO languages VALUES (?, ?, ?)',
+                                [(titleHash(title), lang1, lang2) for (title, (lang1, lang2)) in languages.items()])
+
+    def close(self):
+        self.db.close()
+
+
+def detectAll(titles, cache=None, jobs=None, batchSize=BATCH_SIZE):
+    """
+    {title: (langdetect, cld2)} for the titles, classifying each distinct
+    title which isn't in the cache in batches across jobs processes, and
+    adding them to the cache.
+    """
+    unique = list(dict.fromkeys(titles))
+    languages = cache.get(unique) if cache else {}
+    todo = [t for t in unique if t not in languages]
+    print('Detecting languages of %d new titles (%d distinct, %d in all)' % (len(todo), len(unique), len(titles)),
+          file=sys.stderr)
+    batches = [todo[i:i + batchSize] for i in range(0, len(todo), batchSize)]
+    with ProcessPoolExecutor(max_workers=jobs or os.cpu_count()) as pool:
+        for (batch, results) in zip(batches, pool.map(detectBatch, batches)):
+            found = dict(zip(batch, results))
+            languages.update(found)
+            if cache:
+                # A batch at a time, so an interrupted run keeps what it's done
+                cache.put(found)
+    return languages
+
 def main():
+    parser = ArgumentParser(description='Extend the booklist with print IDs and detected title languages.')
+    parser.add_argument('--jobs', '-j', type=int, default=None, help='Processes to detect languages with [default: one per CPU]')
+    parser.add_argument('--cache', default=CACHE, help='Detected languages from previous runs [default: %(default)s]')
+    args = parser.parse_args()
 
     lookup = dict()
     with open('metadata/crosswalk.tsv') as infile:
@@ -69,59 +162,53 @@ def main():
     mismatch = 0
     langs = Counter()
     with codecs.open('metadata/booklist.tsv','r','utf-8') as infile:
-        for line in infile:
-            line = line.rstrip('\n')
-            if line.startswith('Aleph'): # handle header
-                print('Print sysnum\tFlag\tDetected Lang\tBest Lang\t%s' % line)
-                continue
-            total += 1
-            fields = line.split('\t')
-            scanId = fields[0]
-            title = fields[7]
-            title = cleanTitle(title)
-            lang1 = 'unk'
-            try:
-                lang1 = langdetect.detect(title)
-            except LangDetectException:
-                # print(('Language detection failed for %s' % line).encode('utf-8'))
-                pass
-            title = title.encode('utf-8') # CLD2 needs UTF-8 bytes
-            isReliable, textBytesFound, langDetails = cld2.detect(title)  # @UnusedVariable
-            lang2 = 'unk'
-            if isReliable:
-                lang2 = langDetails[0][1]
-            origLang = fields[2]
-            if origLang and not origLang in ['und', 'mul']:
-                origLang = bib2std(origLang)
-            if not origLang:
-                origLang = 'und'
-            newLang = 'unk'
-            flag = ''
-            bestLang = origLang
-            if lang1 == lang2:
-                newLang = lang1
-                if lang1 == origLang:
-                    all_agree += 1
-                elif not origLang in ['und', 'mul']:
-                    mismatch += 1
-                    flag = '*'
+        lines = [line.rstrip('\n') for line in infile]
+    titles = [cleanTitle(line.split('\t')[7]) for line in lines if not line.startswith('Aleph')]
+    cache = LanguageCache(args.cache)
+    languages = detectAll(titles, cache, args.jobs)
+    cache.close()
+    for line in lines:
+        if line.startswith('Aleph'): # handle header
+            print('Print sysnum\tFlag\tDetected Lang\tBest Lang\t%s' % line)
+            continue
+        total += 1
+        fields = line.split('\t')
+        scanId = fields[0]
+        title = fields[7]
+        title = cleanTitle(title)
+        (lang1, lang2) = languages[title]
+        origLang = fields[2]
+        if origLang and not origLang in ['und', 'mul']:
+            origLang = bib2std(origLang)
+        if not origLang:
+            origLang = 'und'
+        newLang = 'unk'
+        flag = ''
+        bestLang = origLang
+        if lang1 == lang2:
+            newLang = lang1
+            if lang1 == origLang:
+                all_agree += 1
+            elif not origLang in ['und', 'mul']:
+                mismatch += 1
+                flag = '*'
+                bestLang = lang1
+            else:
+                new_agree += 1
+                if origLang != 'mul':
                     bestLang = lang1
-                else:
-                    new_agree += 1
-                    if origLang != 'mul':
-                        bestLang = lang1
-            langs[newLang+'-'+origLang] += 1
-
-            printId = 'None'
-            if scanId in lookup:
-                printId = lookup[scanId]
-                found += 1
-
-            # TODO: Blaclist pig latin, Klingon, etc
-            #if lang == 'zzp':
-            #    print(lang,title,line)
-
-            print(('%s\t%s\t%s\t%s\t%s' % (printId, flag, newLang, bestLang, line)).encode('utf-8'))
+        langs[newLang+'-'+origLang] += 1
+
+        printId = 'None'
+        if scanId in lookup:
+            printId = lookup[scanId]
+            found += 1
+
+        # TODO: Blaclist pig latin, Klingon, etc
+        #if lang == 'zzp':
+        #    print(lang,title,line)
+
+        print(('%s\t%s\t%s\t%s\t%s' % (printId, flag, newLang, bestLang, line)).encode('utf-8'))
 
     print('Found print ID for %d of %d total' % (found, total))
     print('Found %d title language mismatches, %d agreed new, %d all 3 agree, total = %d' % (mismatch, new_agree, all_agree, total))
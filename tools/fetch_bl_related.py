@@ -11,16 +11,29 @@ Fetching the ARKs took another 30 hours, so it is disabled by default.  There
 are multiple DOM IDs (lsid) and ARKs for multi-volume editions, so the values
 for these columns are comma-separated lists.
 
+The lookups are now made by several asyncio workers sharing a pool of
+connections.  Politeness is a budget of requests per second for the whole
+run, enforced by a token bucket, rather than a pause after each response, so
+the latency of one request no longer holds up the rest.  Each result is
+appended to a store as soon as it's known, so an interrupted run picks up
+where it left off and a rerun only looks up the IDs which failed.
+
 Created on Jan 27, 2016
 
 @author: Tom Morris <tfmorris@gmail.com>
 @license: Apache License 2.0
 '''
 
+from argparse import ArgumentParser
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+import os
+import random
+import sys
+import time
+
 from lxml import etree as ET
 import requests
-import requests_cache
-import time
 
 CATALOG_TEMPLATE = 'http://primocat.bl.uk/F/?func=direct&local_base=PRIMO&doc_number=%s'
 # Full viewer URL - http://access.bl.uk/item/viewer/lsidyv39e6ab44#ark:/81055/vdc_00000003D6EB.0x000009
@@ -29,93 +42,293 @@ VIEWER_TEMPLATE = 'http://access.bl.uk/item/viewer/%s'
 
 FETCH_ARKS = False
 
-def make_throttle_hook(timeout=1.0):
+# Be polite - less than 2 req/sec, however many are in flight
+RATE = 2.0
+CONCURRENCY = 8
+RETRIES = 3
+# Seconds before the first retry, doubled for each retry after that and jittered
+BACKOFF = 2.0
+TIMEOUT = 60
+STORE = 'bl-related.tsv'
+COLUMNS = ['Print ID', 'Scan ID', 'DOM IDs', 'ARKs']
+
+def parsePrintId(content):
+    """ The print record's system number from the scan's catalog page, or None. """
+    doc = ET.HTML(content)
+    relatedLinks = doc.findall('.//td[@class="td1"]/a[@href]')
+    if len(relatedLinks) > 0:
+        href = relatedLinks[0].attrib['href']
+        candidate = href.split('=')[-1]
+        if len(candidate) > 0:
+            return candidate
+    return None
+
+def parseARK(content):
+    doc = ET.HTML(content)
+    inputItemId = doc.findall('.//input[@id="ItemID"]') # type = "hidden"
+    if len(inputItemId) > 0:
+        return inputItemId[0].attrib['value']
+    return 'None'
+
+
+class TokenBucket():
+    """ Allows rate requests a second on average, with bursts of up to burst at once. """
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def take(self):
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
+
+
+class AsyncFetcher():
     """
-    Returns a response hook function which sleeps for `timeout` seconds if
-    response is not cached
+    Makes GET requests from asyncio, at most concurrency at a time over a
+    shared pool of connections and no faster than rate a second in total.
+    Server errors, rate limiting and connection failures are retried with
+    exponential backoff and jitter.
     """
-    def hook(response, *args, **kw_args):
-        if not getattr(response, 'from_cache', False):
-            #print 'sleeping'
-            # This doesn't account for response latency, so rate will be less
-            # (perhaps much less) than 1/timeout per sec.
-            time.sleep(timeout)
-        return response
-    return hook
-
-def getWithRetry(session, url):
-    tries = 3
-    while tries:
-        tries -= 1
-        response = session.get(url)
+    def __init__(self, rate=RATE, concurrency=CONCURRENCY, retries=RETRIES, backoff=BACKOFF, timeout=TIMEOUT):
+        self.bucket = TokenBucket(rate)
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=concurrency)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        # requests blocks, so each request in flight has a thread
+        self.pool = ThreadPoolExecutor(max_workers=concurrency)
+
+    async def get(self, url):
+        """ The response, or None if the request failed every time. """
+        loop = asyncio.get_running_loop()
+        for attempt in range(self.retries + 1):
+            await self.bucket.take()
+            try:
+                response = await loop.run_in_executor(self.pool, lambda: self.session.get(url, timeout=self.timeout))
+                if response.status_code < 500 and response.status_code != 429:
+                    return response
+                problem = 'HTTP %d' % response.status_code
+            except requests.RequestException as e:
+                problem = str(e)
+            if attempt < self.retries:
+                delay = self.backoff * 2 ** attempt * random.uniform(0.5, 1.5)
+                print('Failed to fetch %s (%s), retrying in %.1f seconds' % (url, problem, delay), file=sys.stderr)
+                await asyncio.sleep(delay)
+            else:
+                print('Failed to fetch %s (%s), giving up' % (url, problem), file=sys.stderr)
+        return None
+
+    async def fetch(self, template, key, parse):
+        """ (whether the lookup completed, parse(content) or None if the page isn't there). """
+        response = await self.get(template % key)
+        if response is None:
+            return (False, None)
         if response.status_code != requests.codes.ok:
-            print('Failed to fetch %d %s' % (response.status_code, url))
-            if response.status_code >= 500 and tries:
-                print('Sleeping before retry')
-                time.sleep(2**(3-tries))
-    return response
-
-def getPrintId(session, digitalId):
-    url = CATALOG_TEMPLATE % digitalId
-    originalId = None
-    response = getWithRetry(session, url)
-
-    if response.status_code == requests.codes.ok:
-        doc = ET.HTML(response.content)
-        relatedLinks = doc.findall('.//td[@class="td1"]/a[@href]')
-        if len(relatedLinks) > 0:
-            href = relatedLinks[0].attrib['href']
-            candidate = href.split('=')[-1]
-            if len(candidate) > 0:
-                originalId = candidate
-    return originalId
-
-def getARK(session, lsid):
+            # Not there, which is an answer too
+            return (True, None)
+        return (True, parse(response.content))
+
+    def close(self):
+        self.pool.shutdown()
+        self.session.close()
+
+
+class ResultStore():
     """
-    Get ARK from lsid
+    The rows looked up so far, by scan ID, in a TSV file with the same
+    columns as the output.  Rows are appended and flushed one at a time, so
+    the file survives the run being killed.
     """
-    url = VIEWER_TEMPLATE % lsid
-    ark = None
-    response = session.get(url)
-    if response.status_code == requests.codes.ok:
-        doc = ET.HTML(response.content)
-        inputItemId = doc.findall('.//input[@id="ItemID"]') # type = "hidden"
-        ark = 'None'
-        if len(inputItemId) > 0:
-            ark = inputItemId[0].attrib['value']
-    return ark
+    def __init__(self, path):
+        self.path = path
+        self.rows = {}
+        if os.path.exists(path):
+            with open(path) as f:
+                for line in f:
+                    fields = line.rstrip('\n').split('\t')
+                    if fields[0] != COLUMNS[0] and len(fields) > 1:
+                        self.rows[fields[1]] = fields
+        new = not os.path.exists(path) or os.path.getsize(path) == 0
+        self.out = open(path, 'a')
+        if new:
+            self.out.write('\t'.join(COLUMNS) + '\n')
 
-def main():
-    requests_cache.install_cache("british-library-catalog")
-    session = requests_cache.CachedSession()
-    session.hooks = {'response': make_throttle_hook(0.5)} # Be polite - less than 2 req/sec
+    def __contains__(self, digitalId):
+        return digitalId in self.rows
 
-    columns = '\t'.join(['Print ID', 'Scan ID', 'DOM IDs'])
-    if FETCH_ARKS:
-        columns += '\tARKs'
-    print(columns)
+    def add(self, fields):
+        self.rows[fields[1]] = fields
+        self.out.write('\t'.join(fields) + '\n')
+        self.out.flush()
 
-    with open('metadata/booklist.tsv') as infile:
+    def close(self):
+        self.out.close()
+
+
+def readBooklist(path):
+    """ (scan ID, [lsids]) for each book in the booklist. """
+    books = []
+    with open(path) as infile:
         for line in infile:
             if line.startswith('Aleph'): #skip header
                 continue
             line = line.rstrip('\n')
-            digitalId = line.split('\t')[0]
-            originalId = getPrintId(session, digitalId)
+            books.append((line.split('\t')[0], line.split('\t')[-1].split(' -- ')))
+    return books
+
+async def lookup(fetcher, store, digitalId, lsids, fetchArks=False, catalog=CATALOG_TEMPLATE, viewer=VIEWER_TEMPLATE):
+    """ Look up one book, storing its row unless a request failed. """
+    (ok, originalId) = await fetcher.fetch(catalog, digitalId, parsePrintId)
+    arks = []
+    # This (disabled) section of code will translate lsid to ARK
+    # in case we ever need it.  Right now the BL Viewer accepts raw
+    # lsids, so it's unnecessary
+    if fetchArks:
+        for lsid in lsids:
+            (arkOk, ark) = await fetcher.fetch(viewer, lsid, parseARK)
+            ok = ok and arkOk
+            arks.append(str(ark))
+    if ok:
+        store.add([str(originalId), digitalId, ','.join(lsids), ','.join(arks)])
+    return ok
+
+async def fetchAll(books, store, fetcher, fetchArks=False, workers=CONCURRENCY, **templates):
+    """ Look up the books which aren't in the store yet. Returns the number which failed. """
+    queue = asyncio.Queue()
+    for book in books:
+        if book[0] not in store:
+            queue.put_nowait(book)
+    print('Looking up %d of %d books' % (queue.qsize(), len(books)), file=sys.stderr)
+    failed = []
+
+    async def worker():
+        while not queue.empty():
+            (digitalId, lsids) = queue.get_nowait()
+            if not await lookup(fetcher, store, digitalId, lsids, fetchArks, **templates):
+                failed.append(digitalId)
+
+    await asyncio.gather(*[worker() for _ in range(workers)])
+    return len(failed)
+
+def run(books, storePath, rate=RATE, concurrency=CONCURRENCY, fetchArks=False, retries=RETRIES, backoff=BACKOFF,
+        **templates):
+    """ Look up the books into the store at storePath. Returns (store, number failed). """
+    store = ResultStore(storePath)
+    async def go():
+        fetcher = AsyncFetcher(rate, concurrency, retries, backoff)
+        try:
+            return await fetchAll(books, store, fetcher, fetchArks, concurrency, **templates)
+        finally:
+            fetcher.close()
+    try:
+        failed = asyncio.run(go())
+    finally:
+        store.close()
+    return (store, failed)
+
+def main():
+    parser = ArgumentParser(description='Look up the print records of the scanned books in the BL catalog.')
+    parser.add_argument('booklist', nargs='?', default='metadata/booklist.tsv')
+    parser.add_argument('--store', default=STORE, help='Results so far, which a rerun skips [default: %(default)s]')
+    parser.add_argument('--rate', type=float, default=RATE, help='Requests per second [default: %(default)s]')
+    parser.add_argument('--concurrency', type=int, default=CONCURRENCY,
+                        help='Requests in flight at once [default: %(default)s]')
+    parser.add_argument('--arks', action='store_true', default=FETCH_ARKS, help='Look up the ARKs too')
+    args = parser.parse_args()
+
+    books = readBooklist(args.booklist)
+    (store, failed) = run(books, args.store, args.rate, args.concurrency, args.arks)
+    columns = COLUMNS if args.arks else COLUMNS[:3]
+    print('\t'.join(columns))
+    for (digitalId, lsids) in books:  # @UnusedVariable
+        if digitalId in store:
+            print('\t'.join(store.rows[digitalId][:len(columns)]))
+    if failed:
+        print('%d lookups failed, run again to retry them' % failed, file=sys.stderr)
+        return 1
+    return 0
+
+
+CANNED_PAGE = '<html><body><table><tr><td class="td1"><a href="/F/?func=direct&doc_number=%s">Print</a></td></tr></table></body></html>'
+
+def test():
+    """ Look up books from a local stub of the catalog, then rerun with the failures fixed. """
+    from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+    import tempfile
+    import threading
+    from urllib.parse import parse_qs, urlparse
+
+    hits = []
+    # Scan IDs whose first request fails, and ones which fail until this is set
+    flaky = {'000000003'}
+    broken = {'000000007'}
+    fixed = threading.Event()
+
+    class Catalog(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            digitalId = parse_qs(urlparse(self.path).query)['doc_number'][0]
+            hits.append(digitalId)
+            if digitalId in flaky and hits.count(digitalId) == 1 or digitalId in broken and not fixed.is_set():
+                (status, body) = (503, b'Busy')
+            elif digitalId == '000000005':
+                (status, body) = (404, b'Not found')
+            else:
+                (status, body) = (200, (CANNED_PAGE % ('1' + digitalId[1:])).encode('utf-8'))
+            self.send_response(status)
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
 
-            # This (disabled) section of code will translate lsid to ARK
-            # in case we ever need it.  Right now the BL Viewer accepts raw
-            # lsids, so it's unnecessary
-            lsids = line.split('\t')[-1].split(' -- ')
-            arks = []
-            if FETCH_ARKS:
-                for lsid in lsids:
-                    ark = getARK(session, lsid)
-                    arks.append(ark)
+        def log_message(self, *args):
+            pass
 
-            print('\t'.join([str(originalId), digitalId,','.join(lsids),','.join(arks)]))
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Catalog)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    catalog = 'http://127.0.0.1:%d/F/?func=direct&local_base=PRIMO&doc_number=%%s' % server.server_address[1]
+    storePath = os.path.join(tempfile.mkdtemp(), 'related.tsv')
+    books = [('%09d' % i, ['lsid%d' % i]) for i in range(20)]
+    rate = 40.0
+    try:
+        start = time.time()
+        (store, failed) = run(books, storePath, rate=rate, concurrency=4, retries=1, backoff=0.05, catalog=catalog)
+        elapsed = time.time() - start
+        assert failed == 1 and '000000007' not in store, failed
+        assert store.rows['000000003'][0] == '100000003'
+        assert store.rows['000000005'][0] == 'None'
+        # 20 books plus a retry each of the flaky and the broken one
+        assert len(hits) == 22, len(hits)
+        assert elapsed >= (len(hits) - 1) / rate, elapsed
 
+        # The rerun only asks for the book which failed
+        fixed.set()
+        del hits[:]
+        (store, failed) = run(books, storePath, rate=rate, concurrency=4, catalog=catalog)
+        assert failed == 0 and hits == ['000000007'], hits
+        reread = ResultStore(storePath)
+        reread.close()
+        assert len(reread.rows) == 20
+    finally:
+        server.shutdown()
+    print('Looked up %d books in %.2f seconds at %.0f requests a second: OK' % (len(books), elapsed, rate))
 
 
 if __name__ == '__main__':
-    main()
+    if sys.argv[1:] == ['--test']:
+        test()
+    else:
+        sys.exit(main())
@@ -5,6 +5,13 @@ stats -- Dump compute and dump corpus stats
 
 stats is a program to compute and dump statistics for books in the British Library 19th Century corpus
 
+Books are converted in a pool of worker processes and their rows printed as
+they finish.  Only the running totals are kept, as a gitlit.aggregate.Totals,
+so the whole corpus takes no more memory than a book.  The totals can be
+saved with --totals and those of several runs (e.g. on different machines)
+combined with --merge.  The language of each book, identified from pages
+sampled through it, can be saved in a corpus index with --index.
+
 It defines classes_and_methods
 
 @author:     Tom Morris
@@ -27,10 +34,14 @@ import os
 
 from argparse import ArgumentParser
 from argparse import RawDescriptionHelpFormatter
-from reader import BLCorpus
-from lib2to3.pgen2.pgen import PgenGrammar
-
-import pycld2
+from functools import partial
+from gitlit import batch
+import gitlit.shard
+import gitlit.cache
+import gitlit.index
+from gitlit.aggregate import Totals
+from gitlit.language import SAMPLE_PAGES, UNKNOWN
+from gitlit.reader import BLCorpus, BLText
 
 __all__ = []
 __version__ = 0.1
@@ -82,9 +93,14 @@ USAGE
         # Setup argument parser
         parser = ArgumentParser(description=program_license, formatter_class=RawDescriptionHelpFormatter)
         parser.add_argument("-r", "--recursive", dest="recurse", action="store_true", help="recurse into subfolders [default: %(default)s]")
-        parser.add_argument("-v", "--verbose", dest="verbose", action="count", help="set verbosity level [default: %(default)s]")
+        parser.add_argument("-v", "--verbose", dest="verbose", action="count", default=0, help="set verbosity level [default: %(default)s]")
         parser.add_argument("-i", "--include", dest="include", help="only include paths matching this regex pattern. Note: exclude is given preference over include. [default: %(default)s]", metavar="RE" )
         parser.add_argument("-e", "--exclude", dest="exclude", help="exclude paths matching this regex pattern. [default: %(default)s]", metavar="RE" )
+        parser.add_argument("-j", "--jobs", dest="jobs", type=int, default=1, help="number of books to convert in parallel [default: %(default)s]")
+        parser.add_argument("--no-cache", dest="nocache", action="store_true", help="don't use or update the conversion cache")
+        parser.add_argument("--totals", dest="totals", help="save the totals to this JSON file, for --merge", metavar="FILE")
+        parser.add_argument("--merge", dest="merge", action="store_true", help="the paths are --totals files to combine, rather than books")
+        parser.add_argument("--index", dest="index", help="record each book's language in this corpus index", metavar="DB")
         parser.add_argument('-V', '--version', action='version', version=program_version_message)
         parser.add_argument(dest="paths", help="paths to folder(s) with source file(s) [default: %(default)s]", metavar="path", nargs='+')
 
@@ -107,24 +123,19 @@ USAGE
         if inpat and expat and inpat == expat:
             raise CLIError("include and exclude pattern are equal! Nothing will be processed.")
 
-        confidence = 0
-        pages = 0
-        words = 0
-        chars = 0
-
-        if recurse:
-            corpus = BLCorpus(paths[0], metadataOnly=False)
-            (confidence, pages, words, chars) = generate_stats(corpus)
+        if args.merge:
+            totals = Totals.combine(Totals.load(path) for path in paths)
         else:
-            for path in paths:
-                corpus = BLCorpus([path], metadataOnly=False)
-                (conf, pg, wd, ch) = generate_stats(corpus)
-                confidence += conf
-                pages += pg
-                words += wd
-                chars += ch
+            if recurse:
+                files = BLCorpus(paths[0]).files
+            else:
+                files = paths
+            index = gitlit.index.CorpusIndex(args.index) if args.index else None
+            totals = generate_stats(files, args.jobs, not args.nocache, index)
+        if args.totals:
+            totals.save(args.totals)
 
-        print('\t'.join(['Total|Avg', str(confidence/words), '--', str(pages), str(words), str(chars)]))
+        print('\t'.join(['Total|Avg', str(totals.avg_word_confidence), '--', str(totals.pages), str(totals.words), str(totals.chars)]))
 
         return 0
     except KeyboardInterrupt:
@@ -138,34 +149,37 @@ USAGE
 #         sys.stderr.write(indent + "  for help use --help")
 #         return 2
 
-def generate_stats(corpus):
-    confidence = 0
-    pages = 0
-    words = 0
-    chars = 0
-
-    for text in corpus.texts:
-        if type(text.author) is list:
-            author = '|'.join(text.author)
-        else:
-            author = text.author
-        confidence += text.avg_word_confidence * text.words
-        pages += text.pages
-        words += text.words
-        chars += len(text.text)
-        vid = text.book_id
-        if text.volume:
-            vid += ('_%02d' % text.volume)
-        isReliable, textBytesFound, langDetails = pycld2.detect(text.title.encode('utf-8'), isPlainText=True)
-        if isReliable:
-            language = langDetails[0][0]
-            langCode = langDetails[0][1]
-        else:
-            language = 'Unknown'
-            langCode = '--'
-        print('\t'.join([vid, str(text.avg_word_confidence), langCode, str(text.pages), str(text.words), str(len(text.text)), author, text.title]))
-
-    return(confidence, pages, words, chars)
+def book_stats(filename, useCache=True):
+    """ (vol_id, row to print, statistics) for a book, converted without keeping its text. """
+    text = BLText(filename, streaming=True, cache=gitlit.cache.open_cache() if useCache else None,
+                  languagePages=SAMPLE_PAGES)
+    for chunk in text.iterText():
+        pass
+    if type(text.author) is list:
+        author = '|'.join(text.author)
+    else:
+        author = text.author
+    # From pages sampled through the book as it was parsed, which is more reliable than the title
+    langCode = text.language if text.language and text.language != UNKNOWN else '--'
+    row = '\t'.join([text.vol_id, str(text.avg_word_confidence), langCode, str(text.pages), str(text.words), str(text.chars), author, text.title])
+    return (text.vol_id, row, text.getStats())
+
+def generate_stats(files, jobs=1, useCache=True, index=None):
+    """ Print a row for each book as it's done, returning the Totals. Languages are recorded in the index if given. """
+    totals = Totals()
+    # Largest first, by the corpus file list
+    sizes = gitlit.shard.manifest_sizes() if jobs > 1 else None
+    for result in batch.run(partial(book_stats, useCache=useCache), files, jobs, sizes):
+        if not result.ok:
+            print('Failed %s' % result, file=sys.stderr)
+            continue
+        (vol_id, row, stats) = result.value
+        if index is not None and stats['language'] not in (None, UNKNOWN):
+            index.setLanguage(vol_id, stats['language'])
+        print(row)
+        sys.stdout.flush()
+        totals.add(stats)
+    return totals
 
 if __name__ == "__main__":
     if DEBUG:
@@ -0,0 +1,312 @@
+#!/usr/bin/python
+# -*- coding: utf-8 -*-
+"""
+A stand-in for the GitHub API, served over HTTP from a local thread and
+backed by local bare repos, to check publishing and updating through
+github3 without the network or an account.  Run it to check:
+
+    python -m tools.stub_github
+
+It serves the parts of the API that publishing uses: the org, its repo
+listing (paginated, with ETags, where a 304 doesn't count against the rate
+limit), repo creation and /rate_limit.  Every response carries the
+X-RateLimit headers, and requests fail with 403 once the limit runs out.
+"""
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from urllib.parse import parse_qs, urlsplit
+
+from click.testing import CliRunner
+import github3
+import sh
+
+from gitlit.fastimport import FastImport, init_repo
+import gitlit.github
+from gitlit.github import RepoIndex, ORG
+from gitlit.local import CdContext
+import gitlit.main
+from gitlit.publish import Publisher, PublishJob
+
+DATA = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'data')
+API = '/api/v3'
+LIMIT = 5000
+
+
+class StubGitHub(ThreadingHTTPServer):
+    """
+    A GitHub Enterprise-style API for the org, whose repos are local bare
+    repos under root which only appear after delay seconds, like freshly
+    created GitHub repos.  The rate limit resets every window seconds.
+    """
+    daemon_threads = True
+
+    def __init__(self, root, delay=0.5, remaining=LIMIT, window=3600):
+        ThreadingHTTPServer.__init__(self, ('127.0.0.1', 0), StubHandler)
+        self.root = root
+        self.delay = delay
+        self.remaining = remaining
+        self.window = window
+        self.reset = time.time() + window
+        self.repos = []
+        self.listings = 0
+        self.lock = threading.Lock()
+        self.thread = threading.Thread(target=self.serve_forever, daemon=True)
+        self.thread.start()
+
+    @property
+    def url(self):
+        return 'http://127.0.0.1:%d/' % self.server_address[1]
+
+    def session(self):
+        """ A github3 session logged in to the stub. """
+        return github3.GitHubEnterprise(self.url, login='stub', password='stub')
+
+    def api(self, *parts):
+        return self.url.rstrip('/') + API + '/' + '/'.join(parts)
+
+    def repoJSON(self, name):
+        return {'id': self.repos.index(name) + 1, 'name': name, 'full_name': '%s/%s' % (ORG, name),
+                'url': self.api('repos', ORG, name), 'ssh_url': os.path.join(self.root, name + '.git'),
+                'owner': {'login': ORG, 'type': 'Organization'}}
+
+    def orgJSON(self):
+        return {'login': ORG, 'id': 1, 'type': 'Organization', 'url': self.api('orgs', ORG),
+                'repos_url': self.api('orgs', ORG, 'repos'), 'public_repos': len(self.repos)}
+
+    def addRepo(self, name, create=True):
+        """ Add a repo to the org, as if someone else had created it. """
+        with self.lock:
+            self.repos.append(name)
+        if create:
+            init_repo(os.path.join(self.root, name + '.git'), bare=True)
+
+    def createRepo(self, name):
+        with self.lock:
+            self.repos.append(name)
+        threading.Timer(self.delay, init_repo, [os.path.join(self.root, name + '.git')], {'bare': True}).start()
+        return self.repoJSON(name)
+
+    def charge(self):
+        """ Count a request against the rate limit. Returns whether there was any left. """
+        with self.lock:
+            if time.time() >= self.reset:
+                (self.remaining, self.reset) = (LIMIT, time.time() + self.window)
+            if self.remaining <= 0:
+                return False
+            self.remaining -= 1
+            return True
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, body=None, headers=None):
+        server = self.server
+        data = json.dumps(body).encode('utf-8') if body is not None else b''
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(data)))
+        self.send_header('X-RateLimit-Limit', str(LIMIT))
+        self.send_header('X-RateLimit-Remaining', str(server.remaining))
+        self.send_header('X-RateLimit-Reset', str(int(server.reset)))
+        for (name, value) in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def route(self):
+        """ (path under the API, query) of the request. """
+        url = urlsplit(self.path)
+        path = url.path
+        if path.startswith(API):
+            path = path[len(API):]
+        return (path.rstrip('/'), parse_qs(url.query))
+
+    def do_GET(self):
+        (path, query) = self.route()
+        server = self.server
+        if path == '/rate_limit':
+            core = {'limit': LIMIT, 'remaining': server.remaining, 'reset': int(server.reset)}
+            return self.reply(200, {'resources': {'core': core}, 'rate': core})
+        if path == '/orgs/' + ORG:
+            return self.charged(200, server.orgJSON())
+        if path == '/orgs/%s/repos' % ORG:
+            return self.listRepos(query)
+        self.reply(404, {'message': 'Not Found'})
+
+    def do_POST(self):
+        (path, query) = self.route()  # @UnusedVariable
+        length = int(self.headers.get('Content-Length') or 0)
+        body = json.loads(self.rfile.read(length) or b'{}')
+        if path != '/orgs/%s/repos' % ORG:
+            return self.reply(404, {'message': 'Not Found'})
+        if self.headers.get('Authorization') is None:
+            return self.reply(401, {'message': 'Requires authentication'})
+        if body['name'] in self.server.repos:
+            return self.charged(422, {'message': 'Validation Failed'})
+        if not self.server.charge():
+            return self.reply(403, {'message': 'API rate limit exceeded'})
+        self.reply(201, self.server.createRepo(body['name']))
+
+    def charged(self, status, body):
+        if not self.server.charge():
+            return self.reply(403, {'message': 'API rate limit exceeded'})
+        self.reply(status, body)
+
+    def listRepos(self, query):
+        """ A page of the org's repos, newest first, with Link and ETag headers like GitHub's. """
+        server = self.server
+        with server.lock:
+            server.listings += 1
+            names = list(reversed(server.repos))
+        perPage = int(query.get('per_page', ['30'])[0])
+        page = int(query.get('page', ['1'])[0])
+        repos = [server.repoJSON(name) for name in names[(page - 1) * perPage:page * perPage]]
+        etag = '"%s"' % hashlib.sha1(json.dumps(repos).encode('utf-8')).hexdigest()
+        headers = {'ETag': etag}
+        if page * perPage < len(names):
+            headers['Link'] = '<%s?per_page=%d&page=%d>; rel="next"' % (server.api('orgs', ORG, 'repos'), perPage, page + 1)
+        if self.headers.get('If-None-Match') == etag:
+            # Not modified, which GitHub doesn't count against the rate limit
+            return self.reply(304, None, headers)
+        if not server.charge():
+            return self.reply(403, {'message': 'API rate limit exceeded'})
+        self.reply(200, repos, headers)
+
+
+def stub_publisher(server, indexPath, **kwargs):
+    """ A Publisher for the stub's org, through github3. """
+    github = server.session()
+    org = github.organization(ORG)
+    options = dict(jobs=3, minInterval=0, backoff=0.2, remote=os.path.join(server.root, '%s.git'))
+    options.update(kwargs)
+    return Publisher(org, github, repos=RepoIndex(org, indexPath), **options)
+
+def check_publish():
+    """ Publish six books to the stub, concurrently, and check the repo index. """
+    root = tempfile.mkdtemp()
+    jobs = [book_job(root, i) for i in range(6)]
+
+    server = StubGitHub(root)
+    server.addRepo('000000999')
+    indexPath = os.path.join(root, 'repos.json')
+    publisher = stub_publisher(server, indexPath)
+    start = time.time()
+    results = [r for r in publisher.publish(jobs)]
+    assert all(r.ok for r in results), [str(r) for r in results]
+    assert all(r.metrics['counters']['api_calls'] == 1 and 'push' in r.metrics['stages'] for r in results)
+    for job in jobs:
+        local = sh.git('-C', job.directory, 'rev-parse', 'gh-pages').strip()
+        remote = sh.git('--git-dir', os.path.join(root, job.name + '.git'), 'rev-parse', 'gh-pages').strip()
+        assert local == remote, job.name
+    print('Published %d books in %.1f seconds' % (len(results), time.time() - start))
+
+    # Existing repos are checked, without listing the org again: one which
+    # was already pushed is published, as is one which was created but not
+    # pushed (as when a run is interrupted), but not one with another book
+    os.rename(os.path.join(jobs[1].directory, '.git'), os.path.join(root, 'other.git'))
+    other = book_job(root, 1, 'Another book')
+    empty = book_job(root, 6)
+    server.addRepo(empty.name)
+    publisher.repos.add(empty.name)
+    results = {r.filename: r for r in publisher.publish([jobs[0], other, empty])}
+    assert results[jobs[0].directory].ok and results[empty.directory].ok
+    assert not results[other.directory].ok and 'already exists' in results[other.directory].error
+    assert remote_heads(os.path.join(root, empty.name + '.git'))
+    # The org, one listing and six creations
+    assert server.listings == 1 and server.remaining == LIMIT - 8, (server.listings, server.remaining)
+
+    # The repo index persists, and a new process's refresh finds it unchanged
+    # with a 304, which costs nothing...
+    org = server.session().organization(ORG)
+    repos = RepoIndex(org, indexPath)
+    assert '000000999' in repos and jobs[0].name in repos
+    remaining = server.remaining
+    assert repos.refresh() is False and server.remaining == remaining
+    # ...unless someone else has created a repo
+    server.addRepo('000001000')
+    repos = RepoIndex(org, indexPath)
+    assert repos.refresh() is True and '000001000' in repos.names
+    print('Listed and created repos through github3: OK')
+
+    # Listings longer than a page are followed to the end, keeping the ETag of the first page
+    for i in range(120):
+        server.addRepo('%09d' % (2000 + i), create=False)
+    repos = RepoIndex(org, indexPath)
+    assert repos.refresh() is True and len(repos.names) == 129 and repos.refresh() is False
+    print('Followed a paginated listing: OK')
+
+    # With the rate limit nearly used up, creating a repo waits for the reset
+    server.remaining = 3
+    server.reset = time.time() + 1
+    publisher = stub_publisher(server, indexPath, minRemaining=5)
+    start = time.time()
+    results = [r for r in publisher.publish([book_job(root, 7)])]
+    assert results[0].ok, str(results[0])
+    assert time.time() - start >= 1 and server.remaining > 5
+    print('Waited %.1f seconds for the rate limit to reset: OK' % (time.time() - start))
+    server.shutdown()
+
+def book_job(root, i, text='Book'):
+    """ A job for a repo of a one page book. """
+    directory = os.path.join(root, 'book%d' % i)
+    fast = FastImport(init_repo(directory))
+    fast.commit('gh-pages', 'Book %d' % i, [('index.md', '100644', fast.blob('%s %d\n' % (text, i)))])
+    fast.close()
+    return PublishJob('%09d' % i, 'Book %d' % i, None, directory)
+
+def remote_heads(gitdir):
+    return sh.git('--git-dir', gitdir, 'for-each-ref', '--format=%(refname) %(objectname)').strip()
+
+def check_update():
+    """ Update a book published as process --push does, which has no master, and check nothing is pushed. """
+    root = tempfile.mkdtemp()
+    filename = os.path.join(DATA, '000000037_0_1-42pgs__944211_dat.zip')
+    with CdContext(root):
+        directory = gitlit.main.process_book(filename, useCache=False)
+    server = StubGitHub(root, delay=0)
+    publisher = stub_publisher(server, os.path.join(root, 'repos.json'))
+    results = [r for r in publisher.publish([PublishJob.fromDirectory(directory)])]
+    assert results[0].ok, str(results[0])
+    server.shutdown()
+    remote = os.path.join(root, '000000037.git')
+    published = remote_heads(remote)
+    assert 'refs/heads/master' not in published
+
+    staging = os.path.join(root, 'staging.git')
+    assert update([filename], staging, root).exit_code == 0
+    assert remote_heads(remote) == published
+    # The published master is staged, so the next run has nothing to fetch or commit
+    staged = sh.git('--git-dir', staging, 'rev-parse', '000000037/master', '000000037/gh-pages^').split()
+    assert staged[0] == staged[1]
+    print('Updated an unchanged published book without pushing: OK')
+
+    # A book which fails doesn't stop a changed one being pushed, but the run still fails
+    broken = os.path.join(root, '000000001_0_1-1pgs__1_dat.zip')
+    with open(broken, 'wb') as f:
+        f.write(b'Not a zip')
+    init_repo(os.path.join(root, '000000196.git'), bare=True)
+    result = update([broken, os.path.join(DATA, '000000196_0_1-164pgs__1031646_dat.zip')], staging, root)
+    assert result.exit_code != 0 and '1 of 2 books failed' in result.output, result.output
+    assert 'refs/heads/gh-pages' in remote_heads(os.path.join(root, '000000196.git'))
+    print('Pushed the changed book despite a failure: OK')
+
+def update(filenames, staging, root):
+    """ Run update --push, with the repos under root. """
+    (saved, gitlit.github.REMOTE) = (gitlit.github.REMOTE, os.path.join(root, '%s.git'))
+    try:
+        return CliRunner().invoke(gitlit.main.cli, ['update', '--staging', staging, '--push', '--no-cache'] + filenames)
+    finally:
+        gitlit.github.REMOTE = saved
+
+
+if __name__ == '__main__':
+    check_publish()
+    check_update()